@@ -0,0 +1,186 @@
+"""
+Compact announce packets. Announces are sent as a fixed binary header followed by length prefixed text fields, so the
+server identity, ports, client count, load and what's playing fit in a single datagram of under MAX_SIZE bytes.
+Long free text fields (name, title, artist, album) are truncated to fit. Any other field, such as an address or the
+artwork URL, is left out if it doesn't fit whole, and space is given out in priority order so artwork goes first.
+JSON announces are still understood so older servers are found.
+
+Packet layout, all integers big endian:
+
+    magic (2) 'PA' | version (1) | flags (1) | server id (16) | control port (2) | RTP port (2) |
+    multicast RTP port (2) | clients (2) | load * 100 (2) | alive since (8, double) | fields...
+
+Each field is a type byte, a length byte and that many bytes of UTF-8. Unknown field types are skipped.
+"""
+import json
+import struct
+import binascii
+
+MAGIC = b'PA'
+VERSION = 1
+HEADER = struct.Struct('!2sBB16sHHHHHd')
+FIELD = struct.Struct('!BB')
+#Announces are a single datagram, below the WiFi MTU once IP and UDP headers are added.
+MAX_SIZE = 1024
+#Sent in place of a value that isn't known.
+UNKNOWN = 0xFFFF
+
+
+class Field(object):
+    NAME = 1
+    TITLE = 2
+    ARTIST = 3
+    ALBUM = 4
+    ARTWORK = 5
+    NONCE = 6
+    BACKEND = 7
+    MULTICAST_GROUP = 8
+    ZONE = 9
+    ADDRESS = 10
+
+
+#Where each field is found in the announce dict, in the order space is given out.
+FIELDS = [
+    (Field.NONCE, ('NONCE',)),
+    (Field.NAME, ('NAME',)),
+    (Field.ADDRESS, ('ADDRESS',)),
+    (Field.MULTICAST_GROUP, ('MULTICAST_GROUP',)),
+    (Field.ZONE, ('ZONE',)),
+    (Field.TITLE, ('NOW_PLAYING', 'TITLE')),
+    (Field.ARTIST, ('NOW_PLAYING', 'ARTIST')),
+    (Field.ALBUM, ('NOW_PLAYING', 'ALBUM')),
+    (Field.BACKEND, ('NOW_PLAYING', 'BACKEND')),
+    (Field.ARTWORK, ('NOW_PLAYING', 'ARTWORK')),
+]
+
+
+#Fields that can be cut short and still make sense, others are sent whole or not at all.
+TEXT_FIELDS = frozenset([Field.NAME, Field.TITLE, Field.ARTIST, Field.ALBUM])
+
+
+class AnnounceError(ValueError):
+    """
+    Raised for a packet that isn't a PartyBox announce.
+    """
+    pass
+
+
+def truncate(text, size):
+    """
+    Encodes text as UTF-8 cut to at most size bytes without splitting a character.
+    :rtype: bytes
+    """
+    data = text.encode('UTF-8')
+    if len(data) <= size:
+        return data
+    return data[:size].decode('UTF-8', 'ignore').encode('UTF-8')
+
+
+def _get(announce, path):
+    for key in path:
+        if not isinstance(announce, dict):
+            return None
+        announce = announce.get(key)
+    return announce
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('UTF-8', 'replace')
+    return u'{}'.format(value)
+
+
+def _number(value, scale=1):
+    if value is None:
+        return UNKNOWN
+    return min(int(round(value * scale)), UNKNOWN - 1)
+
+
+def encode(message, compact=True):
+    """
+    Encodes an announce message.
+    :param dict message: The message, announce fields are in message['PARTYBOX'].
+    :param bool compact: Use the binary format, falls back to JSON if the message can't be packed.
+    :rtype: bytes
+    """
+    announce = message['PARTYBOX']
+    try:
+        server_id = binascii.unhexlify(announce['ID'])
+    except (KeyError, TypeError, ValueError, binascii.Error):
+        server_id = None
+    if not compact or server_id is None or len(server_id) != 16:
+        return json.dumps(message).encode('UTF-8')
+
+    out = [HEADER.pack(MAGIC, VERSION, 0, server_id,
+                       _number(announce.get('PORT')),
+                       _number(announce.get('RTP_PORT')),
+                       _number(announce.get('MULTICAST_PORT')),
+                       _number(announce.get('CLIENTS')),
+                       _number(announce.get('LOAD'), 100),
+                       announce.get('ALIVE_SINCE') or 0)]
+    space = MAX_SIZE - HEADER.size
+    for field, path in FIELDS:
+        value = _get(announce, path)
+        if value is None or space <= FIELD.size:
+            continue
+        limit = min(space - FIELD.size, 255)
+        if field in TEXT_FIELDS:
+            data = truncate(_text(value), limit)
+        else:
+            data = _text(value).encode('UTF-8')
+            if len(data) > limit:
+                continue
+        out.append(FIELD.pack(field, len(data)) + data)
+        space -= FIELD.size + len(data)
+    return b''.join(out)
+
+
+def decode(data):
+    """
+    Decodes an announce in either format.
+    :return: The message, as encode takes it.
+    :rtype: dict
+    :raises AnnounceError: If the packet isn't an announce.
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        try:
+            message = json.loads(data.decode('UTF-8'))
+        except (ValueError, UnicodeDecodeError):
+            raise AnnounceError('Not an announce packet')
+        if not isinstance(message, dict) or not isinstance(message.get('PARTYBOX'), dict):
+            raise AnnounceError('Not an announce packet')
+        return message
+
+    try:
+        magic, version, flags, server_id, port, rtp_port, multicast_port, clients, load, alive_since = \
+            HEADER.unpack_from(data)
+    except struct.error:
+        raise AnnounceError('Truncated announce header')
+    if version != VERSION:
+        raise AnnounceError('Unsupported announce version {}'.format(version))
+
+    announce = {
+        'TYPE': 'BROADCAST',
+        'ID': binascii.hexlify(server_id).decode('ascii'),
+        'PORT': None if port == UNKNOWN else port,
+        'RTP_PORT': None if rtp_port == UNKNOWN else rtp_port,
+        'MULTICAST_PORT': None if multicast_port == UNKNOWN else multicast_port,
+        'CLIENTS': None if clients == UNKNOWN else clients,
+        'LOAD': None if load == UNKNOWN else load / 100.0,
+        'ALIVE_SINCE': alive_since or None,
+    }
+    paths = dict(FIELDS)
+    offset = HEADER.size
+    while offset + FIELD.size <= len(data):
+        field, length = FIELD.unpack_from(data, offset)
+        offset += FIELD.size
+        value = data[offset:offset + length].decode('UTF-8', 'replace')
+        offset += length
+        path = paths.get(field)
+        if path is None:
+            continue
+        target = announce
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        target[path[-1]] = value
+    return {'PARTYBOX': announce}
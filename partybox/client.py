@@ -4,6 +4,19 @@ import time
 import json
 import logging
 import select
+import uuid
+import threading
+
+import mdns
+import announce
+import network
+from network import NetworkUtils
+import protocol
+from protocol import MessageType
+from ramp import Ramp, RampScheduler
+from scheduler import Scheduler
+from state import StateMirror
+from discovery import DiscoveryRegistry, DiscoveryCache, ConnectRace, ServerEvent, ServerFound
 
 class PartyBoxClient(object):
 
@@ -42,106 +55,225 @@ class PartyBoxClient(object):
         """
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.connect((self.host, self.port,))
-        while True:
-            msg = s.recv(1024)
-            print msg
+        decoder = protocol.FrameDecoder()
+        while decoder.recv_into(s):
+            for msg_type, payload in decoder.frames():
+                if msg_type == MessageType.PING:
+                    s.sendall(protocol.encode(MessageType.PONG, payload.tobytes()))
+                else:
+                    print msg_type, payload.tobytes()
 
 
 class NetworkListener(object):
     """
-    Listens on the local network for any PartyBox servers.
+    Listens on the local network for any PartyBox servers. Runs until stopped, keeping a DiscoveryRegistry of every
+    server heard so an app can show and pick servers without waiting for a scan.
     """
 
-    def __init__(self, port, callback=None):
+    def __init__(self, port, callback=None, ttl=30, scheduler=None, group=network.DISCOVERY_GROUP, interface=None):
         """
         Sets up the socket for listening
+        :param int port: The announce port.
+        :param callable callback: Called with each discovery.ServerEvent.
+        :param float ttl: Seconds without an announce before a server is forgotten.
+        :param str group: Multicast group servers announce to.
+        :param str interface: Address of the interface to listen on, None lets the kernel choose.
         """
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.bind(('0.0.0.0', port))
+        self.group = group
+        self.socket = NetworkUtils.multicast_receiver(group, port, interface)
+        self.port = self.socket.getsockname()[1]
         self.socket.setblocking(0)
         self.log = logging.getLogger('PartyBox')
-        self.callback = callback
-
-
-
-    def _listen(self, timeout=10):
+        self.registry = DiscoveryRegistry(ttl, scheduler)
+        self._found = threading.Event()
+        self.registry.register_callback(ServerFound, lambda event: self._found.set())
+        if callback:
+            self.registry.register_callback(ServerEvent, callback)
+        self._running = False
+
+    def probe(self, address=None):
         """
-        Starts listening for partybox hosts
+        Asks any servers listening to announce themselves now rather than waiting for their next packet.
+        :return: The nonce sent, servers echo it in their reply.
         """
-        self.log.info('Listening for party hosts for {} seconds'.format(timeout))
+        nonce = uuid.uuid4().hex
+        probe = {'PARTYBOX': {'TYPE': 'PROBE', 'NONCE': nonce}}
+        self.registry.probe_sent(nonce)
+        self.socket.sendto(json.dumps(probe).encode('UTF-8'), (address or self.group, self.port))
+        return nonce
 
-        start = time.time()
-        #TODO: This is poorly implemented, might be better to constantly listen for any hosts.
-        while time.time() - start < timeout:
-            ready = select.select([self.socket], [], [], 1)
+    def query(self, timeout=1.0):
+        """
+        Asks for servers with a DNS-SD query, servers answer straight away with a unicast reply. Servers found are
+        added to the registry.
+        :param float timeout: Seconds to wait for replies.
+        :return: The servers found.
+        :rtype: list
+        """
+        found = []
+        for service in mdns.query(timeout=timeout):
+            if 'id' not in service.txt:
+                continue
+            message = {'TYPE': 'BROADCAST', 'ID': service.txt['id'], 'NAME': service.name, 'PORT': service.port}
+            found.append(self.registry.update(message, service.address))
+        return found
+
+    def start(self):
+        """
+        Starts listening on a daemon thread and probes for servers.
+        """
+        if self._running:
+            return
+        self._running = True
+        t = threading.Thread(target=self._listen, name='NetworkListener')
+        t.daemon = True
+        t.start()
+        self.probe()
 
-            if ready[0]:
+    def stop(self):
+        if self._running:
+            #The listening thread closes the socket on its way out.
+            self._running = False
+        else:
+            self.socket.close()
+        self.registry.stop()
+
+    def _listen(self):
+        """
+        Feeds announces into the registry until stopped.
+        """
+        self.log.info('Listening for party hosts')
+        while self._running:
+            ready = select.select([self.socket], [], [], 0.5)
+            if not ready[0]:
+                continue
+            try:
                 data, addr = self.socket.recvfrom(1024)
+            except socket.error as e:
+                self.log.warning('Could not read broadcast: {}'.format(e))
+                continue
+            try:
+                self.registry.update(announce.decode(data)['PARTYBOX'], addr[0])
+            except (announce.AnnounceError, AttributeError, TypeError, ValueError):
+                #One bad packet mustn't stop discovery
+                self.log.debug('Could not decode broadcast data from {}'.format(addr))
+        self.socket.close()
+
+    def wait_for_server(self, timeout=10):
+        """
+        Waits for a server to be found.
+        :return: The server with the fewest clients, None if none were found within timeout.
+        :rtype: discovery.ServerInfo
+        """
+        self._found.wait(timeout)
+        servers = self.registry.servers
+        return servers[0] if servers else None
 
-                try:
-                    data = json.loads(data)
-                    return addr[0]
-
-                except ValueError as e:
-                    self.log.debug('Could not decode broadcast data from {}'.format(addr))
-                    return None
-
-
-
-#Port to listen on
-PORT = 8234
-
-#Create VLC stuff
-instance = vlc.Instance()
-player = vlc.MediaPlayer(instance)
-
-#UDP listen
-s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-s.bind(('224.0.0.1', PORT))
-
-server_ip = None
-my_ip = None
-
-while True:
-    data, addr = s.recvfrom(1024)
-
-    try:
-        data = json.loads(data)
-        if 'PARTYBOX' in data:
-            print("Found server - {}".format(addr[0]))
-            server_ip = addr[0]
-            s.close()
-            break
-
-    except ValueError:
-        continue
-
-#Now try and connect to the server
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.connect((server_ip, PORT))
-
-data = s.recv(1024)
-if 'CONNECTED' in data:
-    my_ip = data.split(" ")[1]
-    print("Connected to host")
-
-#Set the media for vlc
-media = vlc.Media("rtp://{0}:{1}".format(my_ip, PORT))
-player.set_media(media)
-player.play()
-
-while True:
-    data = s.recv(1024)
-    print(data)
-    if 'RESTART' in data:
-        print("Restarting stream")
-        player.stop()
-        player.play()
-    elif 'VOLUME' in data:
-        print("Setting volume")
-        volume = data.split(" ")[1]
-        player.audio_set_volume(int(volume))
-    # import pdb; pdb.set_trace()
-        print player.get_state()
-
-
+    def connect(self, cache=None, timeout=None):
+        """
+        Connects to a server. Servers in the cache are connected to directly while discovery runs and any server
+        discovered joins the race, whichever connects first is used. After a restart this usually connects without
+        waiting for an announce.
+        :param discovery.DiscoveryCache cache: Servers seen before, updated with the server connected to.
+        :param float timeout: Seconds to keep trying, None tries forever.
+        :return: The connected socket and the server, None if nothing connected within timeout.
+        :rtype: tuple
+        """
+        race = ConnectRace()
+        candidates = {}
+        end = None if timeout is None else time.time() + timeout
+        try:
+            for server in (cache.servers() if cache else []):
+                candidates.setdefault(server.address, server)
+                race.add(server.address)
+            while end is None or time.time() < end:
+                for server in self.registry.servers:
+                    #A discovered server is more up to date than the cached entry for the same address.
+                    candidates[server.address] = server
+                    race.add(server.address)
+                connected = race.poll(0.05)
+                if connected:
+                    sock, address = connected
+                    server = candidates[address]
+                    if cache:
+                        server.last_seen = time.time()
+                        cache.remember(server)
+                    return sock, server
+        finally:
+            race.close()
+        return None
+
+
+if __name__ == '__main__':
+    #Port to listen on
+    PORT = 8234
+
+    #Create VLC stuff
+    instance = vlc.Instance()
+    player = vlc.MediaPlayer(instance)
+
+    #Volume ramps are interpolated locally
+    scheduler = Scheduler()
+    scheduler.start()
+    ramps = RampScheduler(scheduler, player.audio_set_volume)
+
+    #Find a server, servers connected to before are tried directly while the listener probes for others. The
+    #listener keeps running so the server can be found again straight away after losing it.
+    cache = DiscoveryCache()
+    listener = NetworkListener(PORT)
+    cache.track(listener.registry)
+    listener.start()
+    threading.Thread(target=listener.query).start()
+
+    my_ip = None
+
+    def state_changed(changes):
+        print("State changed {}".format(changes))
+
+    #Playback state as the server sees it, kept across reconnects so resuming only costs the deltas missed
+    state = StateMirror(state_changed)
+
+    while True:
+        s, server = listener.connect(cache)
+        print("Connected to server - {}".format(server))
+        if state.synced:
+            #The server waits briefly for this before sending a snapshot
+            s.sendall(protocol.encode(MessageType.RESUME, state.resume_payload()))
+
+        decoder = protocol.FrameDecoder()
+        try:
+            while decoder.recv_into(s):
+                for msg_type, payload in decoder.frames():
+                    if msg_type == MessageType.CONNECTED:
+                        my_ip = payload.tobytes().decode('UTF-8')
+                        print("Connected to host")
+                        #Set the media for vlc
+                        media = vlc.Media("rtp://{0}:{1}".format(my_ip, PORT))
+                        player.set_media(media)
+                        player.play()
+                    elif msg_type == MessageType.PING:
+                        s.sendall(protocol.encode(MessageType.PONG, payload.tobytes()))
+                    elif msg_type == MessageType.RESTART:
+                        print("Restarting stream")
+                        player.stop()
+                        player.play()
+                    elif msg_type == MessageType.VOLUME:
+                        print("Setting volume")
+                        ramps.cancel()
+                        player.audio_set_volume(int(payload.tobytes()))
+                    elif msg_type == MessageType.SNAPSHOT:
+                        state.apply_snapshot(payload)
+                    elif msg_type == MessageType.DELTA:
+                        if not state.apply_delta(payload):
+                            print("Missed a state change, resyncing")
+                            s.sendall(protocol.encode(MessageType.RESYNC))
+                    elif msg_type == MessageType.RAMP:
+                        ramp = Ramp.decode(payload)
+                        print("Ramping volume {}".format(ramp))
+                        ramps.start(ramp)
+                    else:
+                        print(msg_type, payload.tobytes())
+        except socket.error as e:
+            print("Connection error {}".format(e))
+        s.close()
+        print("Lost connection to host, reconnecting")
@@ -0,0 +1,421 @@
+import os
+import time
+import json
+import errno
+import select
+import socket
+import logging
+import threading
+
+import events
+from scheduler import default_scheduler
+
+
+class ServerInfo(object):
+    """
+    A PartyBox server seen on the network.
+    """
+
+    def __init__(self, server_id, address, now=None):
+        """
+        :param str server_id: The ID the server announces.
+        :param tuple address: Host and control port of the server.
+        """
+        self.id = server_id
+        self.address = address
+        self.name = None
+        self.alive_since = None
+        self.clients = None
+        self.load = None
+        self.rtp_port = None
+        self.multicast_group = None
+        self.multicast_port = None
+        self.zone = None
+        self.now_playing = None
+        self.rtt = None
+        self.first_seen = self.last_seen = time.time() if now is None else now
+
+    @property
+    def uptime(self):
+        """
+        Seconds the server had been running when last heard from, None if it didn't say.
+        :rtype: float
+        """
+        if self.alive_since is None:
+            return None
+        return max(self.last_seen - self.alive_since, 0)
+
+    def update(self, announce, address, now):
+        """
+        Updates the entry from an announce packet.
+        :return: True if anything other than the last seen time changed.
+        :rtype: bool
+        """
+        before = self._state()
+        self.address = address
+        self.name = announce.get('NAME', self.name)
+        self.alive_since = announce.get('ALIVE_SINCE', self.alive_since)
+        self.clients = announce.get('CLIENTS', self.clients)
+        self.load = announce.get('LOAD', self.load)
+        self.rtp_port = announce.get('RTP_PORT', self.rtp_port)
+        self.multicast_group = announce.get('MULTICAST_GROUP', self.multicast_group)
+        self.multicast_port = announce.get('MULTICAST_PORT', self.multicast_port)
+        self.zone = announce.get('ZONE', self.zone)
+        self.now_playing = announce.get('NOW_PLAYING')
+        self.last_seen = now
+        return before != self._state()
+
+    def _state(self):
+        return (self.address, self.name, self.alive_since, self.clients, self.load, self.rtp_port,
+                self.multicast_group, self.multicast_port, self.zone, self.now_playing)
+
+    def __repr__(self):
+        return 'ServerInfo({0} {1}:{2})'.format(self.name or self.id, *self.address)
+
+
+class ServerEvent(events.Event):
+    """
+    Base class for changes to a DiscoveryRegistry.
+    """
+
+    def __init__(self, server):
+        super(ServerEvent, self).__init__()
+        self.server = server
+
+    def __repr__(self):
+        return '{0}({1})'.format(self.__class__.__name__, self.server)
+
+
+class ServerFound(ServerEvent):
+    pass
+
+
+class ServerChanged(ServerEvent):
+    pass
+
+
+class ServerLost(ServerEvent):
+    pass
+
+
+class DiscoveryRegistry(object):
+    """
+    A live table of the servers announcing on the network, keyed by server ID. Entries are updated by each announce,
+    expire once a server hasn't been heard from for ttl seconds and changes are published as ServerEvents. Thread
+    safe, announces are usually fed in from a NetworkListener thread.
+    """
+
+    #Weight of the newest sample in the smoothed RTT
+    RTT_ALPHA = 0.25
+
+    def __init__(self, ttl=30, scheduler=None, event_workers=1):
+        """
+        :param float ttl: Seconds without an announce before a server is forgotten.
+        :param scheduler.Scheduler scheduler: Scheduler to run expiry on, defaults to the process wide scheduler.
+        :param int event_workers: Threads delivering events to callbacks.
+        """
+        self.ttl = ttl
+        self.log = logging.getLogger('Discovery')
+        self.events = events.EventBus(event_workers)
+        self._servers = {}
+        self._probes = {}
+        self._lock = threading.Lock()
+        self._scheduler = scheduler or default_scheduler()
+        self._expiry = self._scheduler.call_every(max(ttl / 4.0, 0.01), self.expire)
+
+    def register_callback(self, event_type, callable, coalesce=False):
+        """
+        Registers an event callback, called with the event on the event bus worker pool.
+        :param event_type: A ServerEvent subclass or tuple of them.
+        :rtype: events.Subscription
+        """
+        return self.events.subscribe(event_type, callable, coalesce)
+
+    def probe_sent(self, nonce, now=None):
+        """
+        Records a probe so the RTT can be measured from the reply echoing its nonce.
+        """
+        with self._lock:
+            self._probes[nonce] = time.time() if now is None else now
+
+    def update(self, message, host, now=None):
+        """
+        Adds or refreshes a server from a decoded announce packet.
+        :param dict message: The announce, the PARTYBOX dict of the packet.
+        :param str host: Address the packet came from, the servers own ADDRESS for the interface is preferred.
+        :return: The servers entry, None if the message isn't a server announce or has no control port.
+        :rtype: ServerInfo
+        """
+        if message.get('TYPE') != 'BROADCAST' or not isinstance(message.get('ID'), basestring):
+            return None
+        if not isinstance(message.get('NONCE') or '', basestring):
+            self.log.debug('Ignoring announce with a bad nonce from {}'.format(host))
+            return None
+        if not message.get('PORT'):
+            #An older JSON announce, without the port there is nothing to connect to
+            self.log.debug('Ignoring announce without a port from {}'.format(host))
+            return None
+        now = time.time() if now is None else now
+        address = (message.get('ADDRESS') or host, message.get('PORT'))
+        event = None
+        with self._lock:
+            server = self._servers.get(message['ID'])
+            if server is None:
+                server = self._servers[message['ID']] = ServerInfo(message['ID'], address, now)
+                server.update(message, address, now)
+                event = ServerFound(server)
+            elif server.update(message, address, now):
+                event = ServerChanged(server)
+
+            sent = self._probes.pop(message.get('NONCE'), None)
+            if sent is not None:
+                rtt = now - sent
+                if server.rtt is None:
+                    server.rtt = rtt
+                else:
+                    server.rtt += self.RTT_ALPHA * (rtt - server.rtt)
+        if event:
+            self.log.debug(event)
+            self.events.publish(event)
+        return server
+
+    def expire(self, now=None):
+        """
+        Forgets servers that haven't announced within the ttl, run periodically on the scheduler.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            lost = [s for s in self._servers.values() if now - s.last_seen > self.ttl]
+            for server in lost:
+                del self._servers[server.id]
+            #Probes nobody answered
+            for nonce, sent in list(self._probes.items()):
+                if now - sent > self.ttl:
+                    del self._probes[nonce]
+        for server in lost:
+            self.log.debug('Server expired {}'.format(server))
+            self.events.publish(ServerLost(server))
+
+    def get(self, server_id):
+        """
+        :rtype: ServerInfo
+        """
+        return self._servers.get(server_id)
+
+    @property
+    def servers(self):
+        """
+        Known servers, those with the fewest clients first.
+        :rtype: list
+        """
+        with self._lock:
+            servers = list(self._servers.values())
+        return sorted(servers, key=lambda s: (s.clients is None, s.clients, s.load is None, s.load, s.rtt is None,
+                                              s.rtt))
+
+    def stop(self):
+        """
+        Stops expiring entries and delivering events.
+        """
+        self._expiry.cancel()
+        self.events.stop()
+
+
+class DiscoveryCache(object):
+    """
+    Servers recently seen by this client, kept on disk so a restarted client can connect to them directly rather than
+    waiting for an announce.
+    """
+
+    def __init__(self, path=None, max_entries=16, max_age=7 * 24 * 3600):
+        """
+        :param str path: File to keep the cache in, defaults to ~/.partybox/servers.json.
+        :param int max_entries: Most servers to remember.
+        :param float max_age: Seconds a server is remembered after it was last seen.
+        """
+        self.path = path or os.path.join(os.path.expanduser('~'), '.partybox', 'servers.json')
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.log = logging.getLogger('Discovery')
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return dict((e['id'], e) for e in json.load(f)['servers'])
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            self.log.debug('Could not load discovery cache {0}: {1}'.format(self.path, e))
+            return {}
+
+    def save(self):
+        """
+        Writes the cache, replacing the file in one step so a crash can't leave it half written.
+        """
+        with self._lock:
+            data = json.dumps({'servers': list(self._entries.values())})
+        directory = os.path.dirname(self.path)
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp = '{0}.{1}.tmp'.format(self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            self.log.warning('Could not save discovery cache {0}: {1}'.format(self.path, e))
+
+    def remember(self, server, save=True):
+        """
+        Adds or refreshes a server.
+        :param ServerInfo server: The server.
+        """
+        with self._lock:
+            self._entries[server.id] = {
+                'id': server.id,
+                'host': server.address[0],
+                'port': server.address[1],
+                'name': server.name,
+                'last_seen': server.last_seen,
+            }
+            if len(self._entries) > self.max_entries:
+                for entry in sorted(self._entries.values(), key=lambda e: e['last_seen'])[:-self.max_entries]:
+                    del self._entries[entry['id']]
+        if save:
+            self.save()
+
+    def track(self, registry):
+        """
+        Remembers every server a DiscoveryRegistry finds. The file is only written for a server new to the cache or
+        one whose address or name changed, not for every change of client count or load.
+        :param DiscoveryRegistry registry: The registry.
+        """
+        def changed(event):
+            self.remember(event.server, save=self._differs(event.server))
+
+        return registry.register_callback((ServerFound, ServerChanged), changed)
+
+    def _differs(self, server):
+        with self._lock:
+            entry = self._entries.get(server.id)
+        if entry is None:
+            return True
+        return (entry['host'], entry['port'], entry['name']) != (server.address[0], server.address[1], server.name)
+
+    def servers(self, now=None):
+        """
+        Remembered servers that aren't too old, the most recently seen first.
+        :rtype: list
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            entries = [e for e in self._entries.values() if now - e['last_seen'] <= self.max_age]
+        servers = []
+        for entry in sorted(entries, key=lambda e: e['last_seen'], reverse=True):
+            server = ServerInfo(entry['id'], (entry['host'], entry['port']), entry['last_seen'])
+            server.name = entry.get('name')
+            servers.append(server)
+        return servers
+
+
+class ConnectRace(object):
+    """
+    Connects to several addresses at once with non-blocking sockets and keeps whichever connects first, in the spirit
+    of happy eyeballs. Addresses can be added while the race runs, so servers found by discovery can join in. An
+    address that refuses or times out is dialled again after a backoff that doubles up to max_retry, so a server that
+    is restarting is still reached.
+    """
+
+    def __init__(self, timeout=2, retry=0.25, max_retry=5.0):
+        """
+        :param float timeout: Seconds before an attempt is given up.
+        :param float retry: Seconds before the first redial of a failed address.
+        :param float max_retry: Longest wait between redials.
+        """
+        self.timeout = timeout
+        self.retry = retry
+        self.max_retry = max_retry
+        self.log = logging.getLogger('Discovery')
+        self._attempts = {}
+        self._known = set()
+        #Address to the time of its next attempt and the backoff that led to it
+        self._retries = {}
+        self._poll = select.poll()
+
+    def __len__(self):
+        return len(self._attempts)
+
+    def add(self, address):
+        """
+        Starts connecting to an address, adding an address already in the race does nothing.
+        :param tuple address: Host and port.
+        """
+        address = tuple(address)
+        if address in self._known:
+            return
+        self._known.add(address)
+        self._dial(address)
+
+    def _dial(self, address):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        err = sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.log.debug('Connect to {0} failed: {1}'.format(address, os.strerror(err)))
+            sock.close()
+            self._failed(address)
+            return
+        self._attempts[sock.fileno()] = (sock, address, time.time())
+        self._poll.register(sock, select.POLLOUT)
+
+    def _failed(self, address):
+        """
+        Schedules a failed address to be dialled again.
+        """
+        backoff = self._retries.get(address, (None, self.retry / 2.0))[1]
+        backoff = min(backoff * 2, self.max_retry)
+        self._retries[address] = (time.time() + backoff, backoff)
+
+    def _drop(self, fd):
+        sock = self._attempts.pop(fd)[0]
+        self._poll.unregister(fd)
+        return sock
+
+    def poll(self, timeout=0):
+        """
+        Waits up to timeout seconds for an attempt to connect.
+        :return: The connected blocking socket and its address, None if nothing has connected yet.
+        :rtype: tuple
+        """
+        for fd, event in self._poll.poll(timeout * 1000):
+            sock, address, started = self._attempts[fd]
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            self._drop(fd)
+            if err or event & (select.POLLERR | select.POLLHUP):
+                self.log.debug('Connect to {0} failed: {1}'.format(address, os.strerror(err)))
+                sock.close()
+                self._failed(address)
+                continue
+            sock.setblocking(1)
+            self.log.debug('Connected to {0} in {1:.3f}s'.format(address, time.time() - started))
+            return sock, address
+
+        now = time.time()
+        for fd, (sock, address, started) in list(self._attempts.items()):
+            if now - started > self.timeout:
+                self._drop(fd).close()
+                self._failed(address)
+        for address, (due, backoff) in list(self._retries.items()):
+            if due <= now:
+                #Rescheduled if this attempt fails too
+                self._retries[address] = (float('inf'), backoff)
+                self._dial(address)
+        return None
+
+    def close(self):
+        """
+        Abandons the attempts still running.
+        """
+        for fd in list(self._attempts):
+            self._drop(fd).close()
+        self._retries.clear()
@@ -0,0 +1,269 @@
+"""
+Streaming engines for MediaServer. The default engine plays each track on a vlc.MediaPlayer with the stream output
+set on its vlc.Media. The VLM engine runs a single named VLM broadcast instead, a track change switches its input and
+a change of clients switches its output, so no media or player objects are created or destroyed along the way.
+
+The gapless engine is double buffered, shortly before a track ends the next one is opened on a second player and
+held paused on its first frame (a Preroll), then started the moment the first player reaches the end.
+
+The crossfade engine decodes tracks into a mixer.Mixer rather than streaming each one, a single output player streams
+the mix. The next track is started on a second player before the current one ends and the two are faded across.
+"""
+import time
+import logging
+
+import vlc
+
+
+class Engine(object):
+    PLAYER = 1
+    VLM = 2
+    GAPLESS = 3
+    CROSSFADE = 4
+
+
+def _sout(output):
+    """
+    VLM takes the sout chain itself rather than a media option.
+    """
+    prefix = ':sout='
+    return output[len(prefix):].strip() if output.startswith(prefix) else output
+
+
+class BroadcastInput(object):
+    """
+    The input of a VLMBroadcast, stands in for the vlc.Media a MediaPlayer returns from get_media.
+    """
+
+    def __init__(self, mrl):
+        self.mrl = mrl
+
+    def get_mrl(self):
+        return self.mrl
+
+
+class VLMBroadcast(object):
+    """
+    A named VLM broadcast with the parts of the vlc.MediaPlayer interface MediaServer uses, so it can take the place
+    of the player. Volume is only recorded, a broadcast has no output volume so clients apply the VOLUME and RAMP
+    messages they are sent.
+    """
+
+    #MediaPlayer events MediaServer attaches to and the VLM events they are raised for
+    EVENTS = {
+        vlc.EventType.VlmMediaInstanceStatusEnd: vlc.EventType.MediaPlayerEndReached,
+        vlc.EventType.VlmMediaInstanceStatusError: vlc.EventType.MediaPlayerEncounteredError,
+    }
+    STATES = {
+        vlc.EventType.VlmMediaInstanceStatusOpening: vlc.State.Opening,
+        vlc.EventType.VlmMediaInstanceStatusPlaying: vlc.State.Playing,
+        vlc.EventType.VlmMediaInstanceStatusPause: vlc.State.Paused,
+        vlc.EventType.VlmMediaInstanceStatusEnd: vlc.State.Ended,
+        vlc.EventType.VlmMediaInstanceStatusError: vlc.State.Error,
+        vlc.EventType.VlmMediaInstanceStopped: vlc.State.Stopped,
+    }
+
+    def __init__(self, instance, output, name='partybox'):
+        """
+        :param vlc.Instance instance: The VLC instance to run the broadcast on.
+        :param str output: The sout chain, as from VLCTools.
+        :param str name: Name of the broadcast.
+        """
+        self.instance = instance
+        self.name = name
+        self.log = logging.getLogger('VLMBroadcast')
+        self._output = _sout(output)
+        self._input = None
+        self._state = vlc.State.NothingSpecial
+        self._volume = 100
+        self._callbacks = {}
+        vlm_events = instance.vlm_get_event_manager()
+        for event_type in self.STATES:
+            vlm_events.event_attach(event_type, self._vlm_event)
+
+    def _vlm_event(self, event):
+        #The event is a libvlc_vlm_media_event, which the bindings union doesn't describe. Its first member, the
+        #broadcast name, lines up with filename.
+        name = event.u.filename
+        if name is not None and name.decode('UTF-8', 'replace') != self.name:
+            return
+        self._state = self.STATES.get(event.type, self._state)
+        self._fire(self.EVENTS.get(event.type), event)
+
+    def _fire(self, event_type, event=None):
+        for callback, args in self._callbacks.get(event_type, []):
+            callback(event, *args)
+
+    def event_manager(self):
+        return self
+
+    def event_attach(self, event_type, callback, *args):
+        """
+        Calls back on a MediaPlayer event with the event and args, EndReached, EncounteredError and MediaChanged are
+        raised.
+        """
+        self._callbacks.setdefault(event_type, []).append((callback, args))
+
+    def set_media(self, media):
+        """
+        Switches the broadcast to a new input, playback carries on with it if it was playing.
+        :param media: A vlc.Media or an MRL.
+        """
+        mrl = media.get_mrl() if hasattr(media, 'get_mrl') else media
+        if self._input is None:
+            self.instance.vlm_add_broadcast(self.name, mrl, self._output, 0, None, True, False)
+        else:
+            self.instance.vlm_set_input(self.name, mrl)
+        self._input = BroadcastInput(mrl)
+        if self._state in (vlc.State.Playing, vlc.State.Opening):
+            #An input change only takes effect once the broadcast is restarted
+            self.instance.vlm_play_media(self.name)
+        self._fire(vlc.EventType.MediaPlayerMediaChanged)
+
+    def get_media(self):
+        return self._input
+
+    def set_output(self, output):
+        """
+        Switches the broadcast to a new output, carrying on from the same point if it was playing.
+        :param str output: The sout chain, as from VLCTools.
+        """
+        self._output = _sout(output)
+        if self._input is None:
+            return
+        self.instance.vlm_set_output(self.name, self._output)
+        if self._state == vlc.State.Playing:
+            position = self.get_position()
+            self.instance.vlm_play_media(self.name)
+            if position > 0:
+                self.set_position(position)
+
+    def get_state(self):
+        return self._state
+
+    def play(self):
+        if self._input is None:
+            return -1
+        if self._state == vlc.State.Paused:
+            return self.set_pause(False)
+        self._state = vlc.State.Opening
+        return self.instance.vlm_play_media(self.name)
+
+    def stop(self):
+        if self._input is None:
+            return -1
+        self._state = vlc.State.Stopped
+        return self.instance.vlm_stop_media(self.name)
+
+    def set_pause(self, pause):
+        #vlm_pause_media toggles, only call it when the state needs to change
+        if self._input is None or bool(pause) == (self._state == vlc.State.Paused):
+            return 0
+        self._state = vlc.State.Paused if pause else vlc.State.Playing
+        return self.instance.vlm_pause_media(self.name)
+
+    def pause(self):
+        return self.set_pause(self._state != vlc.State.Paused)
+
+    def get_position(self):
+        if self._input is None:
+            return -1
+        return self.instance.vlm_get_media_instance_position(self.name, 0)
+
+    def set_position(self, position):
+        self.instance.vlm_seek_media(self.name, position * 100)
+
+    def get_time(self):
+        if self._input is None:
+            return -1
+        return self.instance.vlm_get_media_instance_time(self.name, 0)
+
+    def set_time(self, ms):
+        length = self.instance.vlm_get_media_instance_length(self.name, 0)
+        if length > 0:
+            self.set_position(min(float(ms) / length, 1.0))
+
+    def audio_get_volume(self):
+        return self._volume
+
+    def audio_set_volume(self, volume):
+        self._volume = volume
+        return 0
+
+    def release(self):
+        """
+        Removes the broadcast from VLM.
+        """
+        if self._input is not None:
+            self.instance.vlm_del_media(self.name)
+            self._input = None
+
+
+class Preroll(object):
+    """
+    A track opened on its own player and paused on its first frame, so it starts without waiting for the input to
+    open and buffer.
+    """
+
+    def __init__(self, instance, item, media, scheduler, volume=None, on_started=None):
+        """
+        :param vlc.Instance instance: The VLC instance to create the player on.
+        :param media.AbstractMedia item: The queue item being prerolled.
+        :param vlc.Media media: Its media, with the stream output set.
+        :param scheduler.Scheduler scheduler: Scheduler to call the player from outside VLC callbacks.
+        :param int volume: Volume to start at.
+        :param callable on_started: Called with the gap in seconds between start() and the player playing.
+        """
+        self.item = item
+        self.media = media
+        self.gap = None
+        self.on_started = on_started
+        self._scheduler = scheduler
+        self._started_at = None
+        self.log = logging.getLogger('Preroll')
+        media.add_option(':start-paused')
+        self.player = vlc.MediaPlayer(instance)
+        if volume is not None:
+            self.player.audio_set_volume(volume)
+        self.player.set_media(media)
+        events = self.player.event_manager()
+        events.event_attach(vlc.EventType.MediaPlayerPlaying, self._playing)
+        events.event_attach(vlc.EventType.MediaPlayerPaused, self._paused)
+        #Opens the input, it pauses on its first frame
+        self.player.play()
+
+    @property
+    def ready(self):
+        """
+        True once the player is paused on its first frame.
+        :rtype: bool
+        """
+        return self.player.get_state() == vlc.State.Paused
+
+    def start(self, ended_at=None):
+        """
+        Starts playing.
+        :param float ended_at: When the previous track ended, the gap is measured from it.
+        """
+        self._started_at = time.time() if ended_at is None else ended_at
+        if self.ready:
+            self.player.set_pause(0)
+        #Otherwise still opening, it is resumed as soon as it pauses
+
+    def _paused(self, event):
+        if self._started_at is not None and self.gap is None:
+            self._scheduler.call_later(0, self.player.set_pause, 0)
+
+    def _playing(self, event):
+        if self._started_at is None or self.gap is not None:
+            return
+        self.gap = time.time() - self._started_at
+        if self.on_started:
+            self.on_started(self.gap)
+
+    def release(self):
+        """
+        Stops and releases the player, must not be called from one of its VLC callbacks.
+        """
+        self.player.stop()
+        self.player.release()
@@ -0,0 +1,122 @@
+import time
+import logging
+import threading
+import collections
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class Event(object):
+    """
+    Base class for events published on an EventBus. Subscribers are matched on the event class, subscribing to a
+    base class receives all of its subclasses.
+    """
+
+    def __init__(self):
+        self.timestamp = time.time()
+
+
+class Subscription(object):
+    """
+    A callback subscribed to one or more event classes. Events for a subscription are delivered one at a time in the
+    order they were published. A coalescing subscription only receives the latest of any events that pile up while
+    it is busy.
+    """
+
+    def __init__(self, event_types, callback, coalesce=False):
+        self.event_types = event_types
+        self.callback = callback
+        self.coalesce = coalesce
+        self.coalesced = 0
+        self._mailbox = collections.deque()
+        self._scheduled = False
+
+    def matches(self, event):
+        return isinstance(event, self.event_types)
+
+
+class EventBus(object):
+    """
+    Delivers published events to subscribers on a fixed pool of worker threads, so a burst of events never starts
+    more threads than the pool size.
+    """
+
+    def __init__(self, workers=4):
+        """
+        :param int workers: Number of worker threads.
+        """
+        self.log = logging.getLogger('EventBus')
+        self._subscriptions = []
+        self._lock = threading.Lock()
+        self._ready = queue.Queue()
+        self._workers = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name='EventBus-{}'.format(i))
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def subscribe(self, event_types, callback, coalesce=False):
+        """
+        Subscribes callback(event) to events.
+        :param event_types: An Event subclass or tuple of them.
+        :param callable callback: Called with each event.
+        :param bool coalesce: Only deliver the latest event when several are waiting.
+        :rtype: Subscription
+        """
+        if not isinstance(event_types, tuple):
+            event_types = (event_types,)
+        subscription = Subscription(event_types, callback, coalesce)
+        with self._lock:
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.remove(subscription)
+
+    def publish(self, event):
+        """
+        Queues an event for every matching subscriber, returns without waiting for delivery.
+        :param Event event: The event.
+        """
+        with self._lock:
+            for subscription in self._subscriptions:
+                if not subscription.matches(event):
+                    continue
+                subscription._mailbox.append(event)
+                if not subscription._scheduled:
+                    subscription._scheduled = True
+                    self._ready.put(subscription)
+
+    def stop(self):
+        """
+        Stops the worker threads once queued deliveries have finished.
+        """
+        for t in self._workers:
+            self._ready.put(None)
+
+    def _work(self):
+        while True:
+            subscription = self._ready.get()
+            if subscription is None:
+                return
+            with self._lock:
+                event = subscription._mailbox.popleft()
+                if subscription.coalesce and subscription._mailbox:
+                    subscription.coalesced += len(subscription._mailbox)
+                    event = subscription._mailbox.pop()
+                    subscription._mailbox.clear()
+            try:
+                subscription.callback(event)
+            except Exception:
+                self.log.exception('Event callback failed for {}'.format(event))
+            with self._lock:
+                #Only one worker handles a subscription at a time, which keeps its events in order.
+                if subscription._mailbox:
+                    self._ready.put(subscription)
+                else:
+                    subscription._scheduled = False
@@ -0,0 +1,107 @@
+import time
+import struct
+import logging
+
+from protocol import MessageType
+
+#Ping payload, sequence number and send time. Clients echo it back in a PONG.
+PING = struct.Struct('!Id')
+
+
+class Liveness(object):
+    """
+    Heartbeat state for a single client.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.seq = 0
+        self.awaiting = False
+        self.missed = 0
+        self.rtt = None
+        self.last_seen = time.time()
+        self.timer = None
+
+    def stats(self):
+        return {
+            'rtt': self.rtt,
+            'missed': self.missed,
+            'last_seen': self.last_seen,
+        }
+
+
+class Heartbeat(object):
+    """
+    Pings every connected client on a shared Scheduler, one timer per client in the same timing wheel rather than a
+    thread each. A client that misses too many pings in a row is removed from the server. The round trip time of each
+    ping is kept as a smoothed RTT per client.
+    """
+
+    #Weight of the newest sample in the smoothed RTT
+    RTT_ALPHA = 0.125
+
+    def __init__(self, server, scheduler, interval=1.0, misses=3):
+        """
+        :param server: The control server, clients are expired with server.remove_client.
+        :param scheduler.Scheduler scheduler: Scheduler to run pings on.
+        :param float interval: Seconds between pings.
+        :param int misses: Number of unanswered pings before a client is removed.
+        """
+        self.server = server
+        self.scheduler = scheduler
+        self.interval = interval
+        self.misses = misses
+        self.log = logging.getLogger('Heartbeat')
+
+    def add(self, handler):
+        """
+        Starts pinging a newly connected client.
+        """
+        handler.liveness = Liveness(handler)
+        handler.liveness.timer = self.scheduler.call_later(self.interval, self._ping, handler.liveness)
+
+    def remove(self, handler):
+        """
+        Stops pinging a client.
+        """
+        liveness = getattr(handler, 'liveness', None)
+        if liveness and liveness.timer:
+            liveness.timer.cancel()
+
+    def _ping(self, liveness):
+        """
+        Timer callback, counts a miss if the previous ping is unanswered then sends the next.
+        """
+        if liveness.awaiting:
+            liveness.missed += 1
+        if liveness.missed >= self.misses:
+            address = liveness.handler.client_address
+            self.log.warning('Client {} missed {} pings, removing'.format(address, liveness.missed))
+            self.server.remove_client(address)
+            return
+
+        liveness.seq += 1
+        liveness.awaiting = True
+        liveness.handler.message(MessageType.PING, PING.pack(liveness.seq, time.time()))
+        liveness.timer = self.scheduler.call_later(self.interval, self._ping, liveness)
+
+    def pong(self, handler, payload):
+        """
+        Called when a client answers a ping.
+        :param payload: The echoed ping payload.
+        """
+        liveness = handler.liveness
+        seq, sent = PING.unpack_from(payload)
+        now = time.time()
+        liveness.last_seen = now
+        #Any reply shows the client is alive, a client whose RTT is longer than the interval answers every ping late
+        liveness.missed = 0
+        if seq != liveness.seq:
+            #A late reply says nothing about the RTT of the current ping
+            return
+        liveness.awaiting = False
+        rtt = now - sent
+        if liveness.rtt is None:
+            liveness.rtt = rtt
+        else:
+            liveness.rtt += self.RTT_ALPHA * (rtt - liveness.rtt)
@@ -0,0 +1,423 @@
+"""
+Minimal multicast DNS service discovery (RFC 6762/6763), enough for PartyBox servers to answer queries for their
+service and for clients to find them. Queries are answered straight away, so a client that asks doesn't have to wait
+for the next UDPAnnounce packet. Standard browsers (avahi-browse, dns-sd) see servers as _partybox._tcp.
+"""
+import time
+import errno
+import select
+import socket
+import struct
+import logging
+import threading
+
+from network import NetworkUtils
+
+MDNS_GROUP = '224.0.0.251'
+MDNS_PORT = 5353
+SERVICE = '_partybox._tcp.local.'
+
+CLASS_IN = 1
+#Top bit of the class, in a question asks for a unicast reply, in a record tells caches to replace older records.
+UNICAST_RESPONSE = CACHE_FLUSH = 0x8000
+#Flags of an authoritative response
+RESPONSE = 0x8400
+
+HEADER = struct.Struct('!HHHHHH')
+QUESTION = struct.Struct('!HH')
+RECORD = struct.Struct('!HHIH')
+SRV = struct.Struct('!HHH')
+
+
+class RecordType(object):
+    A = 1
+    PTR = 12
+    TXT = 16
+    SRV = 33
+    ANY = 255
+
+
+class DNSError(Exception):
+    """
+    Raised for a malformed DNS packet.
+    """
+    pass
+
+
+def encode_name(name):
+    """
+    Encodes a dotted name as DNS labels, names aren't compressed.
+    :rtype: bytes
+    """
+    out = b''
+    for label in name.rstrip('.').split('.'):
+        label = label.encode('UTF-8')
+        if len(label) > 63:
+            raise DNSError('Label too long {}'.format(label))
+        out += struct.pack('!B', len(label)) + label
+    return out + b'\0'
+
+
+def decode_name(data, offset):
+    """
+    Decodes a name, following compression pointers.
+    :return: The dotted name and the offset after it.
+    :rtype: tuple
+    """
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        if offset >= len(data):
+            raise DNSError('Name runs past end of packet')
+        length = ord(data[offset:offset + 1])
+        if length & 0xC0 == 0xC0:
+            if offset + 2 > len(data):
+                raise DNSError('Truncated name pointer')
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 32:
+                raise DNSError('Name pointer loop')
+            offset = struct.unpack_from('!H', data, offset)[0] & 0x3FFF
+        elif length == 0:
+            offset += 1
+            break
+        else:
+            labels.append(data[offset + 1:offset + 1 + length].decode('UTF-8', 'replace'))
+            offset += 1 + length
+    return '.'.join(labels) + '.', offset if end is None else end
+
+
+class Question(object):
+
+    def __init__(self, name, type, unicast=False):
+        self.name = name
+        self.type = type
+        self.unicast = unicast
+
+    def encode(self):
+        return encode_name(self.name) + QUESTION.pack(self.type, CLASS_IN | (UNICAST_RESPONSE if self.unicast else 0))
+
+    def __repr__(self):
+        return 'Question({0} {1})'.format(self.name, self.type)
+
+
+class Record(object):
+    """
+    A resource record. data depends on the type, PTR - the name pointed to, SRV - (priority, weight, port, target),
+    TXT - dict of strings, A - dotted IPv4 address. Other types keep their raw bytes.
+    """
+
+    def __init__(self, name, type, data, ttl=120, cache_flush=False):
+        self.name = name
+        self.type = type
+        self.data = data
+        self.ttl = ttl
+        self.cache_flush = cache_flush
+
+    def _encode_data(self):
+        if self.type == RecordType.PTR:
+            return encode_name(self.data)
+        if self.type == RecordType.SRV:
+            priority, weight, port, target = self.data
+            return SRV.pack(priority, weight, port) + encode_name(target)
+        if self.type == RecordType.TXT:
+            out = b''
+            for key, value in sorted(self.data.items()):
+                entry = '{0}={1}'.format(key, value).encode('UTF-8')[:255]
+                out += struct.pack('!B', len(entry)) + entry
+            return out or b'\0'
+        if self.type == RecordType.A:
+            return socket.inet_aton(self.data)
+        return self.data
+
+    @staticmethod
+    def _decode_data(type, packet, offset, length):
+        end = offset + length
+        if type == RecordType.PTR:
+            return decode_name(packet, offset)[0]
+        if type == RecordType.SRV:
+            priority, weight, port = SRV.unpack_from(packet, offset)
+            return priority, weight, port, decode_name(packet, offset + SRV.size)[0]
+        if type == RecordType.TXT:
+            txt = {}
+            while offset < end:
+                size = ord(packet[offset:offset + 1])
+                entry = packet[offset + 1:offset + 1 + size].decode('UTF-8', 'replace')
+                offset += 1 + size
+                if entry:
+                    key, _, value = entry.partition('=')
+                    txt[key] = value
+            return txt
+        if type == RecordType.A:
+            return socket.inet_ntoa(packet[offset:end])
+        return packet[offset:end]
+
+    def encode(self):
+        data = self._encode_data()
+        klass = CLASS_IN | (CACHE_FLUSH if self.cache_flush else 0)
+        return encode_name(self.name) + RECORD.pack(self.type, klass, self.ttl, len(data)) + data
+
+    def __repr__(self):
+        return 'Record({0} {1} {2})'.format(self.name, self.type, self.data)
+
+
+class Message(object):
+    """
+    A DNS query or response.
+    """
+
+    def __init__(self, id=0, flags=0, questions=None, answers=None, additionals=None):
+        self.id = id
+        self.flags = flags
+        self.questions = questions or []
+        self.answers = answers or []
+        self.additionals = additionals or []
+
+    @property
+    def is_response(self):
+        return bool(self.flags & 0x8000)
+
+    @property
+    def records(self):
+        return self.answers + self.additionals
+
+    def encode(self):
+        """
+        :rtype: bytes
+        """
+        out = [HEADER.pack(self.id, self.flags, len(self.questions), len(self.answers), 0, len(self.additionals))]
+        out.extend(q.encode() for q in self.questions)
+        out.extend(r.encode() for r in self.answers)
+        out.extend(r.encode() for r in self.additionals)
+        return b''.join(out)
+
+    @classmethod
+    def decode(cls, packet):
+        """
+        :raises DNSError: If the packet is malformed.
+        :rtype: Message
+        """
+        try:
+            id, flags, qd, an, ns, ar = HEADER.unpack_from(packet)
+            offset = HEADER.size
+            message = cls(id, flags)
+            for i in range(qd):
+                name, offset = decode_name(packet, offset)
+                type, klass = QUESTION.unpack_from(packet, offset)
+                offset += QUESTION.size
+                message.questions.append(Question(name, type, bool(klass & UNICAST_RESPONSE)))
+            records = []
+            for i in range(an + ns + ar):
+                name, offset = decode_name(packet, offset)
+                type, klass, ttl, length = RECORD.unpack_from(packet, offset)
+                offset += RECORD.size
+                if offset + length > len(packet):
+                    raise DNSError('Record runs past end of packet')
+                data = Record._decode_data(type, packet, offset, length)
+                records.append(Record(name, type, data, ttl, bool(klass & CACHE_FLUSH)))
+                offset += length
+        except struct.error as e:
+            raise DNSError('Truncated packet: {}'.format(e))
+        message.answers = records[:an]
+        message.additionals = records[an + ns:]
+        return message
+
+
+class DNSSDResponder(object):
+    """
+    Answers mDNS queries for a PartyBox service, runs beside UDPAnnounce. Questions for the service type, the instance
+    or its host get the PTR, SRV, TXT and A records in one response. Replies are unicast to the querier if the question
+    asks for it or the query didn't come from the mDNS port (a one-shot query), otherwise multicast as normal.
+    """
+
+    def __init__(self, name, port, txt=None, service=SERVICE, group=(MDNS_GROUP, MDNS_PORT), interface=None,
+                 ttl=120):
+        """
+        :param str name: Instance name shown to users.
+        :param int port: The control servers TCP port.
+        :param dict txt: Extra key value pairs for the TXT record.
+        :param str service: The service type.
+        :param tuple group: mDNS group address and port.
+        :param str interface: Address of the interface to answer on, None lets the kernel choose.
+        :param int ttl: TTL of the records in seconds.
+        """
+        self.log = logging.getLogger('DNSSDResponder')
+        self.name = name
+        self.port = port
+        self.txt = txt or {}
+        self.service = service
+        self.group = group
+        self.interface = interface
+        self.ttl = ttl
+        self.host = '{}.local.'.format(socket.gethostname().split('.')[0])
+        self.is_running = False
+        self._socket = None
+
+    @property
+    def instance(self):
+        return '{0}.{1}'.format(self.name.replace('.', ' '), self.service)
+
+    def records(self, address):
+        """
+        The services records.
+        :param str address: Address of the host in the A record.
+        :rtype: list
+        """
+        return [
+            Record(self.service, RecordType.PTR, self.instance, self.ttl),
+            Record(self.instance, RecordType.SRV, (0, 0, self.port, self.host), self.ttl, True),
+            Record(self.instance, RecordType.TXT, self.txt, self.ttl, True),
+            Record(self.host, RecordType.A, address, self.ttl, True),
+        ]
+
+    def answer(self, query, address):
+        """
+        Builds the response to a query.
+        :param Message query: The query.
+        :param str address: Address of the host in the A record.
+        :return: The response and whether it should be unicast, None if no question was for this service.
+        :rtype: tuple
+        """
+        if query.is_response:
+            return None
+        names = {self.service.lower(): RecordType.PTR, self.instance.lower(): None, self.host.lower(): RecordType.A}
+        matched = [q for q in query.questions if q.name.lower() in names]
+        if not matched:
+            return None
+        records = self.records(address)
+        answers = [r for r in records if any(q.name.lower() == r.name.lower() and q.type in (r.type, RecordType.ANY)
+                                              for q in matched)]
+        if not answers:
+            return None
+        additionals = [r for r in records if r not in answers]
+        unicast = any(q.unicast for q in matched)
+        return Message(query.id, RESPONSE, answers=answers, additionals=additionals), unicast
+
+    def _listen(self, sock):
+        """
+        Answers queries until the responder is stopped.
+        """
+        while self.is_running:
+            if not select.select([sock], [], [], 0.5)[0]:
+                continue
+            try:
+                data, addr = sock.recvfrom(9000)
+                query = Message.decode(data)
+            except DNSError as e:
+                self.log.debug('Bad query: {}'.format(e))
+                continue
+            except socket.error:
+                continue
+            address = self.interface or NetworkUtils.local_address(addr[0])
+            response = self.answer(query, address)
+            if response is None:
+                continue
+            response, unicast = response
+            if addr[1] != self.group[1]:
+                #One-shot queries from an ordinary socket get a unicast reply that echoes the question.
+                unicast = True
+                response.questions = query.questions
+            elif not unicast:
+                response.id = 0
+            try:
+                sock.sendto(response.encode(), addr if unicast else self.group)
+                self.log.debug('Answered {0} from {1}'.format(query.questions, addr))
+            except socket.error as e:
+                self.log.warning('Could not answer {0}: {1}'.format(addr, e))
+        sock.close()
+
+    def start(self):
+        """
+        Starts answering queries on a daemon thread.
+        """
+        if self.is_running:
+            return
+        try:
+            sock = NetworkUtils.multicast_receiver(self.group[0], self.group[1], self.interface, ttl=255,
+                                                   reuse_port=True)
+        except socket.error as e:
+            self.log.warning('Could not listen for mDNS queries on {0}: {1}'.format(self.group, e))
+            return
+        self.is_running = True
+        t = threading.Thread(target=self._listen, args=(sock,), name='DNSSDResponder')
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.is_running = False
+
+
+class Service(object):
+    """
+    A service found by query().
+    """
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.host = None
+        self.port = None
+        self.address = None
+        self.txt = {}
+
+    @property
+    def name(self):
+        return self.instance.split('.', 1)[0]
+
+    def __repr__(self):
+        return 'Service({0} {1}:{2})'.format(self.name, self.address, self.port)
+
+
+def query(service=SERVICE, timeout=1.0, group=(MDNS_GROUP, MDNS_PORT), interface=None, first=False):
+    """
+    Multicasts a one-shot query for a service type and collects the unicast replies.
+    :param str service: The service type.
+    :param float timeout: Seconds to wait for replies.
+    :param tuple group: mDNS group address and port.
+    :param str interface: Address of the interface to query on, None lets the kernel choose.
+    :param bool first: Return as soon as one service has been found.
+    :return: The services found, with an address and port.
+    :rtype: list
+    """
+    sock = NetworkUtils.multicast_sender(interface, ttl=255)
+    found = {}
+    try:
+        sock.sendto(Message(questions=[Question(service, RecordType.PTR, True)]).encode(), group)
+        end = time.time() + timeout
+        while True:
+            remaining = end - time.time()
+            if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+                break
+            try:
+                response = Message.decode(sock.recv(9000))
+            except DNSError:
+                continue
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            if not response.is_response:
+                continue
+            addresses = {}
+            for record in response.records:
+                if record.type == RecordType.PTR and record.name.lower() == service.lower():
+                    found.setdefault(record.data.lower(), Service(record.data))
+                elif record.type == RecordType.A:
+                    addresses[record.name.lower()] = record.data
+            for record in response.records:
+                entry = found.get(record.name.lower())
+                if entry is None:
+                    continue
+                if record.type == RecordType.SRV:
+                    entry.port, entry.host = record.data[2], record.data[3]
+                elif record.type == RecordType.TXT:
+                    entry.txt = record.data
+            for entry in found.values():
+                if entry.host and entry.host.lower() in addresses:
+                    entry.address = addresses[entry.host.lower()]
+            if first and any(s.address and s.port for s in found.values()):
+                break
+    finally:
+        sock.close()
+    return [s for s in found.values() if s.address and s.port]
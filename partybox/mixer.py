@@ -0,0 +1,218 @@
+"""
+Mixes decoded audio from several players into a single PCM stream, used for crossfades. Each track is decoded by its
+own vlc.MediaPlayer into the mixer through the libvlc audio callbacks, the mix is written to a pipe which one output
+player reads as raw audio and streams. The output stream carries on across tracks and overlapping tracks are heard
+mixed, each scaled by its own gain ramp.
+
+The first source is the clock, each time it delivers samples the same amount is taken from every other source and
+mixed in. When it is removed the next source takes over.
+"""
+import os
+import sys
+import time
+import errno
+import audioop
+import ctypes
+import logging
+import threading
+
+import vlc
+
+#Signed 16 bit samples in native byte order
+SAMPLE_WIDTH = 2
+SAMPLE_FORMAT = 'S16N'
+FOURCC = 's16l' if sys.byteorder == 'little' else 's16b'
+
+
+class MixerSource(object):
+    """
+    One input of a Mixer.
+    """
+
+    def __init__(self, max_buffer, ramp=None):
+        """
+        :param int max_buffer: Most bytes buffered while waiting to be mixed in, the oldest are dropped past it.
+        :param ramp.Ramp ramp: Gain of the source as a percentage over time, None for full gain.
+        """
+        self.ramp = ramp
+        self.dropped = 0
+        self._buffer = bytearray()
+        self._max_buffer = max_buffer
+
+    def gain(self, now):
+        """
+        :rtype: float
+        """
+        if self.ramp is None:
+            return 1.0
+        return self.ramp.value_at(now) / 100.0
+
+    def put(self, data):
+        self._buffer.extend(data)
+        over = len(self._buffer) - self._max_buffer
+        if over > 0:
+            del self._buffer[:over]
+            self.dropped += over
+
+    def take(self, size):
+        """
+        Removes size bytes from the buffer, padded with silence if there aren't enough.
+        :rtype: bytes
+        """
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        if len(data) < size:
+            data += b'\0' * (size - len(data))
+        return data
+
+    def drain(self):
+        data = bytes(self._buffer)
+        del self._buffer[:]
+        return data
+
+    def clear(self):
+        del self._buffer[:]
+
+
+class Mixer(object):
+    """
+    Mixes MixerSources into a file descriptor. Thread safe, sources are written to from VLC audio threads.
+    """
+
+    def __init__(self, fd, rate=44100, channels=2, max_buffer=2.0):
+        """
+        :param int fd: File descriptor to write the mix to, usually a pipe.
+        :param int rate: Sample rate.
+        :param int channels: Number of channels.
+        :param float max_buffer: Seconds of audio a source can buffer waiting to be mixed.
+        """
+        self.fd = fd
+        self.rate = rate
+        self.channels = channels
+        self.frame_size = SAMPLE_WIDTH * channels
+        self.log = logging.getLogger('Mixer')
+        self._max_buffer = int(rate * max_buffer) * self.frame_size
+        self._sources = []
+        self._lock = threading.Lock()
+
+    def options(self):
+        """
+        Media options for an input reading the mix as raw audio.
+        :rtype: list
+        """
+        return [':demux=rawaud', ':rawaud-fourcc={}'.format(FOURCC), ':rawaud-channels={}'.format(self.channels),
+                ':rawaud-samplerate={}'.format(self.rate)]
+
+    @property
+    def sources(self):
+        with self._lock:
+            return list(self._sources)
+
+    def add(self, ramp=None):
+        """
+        Adds a source, it is mixed in with the gain ramp.
+        :rtype: MixerSource
+        """
+        source = MixerSource(self._max_buffer, ramp)
+        with self._lock:
+            self._sources.append(source)
+        return source
+
+    def remove(self, source):
+        """
+        Removes a source. If it was the clock the next source takes over, what it has buffered is written straight
+        away.
+        """
+        with self._lock:
+            if source not in self._sources:
+                return
+            clock = self._sources[0] is source
+            self._sources.remove(source)
+            if not clock or not self._sources:
+                return
+            data = self._sources[0].drain()
+            out = self._scale(data, self._sources[0].gain(time.time()))
+        if out:
+            self._write(out)
+
+    def write(self, source, data):
+        """
+        Adds samples from a source. Samples from the clock are mixed with the others and written, anything else is
+        buffered until the clock catches up.
+        :param MixerSource source: The source the samples are from.
+        :param bytes data: Whole frames of samples.
+        """
+        with self._lock:
+            if not self._sources or self._sources[0] is not source:
+                if source in self._sources:
+                    source.put(data)
+                return
+            now = time.time()
+            out = self._scale(data, source.gain(now))
+            for other in self._sources[1:]:
+                out = audioop.add(out, self._scale(other.take(len(data)), other.gain(now)), SAMPLE_WIDTH)
+        self._write(out)
+
+    @staticmethod
+    def _scale(data, gain):
+        if gain >= 1.0 or not data:
+            return data
+        return audioop.mul(data, SAMPLE_WIDTH, max(gain, 0.0))
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self.fd, view):]
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                self.log.warning('Could not write mix: {}'.format(e))
+                return
+
+
+class MixerInput(object):
+    """
+    A vlc.MediaPlayer decoding into a Mixer rather than an audio output.
+    """
+
+    def __init__(self, mixer, instance, ramp=None):
+        """
+        :param Mixer mixer: The mixer.
+        :param vlc.Instance instance: The VLC instance to create the player on.
+        :param ramp.Ramp ramp: Gain ramp, None for full gain.
+        """
+        self.mixer = mixer
+        self.source = mixer.add(ramp)
+        self.player = vlc.MediaPlayer(instance)
+        #Kept referenced, libvlc only holds the function pointers
+        self._play_cb = vlc.CallbackDecorators.AudioPlayCb(self._play)
+        self._flush_cb = vlc.CallbackDecorators.AudioFlushCb(self._flush)
+        self.player.audio_set_callbacks(self._play_cb, None, None, self._flush_cb, None, None)
+        self.player.audio_set_format(SAMPLE_FORMAT, mixer.rate, mixer.channels)
+
+    def _play(self, opaque, samples, count, pts):
+        self.mixer.write(self.source, ctypes.string_at(samples, count * self.mixer.frame_size))
+
+    def _flush(self, opaque, pts):
+        #Seeking, drop what was decoded before it
+        self.source.clear()
+
+    def fade(self, ramp):
+        """
+        Changes the gain ramp.
+        :param ramp.Ramp ramp: The new ramp.
+        """
+        self.source.ramp = ramp
+
+    def release(self):
+        """
+        Stops the player and removes it from the mixer, must not be called from one of its VLC callbacks. Only the
+        first call does anything.
+        """
+        player, self.player = self.player, None
+        if player is None:
+            return
+        player.stop()
+        self.mixer.remove(self.source)
+        player.release()
@@ -1,5 +1,290 @@
 import subprocess
 import re
+import os
+import sys
+import time
+import errno
+import select
+import threading
+import socket
+import struct
+import zlib
+import logging
+
+#Organisation local scope multicast (RFC 2365), kept on site and ignored by hosts that haven't joined the group,
+#unlike 224.0.0.1 which every host on the LAN processes.
+DISCOVERY_GROUP = '239.255.42.99'
+#Each zone streams to its own group in 239.255.43.0/24
+STREAM_GROUP_PREFIX = '239.255.43.'
+#Linux only, 0 stops a socket bound to a port receiving every group joined on that port by other sockets.
+IP_MULTICAST_ALL = getattr(socket, 'IP_MULTICAST_ALL', 49)
+
+
+def zone_group(zone=None):
+    """
+    The multicast group a zone streams to, the same on every host.
+    :param str zone: Zone name, None for the default zone.
+    :rtype: str
+    """
+    if not zone:
+        return STREAM_GROUP_PREFIX + '1'
+    return STREAM_GROUP_PREFIX + str((zlib.crc32(zone.encode('UTF-8')) & 0xFFFFFFFF) % 253 + 2)
+
+#Flags in /proc/net/arp and /proc/net/route
+ATF_COM = 0x2
+RTF_UP = 0x1
+#Interface ioctls and flags from linux/sockios.h and net/if.h
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+IFF_MULTICAST = 0x1000
+
+
+class TTLCache(object):
+    """
+    Values that are loaded on first use and kept for ttl seconds.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, ttl, loader):
+        """
+        :param key: Cache key.
+        :param float ttl: Seconds a loaded value is kept.
+        :param callable loader: Called with no arguments to load the value.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._values.get(key)
+            if entry and entry[0] > now:
+                return entry[1]
+        value = loader()
+        with self._lock:
+            self._values[key] = (now + ttl, value)
+        return value
+
+    def invalidate(self, key=None):
+        """
+        Drops a cached value, or all of them.
+        """
+        with self._lock:
+            if key is None:
+                self._values.clear()
+            else:
+                self._values.pop(key, None)
+
+
+def _ip_to_int(address):
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+
+def _proc_hex_to_int(value):
+    #/proc/net/route holds addresses as hex in host (little endian) byte order
+    return struct.unpack('!I', struct.pack('<I', int(value, 16)))[0]
+
+
+def read_arp_table(path='/proc/net/arp'):
+    """
+    Reads the kernels ARP table, only complete entries are returned.
+    :return: MAC addresses keyed by IP address.
+    :rtype: dict
+    """
+    table = {}
+    with open(path) as f:
+        next(f)
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 4 and int(fields[2], 16) & ATF_COM:
+                table[fields[0]] = fields[3].lower()
+    return table
+
+
+def read_route_table(path='/proc/net/route'):
+    """
+    Reads the kernels IPv4 routing table, only routes that are up are returned.
+    :return: (interface, destination, mask, gateway, metric) tuples, addresses as ints. Sorted by prefix length, then
+    metric, so the first match for an address is the route used.
+    :rtype: list
+    """
+    routes = []
+    with open(path) as f:
+        next(f)
+        for line in f:
+            fields = line.split()
+            if len(fields) < 8 or not int(fields[3], 16) & RTF_UP:
+                continue
+            mask = _proc_hex_to_int(fields[7])
+            routes.append((fields[0], _proc_hex_to_int(fields[1]), mask, _proc_hex_to_int(fields[2]),
+                           int(fields[6])))
+    routes.sort(key=lambda r: (-bin(r[2]).count('1'), r[4]))
+    return routes
+
+
+def read_interface_names(path='/proc/net/dev'):
+    """
+    Reads the names of the network interfaces from /proc/net/dev.
+    :rtype: list
+    """
+    names = []
+    with open(path) as f:
+        for line in f.readlines()[2:]:
+            if ':' in line:
+                names.append(line.split(':', 1)[0].strip())
+    return names
+
+
+def _interface_ioctl(sock, name, request):
+    import fcntl
+    return fcntl.ioctl(sock.fileno(), request, struct.pack('256s', name[:15].encode('ascii')))
+
+
+def interface_info(name, sock=None):
+    """
+    Looks up an interface with ioctls. Linux only.
+    :param str name: Interface name, as in /proc/net/dev.
+    :return: Address, netmask and flags of the interface, None if it has no IPv4 address.
+    :rtype: tuple
+    """
+    s = sock or socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        flags = struct.unpack_from('H', _interface_ioctl(s, name, SIOCGIFFLAGS), 16)[0]
+        address = socket.inet_ntoa(_interface_ioctl(s, name, SIOCGIFADDR)[20:24])
+        netmask = socket.inet_ntoa(_interface_ioctl(s, name, SIOCGIFNETMASK)[20:24])
+    except IOError:
+        #No address assigned, or the interface went away
+        return None
+    finally:
+        if sock is None:
+            s.close()
+    return address, netmask, flags
+
+
+def subnet_hosts(subnet):
+    """
+    The host addresses in a subnet, without the network and broadcast addresses.
+    :param str subnet: Subnet in CIDR notation, 192.168.1.0/24.
+    :rtype: list
+    """
+    address, _, prefix = subnet.partition('/')
+    prefix = int(prefix or 32)
+    if not 0 <= prefix <= 32:
+        raise ValueError('Bad prefix length {}'.format(subnet))
+    mask = (0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF
+    first = _ip_to_int(address) & mask
+    last = first | (~mask & 0xFFFFFFFF)
+    if prefix < 31:
+        first, last = first + 1, last - 1
+    return [socket.inet_ntoa(struct.pack('!I', i)) for i in range(first, last + 1)]
+
+
+class ProbeMethod(object):
+    """
+    TCP - Connects to the port, an accepted or refused connection both mean the host is up.
+    UDP - Sends an empty datagram to the port, a reply or an ICMP port unreachable both mean the host is up. Silence
+          can't be told apart from a firewall, so hosts that drop it are reported as down.
+    """
+    TCP = 1
+    UDP = 2
+
+
+class Prober(object):
+    """
+    Checks many hosts at once with non-blocking sockets on one poll loop, rather than a ping process per host. At most
+    concurrency probes are in flight at a time.
+    """
+
+    #Errors that show the host answered
+    ALIVE_ERRORS = (errno.ECONNREFUSED, errno.ECONNRESET)
+
+    def __init__(self, port, method=ProbeMethod.TCP, timeout=1.0, concurrency=256):
+        """
+        :param int port: Port to probe, usually the PartyBox control port.
+        :param int method: One of ProbeMethod.
+        :param float timeout: Seconds to wait for each host.
+        :param int concurrency: Most probes in flight at once, keeps within the file descriptor limit.
+        """
+        self.port = port
+        self.method = method
+        self.timeout = timeout
+        self.concurrency = concurrency
+
+    def _start(self, host):
+        if self.method == ProbeMethod.UDP:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(0)
+            #Connected so an ICMP error is reported on the socket
+            sock.connect((host, self.port))
+            sock.send(b'')
+            return sock, select.POLLIN
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        err = sock.connect_ex((host, self.port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise socket.error(err, os.strerror(err))
+        return sock, select.POLLOUT
+
+    def _alive(self, sock):
+        """
+        Whether a socket that poll reported on shows the host is up.
+        """
+        if self.method == ProbeMethod.UDP:
+            try:
+                sock.recv(1024)
+                return True
+            except socket.error as e:
+                return e.args[0] in self.ALIVE_ERRORS
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        return err == 0 or err in self.ALIVE_ERRORS
+
+    def probe(self, hosts):
+        """
+        Probes every host.
+        :param list hosts: Host addresses.
+        :return: Round trip time in seconds keyed by host, None for hosts that are down or didn't answer in time.
+        :rtype: dict
+        """
+        results = dict((host, None) for host in hosts)
+        pending = iter(results)
+        active = {}
+        poll = select.poll()
+        exhausted = False
+        while active or not exhausted:
+            while not exhausted and len(active) < self.concurrency:
+                host = next(pending, None)
+                if host is None:
+                    exhausted = True
+                    break
+                try:
+                    sock, events = self._start(host)
+                except socket.error:
+                    continue
+                active[sock.fileno()] = (sock, host, time.time())
+                poll.register(sock, events)
+            if not active:
+                break
+
+            now = time.time()
+            wait = max(min(started for sock, host, started in active.values()) + self.timeout - now, 0)
+            for fd, event in poll.poll(wait * 1000):
+                sock, host, started = active.pop(fd)
+                poll.unregister(fd)
+                if self._alive(sock):
+                    results[host] = time.time() - started
+                sock.close()
+
+            now = time.time()
+            for fd, (sock, host, started) in list(active.items()):
+                if now - started >= self.timeout:
+                    del active[fd]
+                    poll.unregister(fd)
+                    sock.close()
+        return results
+
 
 class ARPException(Exception):
     pass
@@ -13,38 +298,136 @@ class NetworkUtilsException(Exception):
 class NetworkUtils():
     """
     A collection of utility methods for general network tasks.
+
+    On Linux the ARP and routing tables are read straight from /proc and cached for a short time, so lookups don't
+    start a process each. Other platforms fall back to the arp, route and ping commands.
     """
 
+    ARP_PATH = '/proc/net/arp'
+    ROUTE_PATH = '/proc/net/route'
+    DEV_PATH = '/proc/net/dev'
+    #Seconds the ARP and routing tables are cached for
+    ARP_TTL = 2
+    ROUTE_TTL = 30
+    #Port ARP resolution is triggered with, the discard service, nothing needs to be listening
+    NUDGE_PORT = 9
+
+    _cache = TTLCache()
+
     @classmethod
-    def _get_mac_address(cls, host):
+    def _has_proc(cls):
+        return os.path.exists(cls.ARP_PATH)
+
+    @classmethod
+    def arp_table(cls, refresh=False):
         """
-        Searches the arp table for a hostname, returns the mac address.
-        :param str host: Host to search for.
-        :return: MAC address for host.
-        :rtype: str
+        The ARP table, cached for ARP_TTL seconds.
+        :param bool refresh: Read the table again rather than using the cache.
+        :return: MAC addresses keyed by IP address.
+        :rtype: dict
+        """
+        if refresh:
+            cls._cache.invalidate('arp')
+        if cls._has_proc():
+            return cls._cache.get('arp', cls.ARP_TTL, lambda: read_arp_table(cls.ARP_PATH))
+        return cls._cache.get('arp', cls.ARP_TTL, cls._arp_command)
+
+    @classmethod
+    def route_table(cls, refresh=False):
+        """
+        The routing table, cached for ROUTE_TTL seconds, see read_route_table.
+        :rtype: list
         """
-        cls.send_ping(host)
-        cmds = ['arp', '-n', host]
-        p = subprocess.Popen(cmds, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if refresh:
+            cls._cache.invalidate('route')
+        return cls._cache.get('route', cls.ROUTE_TTL, lambda: read_route_table(cls.ROUTE_PATH))
+
+    @classmethod
+    def _arp_command(cls):
+        """
+        Reads the ARP table with the arp command, for platforms without /proc.
+        """
+        p = subprocess.Popen(['arp', '-an'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         result = p.communicate()
-        if result[1]:
-            raise HostResolutionException(result[1])
-        if 'no entry' in result[0]:
-            raise ARPException('{} not in ARP table'.format(host))
+        if p.returncode:
+            raise NetworkUtilsException(result[1])
+        table = {}
+        output = result[0].decode('UTF-8', 'replace')
+        for match in re.finditer(r"\(([\d.]+)\) at (([a-f\d]{1,2}:){5}[a-f\d]{1,2})", output):
+            table[match.group(1)] = match.group(2)
+        return table
 
-        mac = re.search(r"(([a-f\d]{1,2}\:){5}[a-f\d]{1,2})", result[0]).groups()[0]
-        return mac
+    @classmethod
+    def _resolve(cls, host):
+        try:
+            return socket.gethostbyname(host)
+        except socket.error as e:
+            raise HostResolutionException('Could not resolve {0}: {1}'.format(host, e))
 
     @classmethod
-    def get_mac_addr(cls, host):
+    def _nudge(cls, addresses):
+        """
+        Sends an empty datagram to each address so the kernel resolves it with ARP, much cheaper than a ping.
+        """
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for address in addresses:
+                try:
+                    s.sendto(b'', (address, cls.NUDGE_PORT))
+                except socket.error:
+                    pass
+        finally:
+            s.close()
+
+    @classmethod
+    def get_mac_addr(cls, host, timeout=1.0):
         """
         Returns the mac address for a host on the same subnet.
         :param str host: Host to retrieve mac address.
+        :param float timeout: Seconds to wait for the host to be resolved if it isn't in the ARP table.
+        """
+        mac = cls.get_mac_addrs([host], timeout)[host]
+        if mac is None:
+            raise ARPException('{} not in ARP table'.format(host))
+        return mac
+
+    @classmethod
+    def get_mac_addrs(cls, hosts, timeout=1.0):
+        """
+        Returns the mac addresses of many hosts with one read of the ARP table. Hosts that aren't in the table are
+        all nudged at once and the table read again until they appear or timeout.
+        :param list hosts: Hosts to look up.
+        :param float timeout: Seconds to wait for missing hosts.
+        :return: MAC addresses keyed by host, None for hosts that couldn't be resolved.
+        :rtype: dict
+        """
+        addresses = dict((host, cls._resolve(host)) for host in hosts)
+        table = cls.arp_table()
+        missing = set(a for a in addresses.values() if a not in table)
+        if missing:
+            cls._nudge(missing)
+            end = time.time() + timeout
+            delay = 0.005
+            while missing and time.time() < end:
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+                table = cls.arp_table(refresh=True)
+                missing = set(a for a in missing if a not in table)
+        return dict((host, table.get(address)) for host, address in addresses.items())
+
+    @classmethod
+    def route_for(cls, host):
+        """
+        The interface the kernel routes a host or multicast group through, Linux only.
+        :param str host: Host or group.
+        :return: The interface name, None if no route matches.
+        :rtype: str
         """
-        #Ping the host so it appears in arp table.
-        cls.send_ping(host)
-        #Get mac from arp table.
-        return cls._get_mac_address(host)
+        address = _ip_to_int(cls._resolve(host))
+        for interface, destination, mask, gateway, metric in cls.route_table():
+            if address & mask == destination:
+                return interface
+        return None
 
     @classmethod
     def active_device(cls):
@@ -53,7 +436,9 @@ class NetworkUtils():
         :returns: The network interface name
         :rtype: str
         """
-        cmd = ['route', 'get', '224.0.0.1']
+        if os.path.exists(cls.ROUTE_PATH):
+            return cls.route_for(DISCOVERY_GROUP)
+        cmd = ['route', 'get', DISCOVERY_GROUP]
         p = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
         result = p.communicate()
         if result[1]:
@@ -75,4 +460,168 @@ class NetworkUtils():
         p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         result = p.communicate()
         if result[1]:
-            raise HostResolutionException(result[1])
\ No newline at end of file
+            raise HostResolutionException(result[1])
+
+    @staticmethod
+    def is_multicast(address):
+        """
+        True for an IPv4 multicast address.
+        :rtype: bool
+        """
+        try:
+            return 224 <= ord(socket.inet_aton(address)[0:1]) <= 239
+        except socket.error:
+            return False
+
+    @classmethod
+    def local_address(cls, remote):
+        """
+        The local address the kernel would use to reach a remote host, which picks the right interface on a multi-homed
+        host. Connecting a UDP socket sends nothing.
+        :param str remote: Host or multicast group.
+        :rtype: str
+        """
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect((remote, 9))
+            return s.getsockname()[0]
+        except socket.error:
+            return '0.0.0.0'
+        finally:
+            s.close()
+
+    @classmethod
+    def multicast_sender(cls, interface=None, ttl=1, loop=True):
+        """
+        A UDP socket for sending to multicast groups.
+        :param str interface: Address of the interface to send from, None lets the kernel choose.
+        :param int ttl: Hops packets can travel, 1 keeps them on the local network.
+        :param bool loop: Deliver packets to listeners on this host as well.
+        :rtype: socket.socket
+        """
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1 if loop else 0)
+        if interface:
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        return s
+
+    @classmethod
+    def multicast_receiver(cls, group, port, interface=None, ttl=1, loop=True, reuse_port=False):
+        """
+        A UDP socket bound to port and joined to a multicast group, it can also send to the group. Several sockets on
+        the host can share the port.
+        :param str group: Multicast group to join.
+        :param int port: Port to bind.
+        :param str interface: Address of the interface to join on, None lets the kernel choose.
+        :param bool reuse_port: Also set SO_REUSEPORT, needed to share a port with other daemons (mDNS).
+        :rtype: socket.socket
+        """
+        s = cls.multicast_sender(interface, ttl, loop)
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port and hasattr(socket, 'SO_REUSEPORT'):
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            s.bind(('', port))
+            if sys.platform.startswith('linux'):
+                s.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
+            cls.join_group(s, group, interface)
+        except socket.error:
+            s.close()
+            raise
+        return s
+
+    @classmethod
+    def join_group(cls, sock, group, interface=None):
+        """
+        Joins a multicast group, the kernel sends an IGMP report so switches start forwarding the group to this host.
+        :param str interface: Address of the interface to join on, None lets the kernel choose.
+        """
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, cls._mreq(group, interface))
+
+    @classmethod
+    def leave_group(cls, sock, group, interface=None):
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, cls._mreq(group, interface))
+
+    @staticmethod
+    def _mreq(group, interface):
+        return socket.inet_aton(group) + socket.inet_aton(interface or '0.0.0.0')
+
+    @classmethod
+    def interfaces(cls):
+        """
+        The network interfaces with an IPv4 address. Linux only.
+        :return: Address, netmask and flags keyed by interface name.
+        :rtype: dict
+        """
+        interfaces = {}
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for name in read_interface_names(cls.DEV_PATH):
+                info = interface_info(name, s)
+                if info:
+                    interfaces[name] = info
+        finally:
+            s.close()
+        return interfaces
+
+    @classmethod
+    def interface_addresses(cls):
+        """
+        Addresses of the interfaces that are up and can multicast, loopback excluded. Without /proc the address of
+        the interface the kernel would pick is returned.
+        :rtype: list
+        """
+        if not os.path.exists(cls.DEV_PATH):
+            address = cls.local_address(DISCOVERY_GROUP)
+            return [] if address == '0.0.0.0' else [address]
+        addresses = []
+        for name, (address, netmask, flags) in sorted(cls.interfaces().items()):
+            if flags & IFF_UP and flags & IFF_MULTICAST and not flags & IFF_LOOPBACK:
+                addresses.append(address)
+        return addresses
+
+    @classmethod
+    def local_subnets(cls):
+        """
+        Subnets of the directly connected networks, from the routing table. Linux only.
+        :return: Subnets in CIDR notation.
+        :rtype: list
+        """
+        subnets = []
+        for interface, destination, mask, gateway, metric in cls.route_table():
+            address = socket.inet_ntoa(struct.pack('!I', destination))
+            if gateway == 0 and mask and not cls.is_multicast(address):
+                subnet = '{0}/{1}'.format(address, bin(mask).count('1'))
+                if subnet not in subnets:
+                    subnets.append(subnet)
+        return subnets
+
+    @classmethod
+    def probe_hosts(cls, hosts, port, method=ProbeMethod.TCP, timeout=1.0, concurrency=256):
+        """
+        Checks which hosts are reachable, all at once, see Prober.
+        :return: Round trip time in seconds keyed by host, None for hosts that didn't answer.
+        :rtype: dict
+        """
+        return Prober(port, method, timeout, concurrency).probe(hosts)
+
+    @classmethod
+    def probe_subnet(cls, port, subnet=None, method=ProbeMethod.TCP, timeout=1.0, concurrency=256, min_prefix=22):
+        """
+        Probes every host of a subnet, or of every local subnet.
+        :param str subnet: Subnet in CIDR notation, None for the local subnets.
+        :param int min_prefix: Subnets larger than this prefix length are skipped, a /16 or /8 (docker bridges,
+        link-local, corporate networks) would be tens of thousands of hosts or more.
+        :return: Round trip time in seconds of the hosts that answered.
+        :rtype: dict
+        """
+        hosts = []
+        for network in ([subnet] if subnet else cls.local_subnets()):
+            if int(network.partition('/')[2] or 32) < min_prefix:
+                log = logging.getLogger('NetworkUtils')
+                log.warning('Not probing {0}, larger than /{1}'.format(network, min_prefix))
+                continue
+            hosts.extend(subnet_hosts(network))
+        results = cls.probe_hosts(hosts, port, method, timeout, concurrency)
+        return dict((host, rtt) for host, rtt in results.items() if rtt is not None)
@@ -0,0 +1,238 @@
+import collections
+import threading
+import time
+
+import protocol
+
+
+class OverflowPolicy(object):
+    """
+    What an Outbox does once a client falls behind and its queue reaches the high water mark.
+
+    DROP_OLDEST - The oldest queued frame is dropped to make room.
+    COALESCE - A queued frame of the same message type is replaced by the new one, if there isn't one the oldest frame
+               is dropped.
+    DISCONNECT - Frames are kept (up to a hard limit) and the client is disconnected once it has been over the high
+                 water mark for longer than disconnect_after seconds.
+    """
+    DROP_OLDEST = 1
+    COALESCE = 2
+    DISCONNECT = 3
+
+
+class Outbox(object):
+    """
+    A bounded, thread safe queue of encoded frames waiting to be sent to one client. Stops a client that has gone away
+    without closing its socket from growing the servers memory without limit.
+
+    Frames of a keyed message type (volume, position) take one place in the queue, a newer frame of the same type
+    replaces the queued one so a slow client skips the intermediate values. Only frames queued since the last unkeyed
+    frame are replaced, so a value never jumps ahead of a frame that was queued after it, such as a RAMP or
+    MEDIA_CHANGED.
+    """
+
+    def __init__(self, high_water=256, policy=OverflowPolicy.DROP_OLDEST, disconnect_after=5.0, keyed_types=()):
+        """
+        :param int high_water: Number of queued frames at which the overflow policy applies.
+        :param int policy: One of OverflowPolicy.
+        :param float disconnect_after: Seconds a client can stay over the high water mark with the DISCONNECT policy.
+        :param keyed_types: Message types where only the latest queued frame is kept.
+        """
+        self.high_water = high_water
+        self.policy = policy
+        self.disconnect_after = disconnect_after
+        self.keyed_types = frozenset(keyed_types)
+        #Hard limit so a client waiting to be disconnected is still bounded.
+        self.maxlen = high_water * 4
+        self.dropped = 0
+        self.coalesced = 0
+        self._over_since = None
+        self._closed = False
+        #Keyed frames are queued in a one item list, _keyed holds the lists that can still be replaced by type.
+        self._frames = collections.deque()
+        self._keyed = {}
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame):
+        """
+        Queues a frame, applying the overflow policy if the client has fallen behind.
+        :param bytes frame: An encoded frame.
+        :return: False if the client should be disconnected.
+        :rtype: bool
+        """
+        with self._cond:
+            if self._closed:
+                return True
+            msg_type = protocol.frame_type(frame)
+            if msg_type in self._keyed:
+                self._keyed[msg_type][0] = frame
+                self.coalesced += 1
+                return not self.expired
+            if len(self._frames) >= self.high_water:
+                if self._over_since is None:
+                    self._over_since = time.time()
+                if not self._overflow(frame):
+                    return True
+            if msg_type in self.keyed_types:
+                self._keyed[msg_type] = [frame]
+                self._frames.append(self._keyed[msg_type])
+            else:
+                #Later keyed frames are queued behind this one
+                self._keyed.clear()
+                self._frames.append(frame)
+            self._cond.notify()
+            return not self.expired
+
+    def _overflow(self, frame):
+        """
+        Makes room for a frame when over the high water mark.
+        :return: False if the frame has already been dealt with.
+        """
+        if self.policy == OverflowPolicy.COALESCE:
+            msg_type = protocol.frame_type(frame)
+            for i in range(len(self._frames) - 1, -1, -1):
+                entry = self._frames[i]
+                if not isinstance(entry, list) and protocol.frame_type(entry) == msg_type:
+                    self._frames[i] = frame
+                    self.coalesced += 1
+                    return False
+        elif self.policy == OverflowPolicy.DISCONNECT and len(self._frames) < self.maxlen:
+            return True
+        self._take()
+        self.dropped += 1
+        return True
+
+    def _take(self):
+        """
+        Removes the oldest frame, resolving a keyed entry to its latest frame.
+        """
+        entry = self._frames.popleft()
+        if isinstance(entry, list):
+            msg_type = protocol.frame_type(entry[0])
+            if self._keyed.get(msg_type) is entry:
+                del self._keyed[msg_type]
+            return entry[0]
+        return entry
+
+    def pop(self, limit=protocol.IOV_MAX, block=False, timeout=None):
+        """
+        Removes and returns up to limit frames, oldest first.
+        :param int limit: Most frames to return.
+        :param bool block: Wait for at least one frame or the outbox to be closed.
+        :param float timeout: Longest time to wait when blocking, None waits forever.
+        :rtype: list
+        """
+        with self._cond:
+            if block:
+                end = None if timeout is None else time.time() + timeout
+                while not self._frames and not self._closed:
+                    remaining = None if end is None else end - time.time()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            frames = []
+            while self._frames and len(frames) < limit:
+                frames.append(self._take())
+            if len(self._frames) < self.high_water:
+                self._over_since = None
+            return frames
+
+    def close(self):
+        """
+        Discards queued frames and wakes anything blocked in pop.
+        """
+        with self._cond:
+            self._closed = True
+            self._frames.clear()
+            self._keyed.clear()
+            self._cond.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def expired(self):
+        """
+        True once a client using the DISCONNECT policy has been over the high water mark for too long.
+        """
+        return (self.policy == OverflowPolicy.DISCONNECT and self._over_since is not None and
+                time.time() - self._over_since >= self.disconnect_after)
+
+    def stats(self):
+        """
+        Queue depth and drop counts for monitoring.
+        :rtype: dict
+        """
+        return {
+            'depth': len(self._frames),
+            'high_water': self.high_water,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'over_since': self._over_since,
+        }
+
+
+class Coalescer(object):
+    """
+    Limits broadcasts of keyed message types to one per window. The first message for a key goes straight out,
+    messages arriving within the window replace each other and only the latest is sent when the window closes. Keeps
+    control traffic bounded however fast values like the volume change.
+    """
+
+    def __init__(self, send, scheduler, window=0.1):
+        """
+        :param callable send: Called with each frame to broadcast.
+        :param scheduler.Scheduler scheduler: Runs the end of window flushes.
+        :param float window: Shortest time in seconds between broadcasts of the same key.
+        """
+        self.window = window
+        self.coalesced = 0
+        self._send = send
+        self._scheduler = scheduler
+        self._last_sent = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def put(self, key, frame):
+        """
+        Broadcasts frame now, or at the end of the current window for key.
+        """
+        with self._lock:
+            if key in self._pending:
+                self._pending[key] = frame
+                self.coalesced += 1
+                return
+            now = time.time()
+            last = self._last_sent.get(key)
+            if last is not None and now - last < self.window:
+                self._pending[key] = frame
+                self._scheduler.call_at(last + self.window, self._flush, key)
+                return
+            self._last_sent[key] = now
+        self._send(frame)
+
+    def flush(self):
+        """
+        Broadcasts every pending frame now. Called before a frame that must not overtake them, a deferred VOLUME sent
+        after a RAMP would cancel the ramp.
+        """
+        with self._lock:
+            pending = list(self._pending.values())
+            now = time.time()
+            for key in self._pending:
+                self._last_sent[key] = now
+            self._pending.clear()
+        for frame in pending:
+            self._send(frame)
+
+    def _flush(self, key):
+        with self._lock:
+            frame = self._pending.pop(key, None)
+            if frame is None:
+                return
+            self._last_sent[key] = time.time()
+        self._send(frame)
@@ -0,0 +1,189 @@
+"""
+Wire protocol for control messages pushed between the server and clients.
+
+Every message is sent as a frame, an 8 byte header followed by the payload:
+
+    magic 'PB' (2 bytes) | version (1 byte) | type (1 byte) | payload length (4 bytes, network order)
+
+Frames let a reader find message boundaries regardless of how TCP splits or joins the stream.
+"""
+import struct
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+VERSION = 1
+MAGIC = b'PB'
+HEADER = struct.Struct('!2sBBI')
+MAX_PAYLOAD = 1024 * 1024
+#Most buffers handed to a single vectored write
+IOV_MAX = 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class MessageType(object):
+    CONNECTED = 1
+    MEDIA_CHANGED = 2
+    SOUT_UPDATED = 3
+    VOLUME = 4
+    RESTART = 5
+    PING = 6
+    PONG = 7
+    POSITION = 8
+    RAMP = 9
+    #Versioned playback state, see state.py
+    SNAPSHOT = 10
+    DELTA = 11
+    RESYNC = 12
+    RESUME = 13
+
+
+def encode(msg_type, payload=b''):
+    """
+    Encodes a single frame.
+    :param int msg_type: One of MessageType.
+    :param payload: Payload bytes, anything else is converted to text and UTF-8 encoded.
+    :rtype: bytes
+    """
+    if not isinstance(payload, bytes):
+        payload = text_type(payload).encode('UTF-8')
+    if len(payload) > MAX_PAYLOAD:
+        raise ProtocolError('Payload too large ({} bytes)'.format(len(payload)))
+    return HEADER.pack(MAGIC, VERSION, msg_type, len(payload)) + payload
+
+
+def frame_type(frame):
+    """
+    Returns the message type of an encoded frame.
+    :rtype: int
+    """
+    return HEADER.unpack_from(frame)[2]
+
+
+def sendv(sock, buffers):
+    """
+    Writes a list of buffers with a single vectored write (sendmsg). Where sendmsg isn't available (Python 2) the
+    buffers are joined and written with one send instead.
+    :return: Number of bytes sent.
+    :rtype: int
+    """
+    if hasattr(sock, 'sendmsg'):
+        return sock.sendmsg(buffers[:IOV_MAX])
+    if len(buffers) == 1:
+        return sock.send(buffers[0])
+    return sock.send(b''.join(b.tobytes() if isinstance(b, memoryview) else b for b in buffers))
+
+
+def consume(buffers, sent):
+    """
+    Drops sent bytes from the front of a list of buffers, a partially sent buffer is replaced by a memoryview of the
+    remainder rather than a copy.
+    :return: The buffers still to send.
+    :rtype: list
+    """
+    i = 0
+    while i < len(buffers) and sent >= len(buffers[i]):
+        sent -= len(buffers[i])
+        i += 1
+    buffers = buffers[i:]
+    if sent:
+        buffers[0] = memoryview(buffers[0])[sent:]
+    return buffers
+
+
+def sendallv(sock, buffers):
+    """
+    Blocking vectored write of every buffer.
+    """
+    while buffers:
+        buffers = consume(buffers, sendv(sock, buffers))
+
+
+class FrameDecoder(object):
+    """
+    Incrementally decodes a stream of frames. Data is received straight into a reusable buffer and payloads are
+    returned as memoryview slices of it, so no copies are made. A payload is only valid until the next call to
+    recv_into or feed, call tobytes() on it to keep it.
+    """
+
+    def __init__(self, size=4096, max_payload=MAX_PAYLOAD):
+        """
+        :param int size: Initial size of the receive buffer, it grows to fit larger frames.
+        :param int max_payload: Largest payload accepted before raising a ProtocolError.
+        """
+        self.max_payload = max_payload
+        self._read_size = size
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._needed = 0
+
+    def _reserve(self, size):
+        """
+        Makes sure there are at least size free bytes at the end of the buffer. Unread data is moved to the front
+        and the buffer only grows if it still won't fit.
+        """
+        if len(self._buffer) - self._end >= size:
+            return
+        unread = self._end - self._start
+        if self._start:
+            self._buffer[:unread] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, unread
+        if len(self._buffer) - self._end < size:
+            buf = bytearray(max(len(self._buffer) * 2, unread + size))
+            buf[:unread] = self._view[:unread]
+            self._buffer = buf
+            self._view = memoryview(buf)
+
+    def recv_into(self, sock):
+        """
+        Receives from a socket directly into the buffer.
+        :return: Number of bytes received, 0 if the connection was closed.
+        :rtype: int
+        """
+        self._reserve(max(self._needed, self._read_size))
+        n = sock.recv_into(self._view[self._end:])
+        self._end += n
+        return n
+
+    def feed(self, data):
+        """
+        Copies data into the buffer, for when the data didn't come from a socket.
+        """
+        self._reserve(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def frames(self):
+        """
+        Yields (type, payload) for every complete frame received so far.
+        """
+        while True:
+            available = self._end - self._start
+            if available < HEADER.size:
+                self._needed = HEADER.size - available
+                break
+            magic, version, msg_type, length = HEADER.unpack_from(self._buffer, self._start)
+            if magic != MAGIC:
+                raise ProtocolError('Bad frame magic {!r}'.format(magic))
+            if version != VERSION:
+                raise ProtocolError('Unsupported protocol version {}'.format(version))
+            if length > self.max_payload:
+                raise ProtocolError('Payload too large ({} bytes)'.format(length))
+            if available < HEADER.size + length:
+                self._needed = HEADER.size + length - available
+                break
+            start = self._start + HEADER.size
+            self._start = start + length
+            yield msg_type, self._view[start:self._start]
+
+        if self._start == self._end:
+            #Everything has been read, start filling from the front again.
+            self._start = self._end = 0
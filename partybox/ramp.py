@@ -0,0 +1,175 @@
+import math
+import time
+import struct
+import threading
+
+
+class Curve(object):
+    LINEAR = 1
+    LOG = 2
+    S_CURVE = 3
+
+
+def linear(x):
+    return x
+
+
+def logarithmic(x):
+    """
+    Changes quickly at first then levels off, sounds closer to an even fade than linear.
+    """
+    return math.log10(1 + 9 * x)
+
+
+def s_curve(x):
+    """
+    Eases in and out of the ramp.
+    """
+    return (1 - math.cos(math.pi * x)) / 2
+
+
+CURVES = {
+    Curve.LINEAR: linear,
+    Curve.LOG: logarithmic,
+    Curve.S_CURVE: s_curve,
+}
+
+#RAMP payload - curve, start value, end value, duration (ms), delay before starting (ms)
+RAMP = struct.Struct('!BBBII')
+
+
+def _clamp(value):
+    return min(max(int(value), 0), 255)
+
+
+class Ramp(object):
+    """
+    A value moving from start to end over duration seconds along a curve, starting at time t0.
+    """
+
+    def __init__(self, start, end, duration, curve=Curve.LINEAR, t0=None):
+        """
+        :param int start: Starting value, 0 - 255.
+        :param int end: Final value, 0 - 255.
+        :param float duration: Length of the ramp in seconds.
+        :param int curve: One of Curve.
+        :param float t0: Start time, defaults to now.
+        """
+        if curve not in CURVES:
+            raise ValueError('Unknown curve {}'.format(curve))
+        self.start = start
+        self.end = end
+        self.duration = duration
+        self.curve = curve
+        self.t0 = time.time() if t0 is None else t0
+
+    def value_at(self, now):
+        """
+        The value of the ramp at a point in time.
+        :rtype: int
+        """
+        if self.duration <= 0:
+            x = 1.0
+        else:
+            x = min(max((now - self.t0) / float(self.duration), 0.0), 1.0)
+        return int(round(self.start + (self.end - self.start) * CURVES[self.curve](x)))
+
+    def done(self, now):
+        return now >= self.t0 + self.duration
+
+    def encode(self, now=None):
+        """
+        Encodes the ramp for a RAMP message. The start time is sent as a delay from now so clients don't need a
+        synchronised clock. Values are clamped to 0 - 255, VLC reports -1 without an audio output.
+        :rtype: bytes
+        """
+        now = time.time() if now is None else now
+        delay = max(self.t0 - now, 0)
+        return RAMP.pack(self.curve, _clamp(self.start), _clamp(self.end), int(self.duration * 1000),
+                         int(delay * 1000))
+
+    @classmethod
+    def decode(cls, payload, now=None):
+        """
+        Decodes a RAMP message payload, the start time is relative to now.
+        :rtype: Ramp
+        """
+        now = time.time() if now is None else now
+        curve, start, end, duration, delay = RAMP.unpack_from(payload)
+        return cls(start, end, duration / 1000.0, curve, now + delay / 1000.0)
+
+    def __repr__(self):
+        return 'Ramp({0} -> {1} over {2}s)'.format(self.start, self.end, self.duration)
+
+
+class RampScheduler(object):
+    """
+    Runs a ramp in steps on a Scheduler, calling a setter with each new value. Only one ramp runs at a time,
+    starting another or calling cancel() stops the current one without calling its on_complete.
+    """
+
+    def __init__(self, scheduler, setter, step=0.02):
+        """
+        :param scheduler.Scheduler scheduler: Scheduler to run steps on.
+        :param callable setter: Called with each new value.
+        :param float step: Seconds between steps.
+        """
+        self.step = step
+        self._scheduler = scheduler
+        self._setter = setter
+        self._ramp = None
+        self._timer = None
+        self._last = None
+        self._on_complete = None
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        """
+        The running ramp, None if idle.
+        """
+        return self._ramp
+
+    def start(self, ramp, on_complete=None):
+        """
+        Starts a ramp, replacing any that is running.
+        :param Ramp ramp: The ramp to run.
+        :param callable on_complete: Called once the ramp reaches its end value.
+        """
+        with self._lock:
+            self._cancel()
+            self._ramp = ramp
+            self._last = None
+            self._on_complete = on_complete
+            self._timer = self._scheduler.call_at(ramp.t0, self._step, ramp)
+
+    def cancel(self):
+        """
+        Stops the running ramp where it is.
+        """
+        with self._lock:
+            self._cancel()
+
+    def _cancel(self):
+        if self._timer:
+            self._timer.cancel()
+        self._ramp = self._timer = self._on_complete = None
+
+    def _step(self, ramp):
+        now = time.time()
+        with self._lock:
+            if ramp is not self._ramp:
+                return
+            value = ramp.value_at(now)
+            changed = value != self._last
+            self._last = value
+            on_complete = None
+            if ramp.done(now):
+                on_complete = self._on_complete
+                self._ramp = self._timer = self._on_complete = None
+            else:
+                self._timer = self._scheduler.call_later(self.step, self._step, ramp)
+        if changed:
+            self._setter(value)
+        if on_complete:
+            on_complete()
@@ -0,0 +1,282 @@
+"""
+Fans an RTP stream out to many destinations. VLC streams once to the relay and the relay copies each packet to every
+client and the multicast group, so clients joining or leaving only change the relays destination table rather than
+the VLC output.
+
+On Linux packets are moved in batches with recvmmsg and sendmmsg, one system call each way per batch, into buffers
+allocated once when the relay is created. Elsewhere it falls back to recv_into and sendto.
+"""
+import errno
+import select
+import socket
+import ctypes
+import ctypes.util
+import logging
+import threading
+
+from network import NetworkUtils
+
+MSG_DONTWAIT = 0x40
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [
+        ('sin_family', ctypes.c_ushort),
+        ('sin_port', ctypes.c_ubyte * 2),
+        ('sin_addr', ctypes.c_ubyte * 4),
+        ('sin_zero', ctypes.c_ubyte * 8),
+    ]
+
+
+def _load_mmsg():
+    """
+    Looks up recvmmsg and sendmmsg in libc.
+    :return: The libc functions, None where they aren't available.
+    :rtype: tuple
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        recvmmsg, sendmmsg = libc.recvmmsg, libc.sendmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return recvmmsg, sendmmsg
+
+
+_mmsg = _load_mmsg()
+
+
+def _sockaddr(address):
+    host, port = address
+    addr = sockaddr_in()
+    addr.sin_family = socket.AF_INET
+    addr.sin_port[:] = [port >> 8, port & 0xFF]
+    addr.sin_addr[:] = bytearray(socket.inet_aton(socket.gethostbyname(host)))
+    return addr
+
+
+class RTPRelay(object):
+    """
+    Receives UDP packets on one port and sends a copy of each to every destination. Destinations can be unicast or
+    multicast and are added and removed while the relay runs.
+    """
+
+    def __init__(self, address=('127.0.0.1', 0), batch=64, packet_size=2048, ttl=1, interface=None, use_mmsg=True):
+        """
+        :param tuple address: Address to receive the stream on, port 0 picks a free port.
+        :param int batch: Most packets moved per system call.
+        :param int packet_size: Size of each receive buffer, larger packets are truncated. RTP over UDP from VLC
+        fits in 1500 bytes.
+        :param int ttl: Multicast TTL of the copies.
+        :param str interface: Address of the interface to send multicast from, None lets the kernel choose.
+        :param bool use_mmsg: Use recvmmsg and sendmmsg where available.
+        """
+        self.log = logging.getLogger('RTPRelay')
+        self.batch = batch
+        self.packet_size = packet_size
+        self.packets = 0
+        self.bytes = 0
+        self.is_running = False
+        self._destinations = {}
+        self._lock = threading.Lock()
+        self._dirty = True
+        self._thread = None
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, batch * packet_size * 4)
+        self.socket.bind(address)
+        self.address = self.socket.getsockname()
+        self._sender = NetworkUtils.multicast_sender(interface, ttl, loop=True)
+
+        self._mmsg = _mmsg if use_mmsg else None
+        if self._mmsg:
+            self._setup_mmsg()
+        else:
+            self._buffers = [bytearray(packet_size) for i in range(batch)]
+            self._lengths = [0] * batch
+
+    def _setup_mmsg(self):
+        """
+        Allocates the receive buffers and the recvmmsg vector, done once.
+        """
+        self._buffers = [ctypes.create_string_buffer(self.packet_size) for i in range(self.batch)]
+        self._rx_iov = (iovec * self.batch)()
+        self._rx = (mmsghdr * self.batch)()
+        #Send side iovecs point at the same buffers, their lengths are set to each packets length as it arrives
+        self._tx_iov = (iovec * self.batch)()
+        for i, buf in enumerate(self._buffers):
+            self._rx_iov[i].iov_base = self._tx_iov[i].iov_base = ctypes.addressof(buf)
+            self._rx_iov[i].iov_len = self.packet_size
+            self._rx[i].msg_hdr.msg_iov = ctypes.pointer(self._rx_iov[i])
+            self._rx[i].msg_hdr.msg_iovlen = 1
+        self._tx = None
+        self._addrs = None
+
+    @property
+    def destinations(self):
+        """
+        :rtype: list
+        """
+        with self._lock:
+            return list(self._destinations)
+
+    def add(self, address):
+        """
+        Starts sending copies to an address.
+        :param tuple address: Host and port.
+        """
+        address = tuple(address)
+        with self._lock:
+            if address not in self._destinations:
+                self._destinations[address] = _sockaddr(address)
+                self._dirty = True
+
+    def remove(self, address):
+        """
+        Stops sending copies to an address.
+        """
+        with self._lock:
+            if self._destinations.pop(tuple(address), None) is not None:
+                self._dirty = True
+
+    def set_destinations(self, addresses):
+        """
+        Replaces the destinations, only the difference is changed.
+        :param list addresses: Host and port of every destination.
+        """
+        addresses = set(tuple(a) for a in addresses)
+        for address in set(self.destinations) - addresses:
+            self.remove(address)
+        for address in addresses:
+            self.add(address)
+
+    def _build_tx(self):
+        """
+        Builds the sendmmsg vector after the destinations change, an entry for every destination of every packet
+        slot, in packet order so a batch of n packets is the first n * destinations entries.
+        """
+        with self._lock:
+            self._dirty = False
+            self._addrs = list(self._destinations.values())
+        count = len(self._addrs)
+        self._tx = (mmsghdr * (self.batch * count))()
+        for i in range(self.batch):
+            for d, addr in enumerate(self._addrs):
+                hdr = self._tx[i * count + d].msg_hdr
+                hdr.msg_name = ctypes.addressof(addr)
+                hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+                hdr.msg_iov = ctypes.pointer(self._tx_iov[i])
+                hdr.msg_iovlen = 1
+
+    def _relay_mmsg(self):
+        """
+        Moves one batch with recvmmsg and sendmmsg.
+        """
+        recvmmsg, sendmmsg = self._mmsg
+        n = recvmmsg(self.socket.fileno(), self._rx, self.batch, MSG_DONTWAIT, None)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise socket.error(err, 'recvmmsg failed')
+        for i in range(n):
+            self._tx_iov[i].iov_len = self._rx[i].msg_len
+            self.bytes += self._rx[i].msg_len
+        self.packets += n
+
+        if self._dirty:
+            self._build_tx()
+        total = n * len(self._addrs)
+        sent = 0
+        size = ctypes.sizeof(mmsghdr)
+        base = ctypes.addressof(self._tx) if total else 0
+        while sent < total:
+            r = sendmmsg(self._sender.fileno(), base + sent * size, total - sent, 0)
+            if r < 0:
+                err = ctypes.get_errno()
+                if err != errno.EINTR:
+                    #Skip the destination that failed, the rest still get the packet
+                    self.log.debug('Relay send failed: {}'.format(errno.errorcode.get(err, err)))
+                    sent += 1
+            else:
+                sent += r
+
+    def _relay_fallback(self):
+        """
+        Moves up to one batch with recv_into and sendto.
+        """
+        n = 0
+        while n < self.batch:
+            try:
+                self._lengths[n] = self.socket.recv_into(self._buffers[n], 0, MSG_DONTWAIT)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            n += 1
+        destinations = self.destinations
+        for i in range(n):
+            packet = memoryview(self._buffers[i])[:self._lengths[i]]
+            self.bytes += self._lengths[i]
+            for address in destinations:
+                try:
+                    self._sender.sendto(packet, address)
+                except socket.error as e:
+                    self.log.debug('Relay send to {0} failed: {1}'.format(address, e))
+        self.packets += n
+
+    def _run(self):
+        relay = self._relay_mmsg if self._mmsg else self._relay_fallback
+        while self.is_running:
+            if not select.select([self.socket], [], [], 0.5)[0]:
+                continue
+            try:
+                relay()
+            except socket.error as e:
+                if self.is_running:
+                    self.log.error('Relay stopped: {}'.format(e))
+                break
+
+    def start(self):
+        """
+        Starts relaying on a daemon thread.
+        """
+        if not self.is_running:
+            self.is_running = True
+            self._thread = threading.Thread(target=self._run, name='RTPRelay')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stops relaying and closes the sockets.
+        """
+        self.is_running = False
+        if self._thread:
+            self._thread.join(1)
+            self._thread = None
+        self.socket.close()
+        self._sender.close()
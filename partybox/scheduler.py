@@ -0,0 +1,240 @@
+import math
+import time
+import logging
+import threading
+
+
+class Timer(object):
+    """
+    A callback scheduled on a TimingWheel.
+    """
+
+    def __init__(self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Stops the timer firing, it is dropped from the wheel when its slot is next visited.
+        """
+        self.cancelled = True
+
+
+class PeriodicTimer(object):
+    """
+    A callback repeated at a fixed interval by a Scheduler.
+    """
+
+    def __init__(self, interval, callback, args, first):
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.next_run = first
+        self.cancelled = False
+        self._timer = None
+
+    def cancel(self):
+        self.cancelled = True
+        if self._timer:
+            self._timer.cancel()
+
+
+class TimingWheel(object):
+    """
+    A hashed timing wheel. Timers are kept in a ring of slots by deadline, so scheduling and cancelling are O(1) and
+    each tick only visits one slot however many timers are pending. Deadlines are absolute times in seconds and are
+    rounded up to the next tick. Not thread safe, see Scheduler.
+    """
+
+    def __init__(self, tick=0.01, slots=512, now=None):
+        """
+        :param float tick: Resolution of the wheel in seconds.
+        :param int slots: Number of slots, timers further away than one lap wait in their slot for later laps.
+        :param float now: Current time, defaults to time.time().
+        """
+        self.tick = tick
+        self._slots = [[] for i in range(slots)]
+        self._current = int((time.time() if now is None else now) / tick)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, deadline, callback, *args):
+        """
+        Schedules callback(*args) to fire at deadline.
+        :rtype: Timer
+        """
+        tick = max(int(math.ceil(deadline / self.tick)), self._current + 1)
+        timer = Timer(tick, callback, args)
+        self._slots[tick % len(self._slots)].append(timer)
+        self._count += 1
+        return timer
+
+    def advance(self, now):
+        """
+        Moves the wheel forward to now.
+        :return: Timers that are due, in deadline order.
+        :rtype: list
+        """
+        target = int(now / self.tick)
+        steps = target - self._current
+        if steps <= 0:
+            return []
+        if steps >= len(self._slots):
+            #More than a lap has passed so every slot needs checking.
+            slots = self._slots
+        else:
+            slots = [self._slots[tick % len(self._slots)] for tick in range(self._current + 1, target + 1)]
+        self._current = target
+
+        due = []
+        for slot in slots:
+            if not slot:
+                continue
+            keep = []
+            for timer in slot:
+                if timer.cancelled:
+                    self._count -= 1
+                elif timer.tick <= target:
+                    due.append(timer)
+                    self._count -= 1
+                else:
+                    keep.append(timer)
+            slot[:] = keep
+        due.sort(key=lambda timer: timer.tick)
+        return due
+
+    def next_timeout(self, now):
+        """
+        Seconds until the next slot holding a timer, None if the wheel is empty.
+        :rtype: float
+        """
+        if not self._count:
+            return None
+        for i in range(1, len(self._slots) + 1):
+            if self._slots[(self._current + i) % len(self._slots)]:
+                return max((self._current + i) * self.tick - now, 0)
+        return None
+
+
+class Scheduler(object):
+    """
+    Runs the timers of a single TimingWheel on one daemon thread, so any number of timers costs one thread. Timers
+    can be scheduled and cancelled from any thread. Callbacks run on the scheduler thread and should not block.
+    """
+
+    def __init__(self, tick=0.01, slots=512):
+        """
+        :param float tick: Resolution in seconds.
+        :param int slots: Size of the timing wheel.
+        """
+        self.log = logging.getLogger('Scheduler')
+        self._wheel = TimingWheel(tick, slots)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def call_at(self, deadline, callback, *args):
+        """
+        Calls callback(*args) at the absolute time deadline.
+        :rtype: Timer
+        """
+        with self._cond:
+            timer = self._wheel.schedule(deadline, callback, *args)
+            self._cond.notify()
+            return timer
+
+    def call_later(self, delay, callback, *args):
+        """
+        Calls callback(*args) after delay seconds.
+        :rtype: Timer
+        """
+        return self.call_at(time.time() + delay, callback, *args)
+
+    def call_every(self, interval, callback, *args, **kwargs):
+        """
+        Calls callback(*args) every interval seconds. Runs are scheduled from the first run time rather than from when
+        the previous run finished so the period doesn't drift, runs missed while the thread was busy are skipped.
+        :param float first: Time of the first run, defaults to one interval from now.
+        :rtype: PeriodicTimer
+        """
+        first = kwargs.get('first')
+        periodic = PeriodicTimer(interval, callback, args, time.time() + interval if first is None else first)
+        periodic._timer = self.call_at(periodic.next_run, self._run_periodic, periodic)
+        return periodic
+
+    def _run_periodic(self, periodic):
+        if periodic.cancelled:
+            return
+        try:
+            periodic.callback(*periodic.args)
+        finally:
+            now = time.time()
+            periodic.next_run += periodic.interval
+            if periodic.next_run <= now:
+                periodic.next_run += math.ceil((now - periodic.next_run) / periodic.interval) * periodic.interval
+                if periodic.next_run <= now:
+                    periodic.next_run += periodic.interval
+            if not periodic.cancelled:
+                periodic._timer = self.call_at(periodic.next_run, self._run_periodic, periodic)
+
+    def start(self):
+        """
+        Starts the scheduler thread.
+        """
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='Scheduler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stops the scheduler thread, pending timers are kept. Waits for the thread to finish unless called from it.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+            thread, self._thread = self._thread, None
+        if thread and thread is not threading.current_thread():
+            thread.join(1)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                now = time.time()
+                due = self._wheel.advance(now)
+                if not due:
+                    self._cond.wait(self._wheel.next_timeout(now))
+                    continue
+            for timer in due:
+                if timer.cancelled:
+                    continue
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    self.log.exception('Timer callback failed')
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_scheduler():
+    """
+    A process wide Scheduler for anything that isn't given one, started on first use.
+    :rtype: Scheduler
+    """
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Scheduler()
+            _default.start()
+        return _default
@@ -3,17 +3,48 @@ import threading
 import logging
 import time
 import json
+import select
+import asyncore
+import collections
+import errno
+import uuid
+import os
+import multiprocessing
 
 import vlc
 import media
-import decorators
+import protocol
+from protocol import MessageType
+from outbox import Outbox, OverflowPolicy, Coalescer
+from scheduler import Scheduler, default_scheduler
+from heartbeat import Heartbeat
+import events
+from ramp import Ramp, RampScheduler, Curve
+from mdns import DNSSDResponder
+from state import PlaybackState, ReplayBuffer, describe
+from relay import RTPRelay
+from engine import Engine, VLMBroadcast, Preroll
+from mixer import Mixer, MixerInput
+from transcode import TranscodeCache, Transcoder, PROFILE
+import announce
+import network
+from network import NetworkUtils
 
 try:
     import SocketServer as socketserver
-    import Queue as queue
 except ImportError:
     import socketserver
-    import queue
+
+
+def load_average():
+    """
+    One minute load average per CPU, None where it isn't available.
+    :rtype: float
+    """
+    try:
+        return round(os.getloadavg()[0] / multiprocessing.cpu_count(), 2)
+    except (OSError, AttributeError, NotImplementedError):
+        return None
 
 
 class UDPAnnounce(object):
@@ -22,62 +53,671 @@ class UDPAnnounce(object):
     be stopped and started by calling stop() and start() respectively. The address and port can be changed
     whilst the Announcer is running.
 
+    Packets are sent from a shared Scheduler so any number of announcers (per zone or interface) run on one thread.
+    The message is serialized once and only encoded again when it is replaced.
+
+    The cadence adapts, a burst of packets right after starting or a change of message lets clients find the server
+    quickly, then the gap doubles up to interval so a long running server barely loads the network. Probes sent to
+    the announce port are answered straight away with an extra announce. The probe socket is read on the servers
+    asyncore loop when given its map, otherwise it is drained from the scheduler, either way without a thread of its
+    own.
+
+    On a multi-homed host announces can go out of every interface, each through its own socket and carrying that
+    interfaces address as ADDRESS. Interfaces are scanned again every rescan_interval seconds so ones that come and go
+    (WiFi, VPNs) are picked up.
     """
-    def __init__(self, address, message, interval=1):
+
+    #Pass as interface to announce on every interface
+    ALL_INTERFACES = '*'
+
+    def __init__(self, address, message, interval=8, scheduler=None, min_interval=0.05, probe_address=None,
+                 encoder=None, interface=None, ttl=1, rescan_interval=10, socket_map=None):
         """
 
         :param tuple address: The host or multicast address to send packets to.
         :param dict msg: Message to broadcast.
-        :param int interval: The time interval in seconds between each packet.
+        :param int interval: The steady time interval in seconds between each packet.
+        :param scheduler.Scheduler scheduler: Scheduler to send from, defaults to the process wide scheduler.
+        :param float min_interval: The first gap of the fast start burst, also the shortest gap between probe replies.
+        :param tuple probe_address: Address to listen for probes on, defaults to the announce port. False disables
+        listening.
+        :param callable encoder: Encodes the message into a packet, defaults to JSON.
+        :param interface: Address of the interface to send multicast from, None lets the kernel choose. ALL_INTERFACES
+        sends from every interface, a callable returning interface addresses chooses them.
+        :param int ttl: Multicast TTL, 1 keeps announces on the local network.
+        :param float rescan_interval: Seconds between scans for interfaces when sending from more than one.
+        :param dict socket_map: asyncore map of the event loop to read probes on, None reads them every min_interval
+        from the scheduler.
         """
         self._timer = None
+        self._rescan_timer = None
         self.is_running = False
         self.log = logging.getLogger('UDPAnnounce')
         self.start_time = None
-        self._message = message
-        self._address = address
+        self.address = address
         self._interval = interval
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.min_interval = min_interval
+        self.rescan_interval = rescan_interval
+        self._gap = min_interval
+        self._deadline = None
+        self._last_probe_reply = 0
+        self._lock = threading.Lock()
+        self._scheduler = scheduler or default_scheduler()
+        self._ttl = ttl
+        if interface == self.ALL_INTERFACES:
+            interface = NetworkUtils.interface_addresses
+        self.interface = interface
+        #Sockets and encoded payloads keyed by interface address, None for the kernels choice.
+        self._sockets = {}
+        self._payloads = {}
+        self._probe_socket = None
+        self._probe_reader = None
+        self._socket_map = socket_map
+        if probe_address is None:
+            probe_address = address
+        self._probe_address = probe_address
+        self._encoder = encoder or (lambda message: json.dumps(message).encode('UTF-8'))
+        self._message = None
+        self._scan()
+        self.message = message
+
+    @property
+    def interfaces(self):
+        """
+        Addresses of the interfaces being announced on.
+        :rtype: list
+        """
+        return [a for a in self._sockets if a is not None]
+
+    def _scan(self):
+        """
+        Opens a socket for each new interface and closes those of interfaces that have gone.
+        :return: True if the interfaces changed.
+        :rtype: bool
+        """
+        if callable(self.interface):
+            try:
+                addresses = set(self.interface())
+            except (IOError, OSError, socket.error) as e:
+                self.log.warning('Could not list interfaces: {}'.format(e))
+                return False
+            if not addresses:
+                addresses = set([None])
+        else:
+            addresses = set([self.interface])
+        with self._lock:
+            current = set(self._sockets)
+            if addresses == current:
+                return False
+            for address in current - addresses:
+                self._sockets.pop(address).close()
+                self._payloads.pop(address, None)
+                self._leave(address)
+            for address in addresses - current:
+                try:
+                    sock = NetworkUtils.multicast_sender(address, self._ttl)
+                    if address:
+                        sock.bind((address, 0))
+                except socket.error as e:
+                    self.log.warning('Could not announce on {0}: {1}'.format(address, e))
+                    continue
+                self._sockets[address] = sock
+                if self._message is not None:
+                    self._payloads[address] = self._encode(self._message, address)
+                self._join(address)
+        self.log.info('Announcing on {}'.format(', '.join(str(a) for a in sorted(addresses, key=str))))
+        return True
+
+    def _rescan(self):
+        if self._scan():
+            self.reset()
+
+    def _encode(self, message, interface):
+        if interface is None:
+            return self._encoder(message)
+        return self._encoder(dict((k, dict(v, ADDRESS=interface)) for k, v in message.items()))
 
-    def _broadcast(self):
+    @property
+    def message(self):
         """
-        Sends the UDP packet to the specified port.
+        Message being broadcast, assign a new dict to change it. A change restarts the fast start burst.
         """
-        self.socket.sendto(json.dumps(self._message).encode('UTF-8'), self._address)
-        self.log.debug('Broadcast packet sent {}'.format(self._address))
+        return self._message
+
+    @message.setter
+    def message(self, message):
+        self.update(message)
+
+    def update(self, message, reset=True):
+        """
+        Changes the message being broadcast.
+        :param dict message: The new message.
+        :param bool reset: Restart the fast start burst if the message changed, pass False for minor changes that can
+        wait for the next packet.
+        """
+        if message != self._message:
+            with self._lock:
+                self._message = message
+                self._payloads = dict((a, self._encode(message, a)) for a in self._sockets)
+            if reset:
+                self.reset()
+
+    def _broadcast(self, message=None):
+        """
+        Sends the UDP packet to the specified port, from every interface.
+        :param dict message: A message to send once instead of the usual one.
+        """
+        with self._lock:
+            sockets = list(self._sockets.items())
+            payloads = self._payloads
+        for interface, sock in sockets:
+            payload = payloads.get(interface) if message is None else self._encode(message, interface)
+            try:
+                sock.sendto(payload, self.address)
+            except socket.error as e:
+                #An interface that has just gone down, the next scan drops it.
+                self.log.debug('Could not announce on {0}: {1}'.format(interface, e))
+        self.log.debug('Broadcast packet sent {}'.format(self.address))
 
     def _run(self):
         """
-        Called periodically by the timer.
+        Called by the scheduler, sends a packet and schedules the next with the gap doubled.
         """
-        self.is_running = False
-        self.start()
+        with self._lock:
+            if not self.is_running:
+                return
+            self._deadline += self._gap
+            self._gap = min(self._gap * 2, self._interval)
+            self._timer = self._scheduler.call_at(self._deadline, self._run)
         self._broadcast()
 
+    def reset(self):
+        """
+        Announces straight away and restarts the fast start burst, call after a change of state clients should see.
+        """
+        with self._lock:
+            if not self.is_running:
+                return
+            if self._timer:
+                self._timer.cancel()
+            self._gap = self.min_interval
+            self._deadline = time.time()
+            self._timer = self._scheduler.call_at(self._deadline, self._run)
+
+    def probed(self, nonce=None):
+        """
+        Answers a discovery probe with an immediate announce. The probes nonce is echoed so the client can time the
+        reply. Replies are limited to one per min_interval.
+        """
+        now = time.time()
+        if now - self._last_probe_reply < self.min_interval:
+            return
+        self._last_probe_reply = now
+        if nonce is None:
+            self._broadcast()
+        else:
+            self._broadcast(dict((k, dict(v, NONCE=nonce)) for k, v in self._message.items()))
+
+    def _read_probes(self, sock):
+        """
+        Answers the probes waiting on the non-blocking probe socket.
+        """
+        while self.is_running:
+            try:
+                data, addr = sock.recvfrom(1024)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    self.log.debug('Could not read probe: {}'.format(e))
+                return
+            try:
+                msg = json.loads(data)['PARTYBOX']
+                if msg['TYPE'] == 'PROBE':
+                    self.log.debug('Probe from {}'.format(addr))
+                    self.probed(msg.get('NONCE'))
+            except (ValueError, KeyError, TypeError):
+                continue
+
+    def _join(self, interface):
+        """
+        Joins the probe group on an interface.
+        """
+        sock = self._probe_socket
+        if sock and NetworkUtils.is_multicast(self._probe_address[0]):
+            try:
+                NetworkUtils.join_group(sock, self._probe_address[0], interface)
+            except socket.error as e:
+                self.log.debug('Could not join {0} on {1}: {2}'.format(self._probe_address[0], interface, e))
+
+    def _leave(self, interface):
+        sock = self._probe_socket
+        if sock and NetworkUtils.is_multicast(self._probe_address[0]):
+            try:
+                NetworkUtils.leave_group(sock, self._probe_address[0], interface)
+            except socket.error:
+                pass
+
+    def _start_listening(self):
+        host, port = self._probe_address
+        sock = None
+        try:
+            if NetworkUtils.is_multicast(host):
+                #Joined on each interface below
+                sock = NetworkUtils.multicast_receiver(host, port, self.interfaces[0] if self.interfaces else None)
+            else:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.bind(self._probe_address)
+        except socket.error as e:
+            self.log.warning('Could not listen for probes on {0}: {1}'.format(self._probe_address, e))
+            if sock:
+                sock.close()
+            return
+        with self._lock:
+            self._probe_socket = sock
+            for interface in self.interfaces[1:]:
+                self._join(interface)
+        if self._socket_map is not None:
+            self._probe_reader = _ProbeReader(self, sock, self._socket_map)
+        else:
+            sock.setblocking(0)
+            self._probe_reader = self._scheduler.call_every(self.min_interval, self._read_probes, sock)
+
     def start(self):
         """
         Starts broadcasting on UDP.
-        :param dict message: Message to broadcast.
         """
         if not self.is_running:
-            self._timer = threading.Timer(self._interval, self._run)
-            self._timer.daemon = True
-            self._timer.start()
             self.is_running = True
             self.start_time = time.time()
+            if self._probe_address:
+                self._start_listening()
+            if callable(self.interface):
+                self._rescan_timer = self._scheduler.call_every(self.rescan_interval, self._rescan)
+            self.reset()
 
     def stop(self):
         """
-        Stops the server broadcasting.1
+        Stops the server broadcasting.
+        """
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+            if self._rescan_timer:
+                self._rescan_timer.cancel()
+            self.is_running = False
+            self.start_time = None
+            sock, self._probe_socket = self._probe_socket, None
+            reader, self._probe_reader = self._probe_reader, None
+        if isinstance(reader, _ProbeReader):
+            #Closes the socket too
+            reader.close()
+        elif sock:
+            if reader:
+                reader.cancel()
+            sock.close()
+
+
+class _ProbeReader(asyncore.dispatcher):
+    """
+    Reads probes for a UDPAnnounce on a servers asyncore loop.
+    """
+
+    def __init__(self, announcer, sock, socket_map):
+        asyncore.dispatcher.__init__(self, sock, map=socket_map)
+        self.announcer = announcer
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.announcer._read_probes(self.socket)
+
+    def handle_error(self):
+        self.announcer.log.exception('Error reading probes')
+
+
+class TCPServerEvent(events.Event):
+    """
+    Base event for changes to the control servers clients, published on the servers EventBus.
+    """
+
+    def __init__(self, client):
+        """
+        :param client: The request handler for the client.
         """
-        self._timer.cancel()
-        self.is_running = False
-        self.start_time = None
+        events.Event.__init__(self)
+        self.client = client
+        self.address = client.client_address
+
+    def __repr__(self):
+        return '{0}({1}:{2})'.format(type(self).__name__, self.address[0], self.address[1])
+
+
+class ClientConnected(TCPServerEvent):
+    pass
+
+
+class ClientDisconnected(TCPServerEvent):
+    pass
+
+
+TCPServerEvent.ClientConnected = ClientConnected
+TCPServerEvent.ClientDisconnected = ClientDisconnected
+
+
+class ControlServerMixin(object):
+    """
+    Client registry, event callbacks and messaging shared by the control servers. Request handlers register
+    themselves through _add_client when they connect and are removed through remove_client. Handlers must provide
+    message(msg_type, payload), send_frame(frame) and close_connection(), and call _sync_client after sending
+    CONNECTED.
+
+    Playback state is kept in a versioned PlaybackState, changed through update_state which sends each change to
+    clients as a sequence numbered DELTA. Recent deltas are kept in a ReplayBuffer so a client that reconnects and
+    sends RESUME is only sent what it missed, a new client is sent a SNAPSHOT.
+    """
+
+    #Limits for each clients outbox, see outbox.Outbox
+    outbox_high_water = 256
+    outbox_policy = OverflowPolicy.DROP_OLDEST
+    outbox_disconnect_after = 5.0
+    #High frequency messages where only the latest value matters, at most one is broadcast per window
+    coalesce_types = (MessageType.VOLUME, MessageType.POSITION)
+    coalesce_window = 0.1
+    #Seconds between pings and how many can be missed before a client is removed
+    heartbeat_interval = 1.0
+    heartbeat_misses = 3
+    #Threads delivering events to callbacks
+    event_workers = 4
+    #Answer DNS-SD queries for _partybox._tcp beside the UDP announces
+    dns_sd = True
+    #Send binary announces, see announce.py, rather than JSON
+    compact_announce = True
+    #Seconds between refreshes of the load average in the announce
+    load_interval = 10
+    #Multicast group announces are sent to and probes listened for on, the interface to use (None lets the kernel
+    #choose, '*' announces on every interface) and the TTL
+    discovery_group = network.DISCOVERY_GROUP
+    multicast_interface = UDPAnnounce.ALL_INTERFACES
+    multicast_ttl = 1
+    #Deltas kept for clients resuming after a reconnect, and seconds a new client has to send RESUME before it is
+    #sent a snapshot
+    replay_size = 256
+    resume_wait = 0.1
+
+    def _setup_registry(self):
+        """
+        Sets up the client registry, callbacks, heartbeat, UDP announcer and DNS-SD responder, called from the servers
+        __init__.
+        """
+        self.log = logging.getLogger('server')
+        self._clients = {}
+        self.events = events.EventBus(self.event_workers)
+        self.scheduler = Scheduler()
+        self.heartbeat = Heartbeat(self, self.scheduler, self.heartbeat_interval, self.heartbeat_misses)
+        self._coalescer = Coalescer(self._send_all, self.scheduler, self.coalesce_window)
+
+        #Identifies this server to clients across restarts of their discovery and changes of address
+        self.server_id = uuid.uuid4().hex
+        self.state = PlaybackState(self.server_id)
+        self._replay = ReplayBuffer(self.replay_size)
+        #Held while changing the state or bringing a client up to date, so every client sees every delta in order
+        self._state_lock = threading.RLock()
+        msg = {
+            'PARTYBOX': {
+                'TYPE': 'BROADCAST',
+                'ID': self.server_id,
+                'NAME': socket.gethostname(),
+                'PORT': self.server_address[1],
+                #RTP is streamed on the control port and multicast on the next, see VLCTools.generate_sout
+                'RTP_PORT': self.server_address[1],
+                'MULTICAST_GROUP': network.zone_group(),
+                'MULTICAST_PORT': self.server_address[1] + 1,
+                'CLIENTS': 0,
+                'LOAD': load_average(),
+                'ALIVE_SINCE': time.time(),
+            }
+        }
+        #Setup Announcer
+        encoder = lambda message: announce.encode(message, self.compact_announce)
+        #Probes are read on the asyncore loop of AsyncTCPServer, from the scheduler otherwise
+        self.announcer = UDPAnnounce((self.discovery_group, self.server_address[1]), msg, scheduler=self.scheduler,
+                                     encoder=encoder, interface=self.multicast_interface, ttl=self.multicast_ttl,
+                                     socket_map=getattr(self, '_map', None))
+        self._load_timer = None
+        txt = {'id': self.server_id, 'version': protocol.VERSION}
+        self.responder = None
+        if self.dns_sd:
+            interface = self.multicast_interface
+            if interface == UDPAnnounce.ALL_INTERFACES:
+                interface = None
+            self.responder = DNSSDResponder(socket.gethostname(), self.server_address[1], txt, interface=interface)
+
+    def _start_discovery(self):
+        """
+        Starts the UDP announces and the DNS-SD responder.
+        """
+        self.announcer.start()
+        self._load_timer = self.scheduler.call_every(self.load_interval, self._announce_load)
+        if self.responder:
+            self.responder.start()
+
+    def _stop_discovery(self):
+        """
+        Stops the UDP announces and the DNS-SD responder.
+        """
+        self.announcer.stop()
+        if self._load_timer:
+            self._load_timer.cancel()
+        if self.responder:
+            self.responder.stop()
+
+    def register_callback(self, event_type, callable, coalesce=False):
+        """
+        Registers an event callback, called with the event on the event bus worker pool.
+        :param event_type: A TCPServerEvent subclass or tuple of them.
+        :param bool coalesce: Only call back with the latest event when several arrive while the callback is busy.
+        :rtype: events.Subscription
+        """
+        return self.events.subscribe(event_type, callable, coalesce)
+
+    def _add_client(self, handler):
+        """
+        Adds a newly connected handler to the registry and starts its heartbeat.
+        """
+        handler.state_synced = False
+        handler.sync_timer = None
+        self._clients[handler.client_address] = handler
+        self.heartbeat.add(handler)
+        self._announce_load()
+        self.events.publish(ClientConnected(handler))
+
+    def handle_message(self, handler, msg_type, payload):
+        """
+        Called by handlers for each message received from their client.
+        :param int msg_type: One of protocol.MessageType.
+        :param memoryview payload: Only valid until this method returns.
+        """
+        if msg_type == MessageType.PONG:
+            self.heartbeat.pong(handler, payload)
+        elif msg_type == MessageType.RESYNC:
+            self.log.debug('Resync requested by {}'.format(handler.client_address))
+            self.send_snapshot(handler)
+        elif msg_type == MessageType.RESUME:
+            self._resume(handler, payload.tobytes())
+        else:
+            self.log.debug('Ignoring message type {} from {}'.format(msg_type, handler.client_address))
+
+    def message_all(self, msg_type, payload=b''):
+        """
+        Sends a message to all connected clients. The message is encoded once and every client is handed the same
+        immutable frame. Types in coalesce_types are limited to one broadcast per coalesce_window, the latest value
+        wins. Values held back by the window are sent before any other message, so they arrive in order.
+        :param int msg_type: One of protocol.MessageType.
+        :param payload: The message payload.
+        """
+        frame = protocol.encode(msg_type, payload)
+        if msg_type in self.coalesce_types:
+            self._coalescer.put(msg_type, frame)
+        else:
+            self._coalescer.flush()
+            self._send_all(frame)
+
+    def update_state(self, **changes):
+        """
+        Changes the playback state, fields that actually changed are sent to every client as a DELTA.
+        :param changes: Values for any of state.FIELDS.
+        """
+        with self._state_lock:
+            delta = self.state.update(**changes)
+            if delta:
+                frame = protocol.encode(MessageType.DELTA, json.dumps(delta))
+                self._replay.append(delta['seq'], frame)
+                self._coalescer.flush()
+                self._send_all(frame)
+
+    def _sync_client(self, handler):
+        """
+        Called by handlers once CONNECTED is sent. Deltas are held back from the client until it has been sent a
+        snapshot, or the deltas it missed if it sends RESUME within resume_wait seconds.
+        """
+        handler.sync_timer = self.scheduler.call_later(self.resume_wait, self.send_snapshot, handler)
+
+    def send_snapshot(self, handler):
+        """
+        Sends the whole playback state to one client, on joining or when it asks to resync.
+        """
+        with self._state_lock:
+            self._synced(handler)
+            handler.message(MessageType.SNAPSHOT, json.dumps(self.state.snapshot()))
+
+    def _resume(self, handler, payload):
+        """
+        Brings a reconnected client up to date from the last delta it applied, with a snapshot if the deltas it
+        missed have left the replay buffer.
+        :param bytes payload: The RESUME payload, see state.py.
+        """
+        try:
+            resume = json.loads(payload.decode('UTF-8'))
+            state_id, seq = resume['id'], int(resume['seq'])
+        except (ValueError, KeyError, TypeError):
+            self.log.warning('Bad resume from {}'.format(handler.client_address))
+            self.send_snapshot(handler)
+            return
+        with self._state_lock:
+            if handler.state_synced:
+                #Too late, the snapshot has already been sent
+                return
+            frames = self._replay.since(seq) if state_id == self.state.id else None
+            if frames is None:
+                self.log.debug('Client {} can not resume from {}'.format(handler.client_address, seq))
+                self.send_snapshot(handler)
+                return
+            self._synced(handler)
+            for frame in frames:
+                handler.send_frame(frame)
+        self.log.debug('Client {0} resumed with {1} deltas'.format(handler.client_address, len(frames)))
+
+    def _synced(self, handler):
+        if handler.sync_timer:
+            handler.sync_timer.cancel()
+        handler.state_synced = True
+
+    def _send_all(self, frame):
+        """
+        Hands an encoded frame to every client.
+        """
+        self.log.debug('Sending message to {} clients'.format(len(self._clients)))
+        delta = protocol.frame_type(frame) == MessageType.DELTA
+        for handler in list(self._clients.values()):
+            #Clients waiting to be synced get this delta in their snapshot or replay instead
+            if delta and not handler.state_synced:
+                continue
+            handler.send_frame(frame)
+
+    def remove_client(self, client_address):
+        """
+        Removes the client from the client list, closing the connection if required. The client may have already been
+        removed if the client closes properly.
+        :param tuple client_address: The host,port tuple
+        """
+        try:
+            handler = self._clients.pop(client_address)
+        except KeyError as e:
+            self.log.info('Could not remove client from list')
+            return
+        self.heartbeat.remove(handler)
+        if handler.sync_timer:
+            handler.sync_timer.cancel()
+        handler.close_connection()
+        self.log.info('Client removed {}'.format(client_address))
+        self._announce_load()
+        self.events.publish(ClientDisconnected(handler))
+
+    def _announce_load(self):
+        """
+        Updates the number of clients and load average in the announce packet, sent with the next packet rather than
+        straight away.
+        """
+        msg = dict(self.announcer.message['PARTYBOX'], CLIENTS=len(self._clients), LOAD=load_average())
+        self.announcer.update({'PARTYBOX': msg}, reset=False)
+
+    def announce_stream(self, group, port, zone=None):
+        """
+        Sets the multicast group and port the RTP stream is sent to, and the zone it belongs to, in the announce packet.
+        """
+        msg = dict(self.announcer.message['PARTYBOX'], MULTICAST_GROUP=group, MULTICAST_PORT=port, ZONE=zone)
+        self.announcer.update({'PARTYBOX': msg})
+
+    def announce_now_playing(self, item):
+        """
+        Puts the playing track in the announce packet so passive clients can show it without connecting. Announced
+        straight away.
+        :param media.AbstractMedia item: The track, None if nothing is playing.
+        """
+        msg = dict(self.announcer.message['PARTYBOX'])
+        msg.pop('NOW_PLAYING', None)
+        if item is not None:
+            msg['NOW_PLAYING'] = {
+                'TITLE': item.title,
+                'ARTIST': item.artist,
+                'ALBUM': item.album,
+                'ARTWORK': item.artwork,
+                'BACKEND': item.__class__.__name__,
+            }
+        self.announcer.update({'PARTYBOX': msg})
 
+    def _create_outbox(self):
+        """
+        Creates the outbox for a newly connected client.
+        :rtype: outbox.Outbox
+        """
+        return Outbox(self.outbox_high_water, self.outbox_policy, self.outbox_disconnect_after, self.coalesce_types)
 
-class TCPServerEvent(object):
-    ClientConnected = 1
-    ClientDisconnected = 2
+    def client_stats(self):
+        """
+        Outbox depth, drop counts and heartbeat RTT for each connected client.
+        :return: Stats keyed by client address.
+        :rtype: dict
+        """
+        stats = {}
+        for address, handler in list(self._clients.items()):
+            stats[address] = handler.outbox.stats()
+            stats[address].update(handler.liveness.stats())
+        return stats
+
+    @property
+    def clients(self):
+        """
+        List of unique clients
+        """
+        clients = []
+        for client in list(self._clients.keys()):
+            clients.append(client[0])
+        return list(set(clients))
 
 
 class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
@@ -87,49 +727,76 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
         Sets up the handlers outbox queue and log, because the handler blocks finish_request until it closes we have
         to add the handler to the clients list in this method. Its a bit backwards but it works!
         """
-        self.server._clients[self.client_address] = self
-        self.server._callback(TCPServerEvent.ClientConnected, self)
-        self.queue = queue.Queue()
+        self.outbox = self.server._create_outbox()
+        self.decoder = protocol.FrameDecoder()
         self.log = logging.getLogger('Request')
+        #A client that stops reading fails the send instead of blocking the thread forever.
+        self.request.settimeout(self.server.send_timeout)
+        self.server._add_client(self)
 
     def handle(self):
         """
-        Handles the request, continuously checks the outbox queue pushing any messages to the client. Blocks until
-        the connection is explicitly closed or an exception is raised.
-        """
-        #Send connection confirmation to client
-        msg = "CONNECTED {}".format(self.client_address[0])
-        self.queue.put(msg)
-        while True:
-            msg = self.queue.get(block=True)
-            self.request.sendall(msg)
+        Handles the request, continuously checks the outbox queue pushing any messages to the client and reads
+        anything the client sends. Blocks until the connection is explicitly closed or an exception is raised.
+        """
+        #Send connection confirmation and the playback state to client
+        self.message(MessageType.CONNECTED, self.client_address[0])
+        self.server._sync_client(self)
+        while not self.outbox.closed:
+            #Everything already queued goes out in the same write
+            frames = self.outbox.pop(block=True, timeout=self.server.read_interval)
+            if frames:
+                protocol.sendallv(self.request, frames)
+            if select.select([self.request], [], [], 0)[0]:
+                if not self.decoder.recv_into(self.request):
+                    break
+                for msg_type, payload in self.decoder.frames():
+                    self.server.handle_message(self, msg_type, payload)
 
     def finish(self):
         """
         Called when the client closes the connection like a good boy.
         """
         self.log.debug('Request finished or closed by client')
-        self.server.remove_client()
+        self.server.remove_client(self.client_address)
 
 
-    def message(self, msg):
+    def message(self, msg_type, payload=b''):
         """
         Sends a message to the client
         """
-        self.queue.put(msg)
+        self.send_frame(protocol.encode(msg_type, payload))
 
+    def send_frame(self, frame):
+        """
+        Queues an encoded frame for the client, disconnecting it if its outbox policy says so.
+        """
+        if not self.outbox.put(frame):
+            self.log.warning('Client {} is not keeping up, disconnecting'.format(self.client_address))
+            self.server.remove_client(self.client_address)
+
+    def close_connection(self):
+        """
+        Closes the socket and outbox so the handler thread exits.
+        """
+        self.outbox.close()
+        self.request.close()
 
-class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+
+class TCPServer(ControlServerMixin, socketserver.ThreadingMixIn, socketserver.TCPServer):
     """
     A publish/subscribe server using SocketServer. Allows the server to push messages out to clients.
     Clients are pinged every second to ensure they're still connected. Each connection is handled in a seperate
     thread. Messages are pushed onto a queue.
-    """
 
-    #TODO: Should periodically ping to ensure all clients are alive.
+    Kept as a fallback for AsyncTCPServer, every client costs a thread.
+    """
 
     allow_reuse_address = True
-    callbacks = []
+    #Seconds a blocked send waits before the client is dropped
+    send_timeout = 10
+    #Longest a handler waits on its outbox before checking for messages from the client
+    read_interval = 0.1
 
     def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True):
         """
@@ -138,96 +805,267 @@ class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
         :param bind_and_activate: Whether to call bind and activate on the server.
         """
         socketserver.TCPServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate)
-        self.log = logging.getLogger('server')
-        self._clients = {}
+        self._setup_registry()
 
-        msg = {
-            'PARTYBOX': {
-                'TYPE': 'BROADCAST',
-                'ALIVE_SINCE': time.time(),
-            }
-        }
-        #Setup Announcer
-        self.announcer = UDPAnnounce(("224.0.0.1", self.server_address[1]), msg)
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Starts announcing over UDP and the heartbeat when the TCPServer is running.
+        """
+        self._start_discovery()
+        self.scheduler.start()
+        socketserver.TCPServer.serve_forever(self, poll_interval)
 
+    def finish_request(self, request, client_address):
+        """
+        Called to initialise the handler for a request.
+        """
+        self.log.info('Connection from {0}:{1}'.format(client_address[0], client_address[1]))
+        socketserver.TCPServer.finish_request(self, request, client_address)
 
-    def register_callback(self, event_type, callable):
+    def handle_error(self, request, client_address):
+        """
+        Handles an exception raised from the handler. Used to remove the client from the client list if the connection
+        is no longer open.
         """
-        Registers an event callback.
+        self.log.warning('Lost connection to client {0}:{1}'.format(client_address[0], client_address[1]))
+        self.remove_client(client_address)
+
+    def shutdown(self):
+        self._stop_discovery()
+        self.scheduler.stop()
+        self.events.stop()
+        socketserver.TCPServer.shutdown(self)
+
+
+class AsyncRequestHandler(asyncore.dispatcher):
+    """
+    Handles a single client on the AsyncTCPServer loop. Messages are pushed onto an outbox and written whenever the
+    socket becomes writable, an idle client costs a file descriptor rather than a thread.
+    """
+
+    def __init__(self, request, client_address, server):
         """
-        self.callbacks.append((event_type, callable))
+        :param socket request: The accepted client socket.
+        :param tuple client_address: The host,port tuple
+        :param AsyncTCPServer server: The server that accepted the connection.
+        """
+        asyncore.dispatcher.__init__(self, request, map=server._map)
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.outbox = server._create_outbox()
+        self.decoder = protocol.FrameDecoder()
+        self.log = logging.getLogger('Request')
+        self._pending = []
+
+        self.server._add_client(self)
+        #Send connection confirmation and the playback state to client
+        self.message(MessageType.CONNECTED, self.client_address[0])
+        self.server._sync_client(self)
 
-    def _callback(self, event_type, obj):
+    def message(self, msg_type, payload=b''):
         """
-        Calls event callbacks
+        Sends a message to the client, safe to call from any thread.
         """
-        #Start a thread for each callback
-        for x in (y for y in self.callbacks if y[0] == event_type):
-            t = threading.Thread(target=x[1], args=(event_type, obj))
-            t.daemon = True
-            t.start()
+        self.send_frame(protocol.encode(msg_type, payload))
 
+    def send_frame(self, frame):
+        """
+        Queues an encoded frame for the client, safe to call from any thread. Disconnects the client if its outbox
+        policy says so.
+        """
+        if not self.outbox.put(frame):
+            self.log.warning('Client {} is not keeping up, disconnecting'.format(self.client_address))
+            self.server.remove_client(self.client_address)
+            return
+        self.server.wake()
 
-    def serve_forever(self, poll_interval=0.5):
+    def close_connection(self):
         """
-        Starts announcing over UDP when the TCPServer is running.
+        Closes the connection on the event loop thread.
         """
-        self.announcer.start()
-        socketserver.TCPServer.serve_forever(self, poll_interval)
+        self.server.call_soon(self.close)
 
-    def finish_request(self, request, client_address):
+    def readable(self):
+        return True
+
+    def writable(self):
+        return bool(self._pending or self.outbox)
+
+    def handle_read(self):
         """
-        Called to initialise the handler for a request.
+        Reads whatever the client has sent into the frame decoder and handles each complete message.
         """
-        self.log.info('Connection from {0}:{1}'.format(client_address[0], client_address[1]))
-        socketserver.TCPServer.finish_request(self, request, client_address)
+        if not self.decoder.recv_into(self.socket):
+            self.handle_close()
+            return
+        for msg_type, payload in self.decoder.frames():
+            self.server.handle_message(self, msg_type, payload)
 
-    def message_all(self, message):
+    def handle_write(self):
         """
-        Sends a message to all connected clients.
-        :param str message: The message to send.
+        Writes as much of the outbox as the socket will take without blocking, queued frames are written together
+        in one vectored write.
         """
-        self.log.debug('Sending message to {} clients'.format(len(self._clients)))
-        for address, handler in self._clients.items():
-            handler.message(message)
+        if len(self._pending) < protocol.IOV_MAX:
+            self._pending.extend(self.outbox.pop(protocol.IOV_MAX - len(self._pending)))
+        try:
+            sent = protocol.sendv(self.socket, self._pending)
+        except socket.error as e:
+            if e.args[0] == errno.EWOULDBLOCK:
+                return
+            raise
+        self._pending = protocol.consume(self._pending, sent)
 
-    def remove_client(self, client_address):
+    def handle_close(self):
         """
-        Removes the client from the client list, closing the connection if required. The client may have already been
-        removed if the client closes properly.
-        :param tuple client_address: The host,port tuple
+        Called when the client closes the connection or it is lost.
         """
+        self.log.debug('Request finished or closed by client')
+        self.server.remove_client(self.client_address)
+
+    def handle_error(self):
+        self.server.handle_error(self.request, self.client_address)
+
+
+class _Waker(asyncore.dispatcher):
+    """
+    One end of a socket pair on the event loop, writing to the other end interrupts poll so messages queued from
+    other threads are sent straight away.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self._woken = False
+        self._reader, self._writer = socket.socketpair()
+        self._writer.setblocking(0)
+        asyncore.dispatcher.__init__(self, self._reader, map=server._map)
+
+    def wake(self):
+        #One wake per loop iteration is enough, a broadcast to every client shouldn't write to the pipe for each.
+        if self._woken:
+            return
+        self._woken = True
         try:
-            self._clients[client_address].request.close()
-            del self._clients[client_address]
-            self.log.info('Client removed {}'.format(client_address))
-        except KeyError as e:
-            self.log.info('Could not remove client from list')
+            self._writer.send(b'x')
+        except socket.error:
+            #Buffer is full so the loop is already due to wake.
+            pass
 
-    def handle_error(self, request, client_address):
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self._woken = False
+        self.recv(4096)
+        self.server._run_calls()
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self._writer.close()
+
+
+class AsyncTCPServer(ControlServerMixin, asyncore.dispatcher):
+    """
+    A publish/subscribe server running every connection on a single poll based asyncore loop. Has the same client
+    registry, events and messaging as TCPServer without a thread per client, so thousands of idle phones can stay
+    connected. Messages and closes from other threads are handed to the loop through call_soon.
+    """
+
+    allow_reuse_address = True
+    request_queue_size = socket.SOMAXCONN
+
+    def __init__(self, server_address, RequestHandlerClass=AsyncRequestHandler, bind_and_activate=True):
         """
-        Handles an exception raised from the handler. Used to remove the client from the client list if the connection
-        is no longer open.
+        :param server_address: The host address, usually '0.0.0.0'
+        :param RequestHandlerClass: The handler class
+        :param bind_and_activate: Whether to call bind and listen on the server.
         """
-        self.log.warning('Lost connection to client {0}:{1}'.format(client_address[0], client_address[1]))
-        self.remove_client(client_address)
+        self._map = {}
+        asyncore.dispatcher.__init__(self, map=self._map)
+        self.RequestHandlerClass = RequestHandlerClass
+        self._calls = collections.deque()
+        self._loop_thread = None
+        self._running = False
 
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.allow_reuse_address:
+            self.set_reuse_addr()
+        if bind_and_activate:
+            self.bind(server_address)
+            self.listen(self.request_queue_size)
+        self.server_address = self.socket.getsockname()
+        self._waker = _Waker(self)
+        self._setup_registry()
 
-    @property
-    def clients(self):
+    def wake(self):
         """
-        List of unique clients
+        Interrupts the event loop, called when there is new work from another thread.
         """
-        clients = []
-        for client in self._clients.keys():
-            clients.append(client[0])
-        return list(set(clients))
+        if threading.current_thread() is not self._loop_thread:
+            self._waker.wake()
 
+    def call_soon(self, func, *args):
+        """
+        Runs func on the event loop thread, immediately if already on it.
+        """
+        if threading.current_thread() is self._loop_thread or self._loop_thread is None:
+            func(*args)
+        else:
+            self._calls.append((func, args))
+            self._waker.wake()
 
-    def shutdown(self):
-        self.announcer.stop()
-        socketserver.TCPServer.shutdown()
+    def _run_calls(self):
+        while self._calls:
+            func, args = self._calls.popleft()
+            func(*args)
 
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Starts announcing over UDP and the heartbeat, then runs the event loop until shutdown() is called.
+        """
+        self._start_discovery()
+        self.scheduler.start()
+        self._loop_thread = threading.current_thread()
+        self._running = True
+        try:
+            while self._running:
+                asyncore.loop(timeout=poll_interval, use_poll=True, map=self._map, count=1)
+                self._run_calls()
+        finally:
+            self._loop_thread = None
+            asyncore.close_all(self._map)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        request, client_address = pair
+        self.log.info('Connection from {0}:{1}'.format(client_address[0], client_address[1]))
+        self.RequestHandlerClass(request, client_address, self)
+
+    def handle_error(self, request=None, client_address=None):
+        """
+        Handles an exception raised on the loop. Exceptions from a handler remove the client, anything else is logged.
+        """
+        if client_address is None:
+            self.log.exception('Control server error')
+            return
+        self.log.warning('Lost connection to client {0}:{1}'.format(client_address[0], client_address[1]))
+        self.remove_client(client_address)
+
+    def shutdown(self):
+        """
+        Stops announcing, the heartbeat and the event loop, closing all connections.
+        """
+        self._stop_discovery()
+        self.scheduler.stop()
+        self.events.stop()
+        self._running = False
+        self._waker.wake()
 
 
 class RDPConsumer(object):
@@ -240,11 +1078,14 @@ class RDPConsumer(object):
 class VLCTools(object):
 
     @staticmethod
-    def generate_sout(clients, port):
+    def generate_sout(clients, port, group=None, ttl=1, transcode=True):
         """
         Generates a VLC sout string for a Media object.
         :param list clients: Addresses to push stream to.
-        :param int port: Port to stream on.
+        :param int port: Port to stream on, the multicast stream is sent to the next port.
+        :param str group: Multicast group for the stream, defaults to the default zones group.
+        :param int ttl: Multicast TTL.
+        :param bool transcode: Transcode into the streaming profile, False for media already in it.
         """
         sout = []
         for client in clients:
@@ -252,8 +1093,22 @@ class VLCTools(object):
             cmd = "dst=rtp{{access={0},mux=ts,dst={1},port={2}}}".format(
                 protocol, client, port)
             sout.append(cmd)
-        sout.append("dst=rtp{{access=udp,mux=ts,dst=224.0.0.1,port={0}}}".format(port+1))
-        return ":sout=#transcode{{acodec=mp3,ab=320}}: duplicate{{{0}}}".format(",".join(sout))
+        sout.append("dst=rtp{{access=udp,mux=ts,dst={0},port={1},ttl={2}}}".format(group or network.zone_group(),
+                                                                                port+1, ttl))
+        return ":sout=#{0}duplicate{{{1}}}".format(VLCTools._transcode(transcode), ",".join(sout))
+
+    @staticmethod
+    def generate_relay_sout(address, transcode=True):
+        """
+        Generates a VLC sout string streaming to a single RTPRelay, which sends the stream on to the clients.
+        :param tuple address: Host and port the relay receives on.
+        :param bool transcode: Transcode into the streaming profile, False for media already in it.
+        """
+        return ":sout=#{0}rtp{{access=udp,mux=ts,dst={1},port={2}}}".format(VLCTools._transcode(transcode), *address)
+
+    @staticmethod
+    def _transcode(enabled):
+        return "transcode{{{}}}:".format(PROFILE) if enabled else ""
 
 
 
@@ -262,26 +1117,105 @@ class MediaServer(object):
     Plays music and streams it to clients.
     """
 
-    def __init__(self, port=8234):
+    #Seconds between checks of the player for state changes clients haven't been sent, such as queue edits
+    state_interval = 1.0
+    #Number of upcoming queue items in the playback state
+    queue_head = 5
+    #Gapless engine, seconds before the end of a track the next is prerolled, and the longest acceptable gap
+    preroll = 10.0
+    max_gap = 0.05
+    #Crossfade engine, longest crossfade in seconds
+    max_crossfade = 12.0
+    #Transcode cache, number of queue items converted ahead and the most bytes kept on disk
+    transcode_ahead = 3
+    cache_size = 2 * 1024 ** 3
+
+    def __init__(self, port=8234, threaded=False, zone=None, group=None, relay=True, engine=Engine.PLAYER,
+                 crossfade=6.0, cache=None):
+        """
+        :param int port: Port for the control server and RTP stream.
+        :param bool threaded: Use the thread per client TCPServer instead of AsyncTCPServer.
+        :param str zone: Name of the zone this server plays to.
+        :param str group: Multicast group to stream to, defaults to the zones group from network.zone_group.
+        :param bool relay: Stream once to an RTPRelay that copies the stream to each client, so clients joining and
+        leaving don't interrupt playback. Otherwise VLC streams to each client itself and the media is reloaded.
+        :param int engine: One of engine.Engine, Engine.VLM streams from a VLM broadcast whose input and output are
+        switched rather than creating a player and media for each track. Engine.GAPLESS prerolls the next track on a
+        second player and switches to it as the current one ends. Engine.CROSSFADE mixes the end of each track into
+        the start of the next in a single output stream.
+        :param float crossfade: Seconds tracks overlap by with the crossfade engine, 0 - max_crossfade.
+        :param str cache: Directory to keep local files transcoded ahead of playing in, None transcodes live. Not used
+        by the VLM and crossfade engines, whose output is transcoded whatever the input.
+        """
         #Start the TCP server
-        self._server = TCPServer(("0.0.0.0", port), ThreadedTCPRequestHandler)
+        if threaded:
+            self._server = TCPServer(("0.0.0.0", port), ThreadedTCPRequestHandler)
+        else:
+            self._server = AsyncTCPServer(("0.0.0.0", port), AsyncRequestHandler)
         t = threading.Thread(target=self._server.serve_forever)
         t.daemon = True
         t.start()
         #Setup vlc
         self.instance = vlc.Instance()
-        self._player = vlc.MediaPlayer(self.instance)
+        self._engine = engine
         self._port = port
+        self.zone = zone
+        self._group = group or network.zone_group(zone)
+        self._server.announce_stream(self._group, port + 1, zone)
+        self._relay = None
+        if relay:
+            interface = self._server.multicast_interface
+            if interface == UDPAnnounce.ALL_INTERFACES:
+                interface = None
+            self._relay = RTPRelay(ttl=self._server.multicast_ttl, interface=interface)
+            self._relay.add((self._group, port + 1))
+            self._relay.start()
+        self._mixer = None
+        self._output = None
+        self._input = None
+        self._fading = []
+        if engine == Engine.VLM:
+            self._player = VLMBroadcast(self.instance, self._get_sout())
+        elif engine == Engine.CROSSFADE:
+            #Tracks are decoded into the mixer, one output player streams the mix from a pipe for as long as the
+            #server runs
+            self._mix_fd, write_fd = os.pipe()
+            self._mixer = Mixer(write_fd)
+            self._output = vlc.MediaPlayer(self.instance)
+            self._output.set_media(self._get_mix_media())
+            self._input = MixerInput(self._mixer, self.instance)
+            self._player = self._input.player
+        else:
+            self._player = vlc.MediaPlayer(self.instance)
         self._queue = media.Queue()
         self._log = logging.getLogger('MediaServer')
         self._setup_events()
         self._now_playing = None
         self.history = []
-
-        self._server.register_callback(TCPServerEvent.ClientConnected, self._client_connected)
-
-
-    def _client_connected(self, event, client):
+        self._ramps = RampScheduler(self._server.scheduler, self._set_player_volume)
+        self._state_timer = self._server.scheduler.call_every(self.state_interval, self._sync_state)
+        self._preroll = None
+        self._transition_timer = None
+        #Held while the player, queue or history change. VLC callbacks never wait on it, they pass the change to the
+        #scheduler, so it can be held while a player is stopped
+        self._lock = threading.RLock()
+        #Seconds between the last track ending and the next playing, gapless engine only
+        self.last_gap = None
+        self._crossfade = 0
+        self.crossfade = crossfade
+        self._transcoder = None
+        if cache and engine in (Engine.PLAYER, Engine.GAPLESS):
+            self._transcoder = Transcoder(TranscodeCache(cache, self.cache_size), self._queue, self._server.scheduler,
+                                          self.transcode_ahead)
+            self._transcoder.start()
+
+        self._server.register_callback((ClientConnected, ClientDisconnected), self._clients_changed, coalesce=True)
+
+
+    def _clients_changed(self, event):
+        """
+        Rebuilds the stream output when clients join or leave. Coalesced, so a burst of joins only rebuilds once.
+        """
         self.update_stream_output()
 
 
@@ -299,78 +1233,282 @@ class MediaServer(object):
         """
         return self._queue
 
-    @decorators.synchronized
+    @property
+    def crossfade(self):
+        """
+        Seconds the crossfade engine overlaps tracks by, 0 starts each track as the last one ends.
+        :rtype: float
+        """
+        return self._crossfade
+
+    @crossfade.setter
+    def crossfade(self, value):
+        if not 0 <= value <= self.max_crossfade:
+            raise ValueError('Crossfade must be between 0 and {}s'.format(self.max_crossfade))
+        self._crossfade = float(value)
+        self._schedule_transition()
+
     def previous(self):
         """
         Plays the most recent track in history
         """
-        #Get last track and move now playing back into queue
-        try:
-            media = self.history.pop()
-            if self.now_playing:
-                self.queue.insert(0, self.now_playing)
-        except IndexError:
-            self._log.warning("No tracks in history to load")
-            return
+        with self._lock:
+            self._discard_transition()
+            #Get last track and move now playing back into queue
+            try:
+                media = self.history.pop()
+                if self.now_playing:
+                    self.queue.insert(0, self.now_playing)
+            except IndexError:
+                self._log.warning("No tracks in history to load")
+                return
 
-        playing = self._player.get_state() == vlc.State.Playing
+            playing = self._player.get_state() == vlc.State.Playing
 
-        #Load the media
-        m = self._get_vlc_media(media.get_uri())
-        self._player.set_media(m)
-        self._now_playing = media
+            #Load the media
+            m = self._get_vlc_media(media.get_uri())
+            self._player.set_media(m)
+            self._now_playing = media
 
-        if playing:
-            self.play()
+            if playing:
+                self.play()
 
-    @decorators.synchronized
     def next(self):
         """
         Skips to the next track in the Queue
         """
-        #Move now playing to history
-        if self.now_playing:
-            self.history.append(self.now_playing)
+        with self._lock:
+            self._discard_transition()
+            #Move now playing to history
+            if self.now_playing:
+                self.history.append(self.now_playing)
 
-        try:
-            media = self._queue.pop(0)
-        except IndexError:
-            #No tracks left in the queue so return
-            return None
+            try:
+                media = self._queue.pop(0)
+            except IndexError:
+                #No tracks left in the queue so return
+                return None
 
-        playing = self._player.get_state() == vlc.State.Playing
+            playing = self._player.get_state() == vlc.State.Playing
 
-        #Stop and clear previous player
-        if playing:
-            self._player.stop()
+            if self._engine != Engine.VLM:
+                #Stop and clear previous player
+                if playing:
+                    self._player.stop()
 
-        print(self._player.get_state())
+                print(self._player.get_state())
 
-        #Create new player and attach events
-        self._player = vlc.MediaPlayer(self.instance)
-        self._setup_events()
+                #Create new player and attach events
+                self._player = self._new_player()
+                self._setup_events()
 
-        #Load media
-        m = self._get_vlc_media(media.get_uri())
-        self._player.set_media(m)
-        self._now_playing = media
-        if playing:
-            self.play()
+            #Load media
+            m = self._get_vlc_media(media.get_uri())
+            self._player.set_media(m)
+            self._now_playing = media
+            if playing:
+                self.play()
 
-    def _encountered_error(self, event):
+    def _encountered_error(self, event, player):
         """
-        Called when the player encounters an error, used to recover from it.
+        VLC callback - Called when the player encounters an error, used to recover from it by skipping the track.
         """
         self._log.error(vlc.libvlc_errmsg())
-        self.next()
+        self._server.scheduler.call_later(0, self._skip, player)
+
+    def _skip(self, player):
+        with self._lock:
+            if player is self._player:
+                self.next()
 
-    def _end_reached(self, event):
+    def _end_reached(self, event, player):
         """
-        VLC callback - Track finished playing
+        VLC callback - Track finished playing. The next track is started on the scheduler, a player can't be stopped
+        from its own callback.
         """
         self._log.info('Track ended')
-        self.next()
-        self._player.play()
+        self._server.scheduler.call_later(0, self._track_ended, player, time.time())
+
+    def _track_ended(self, player, ended_at):
+        """
+        Starts the next track once player has ended.
+        :param vlc.MediaPlayer player: The player that ended, nothing is done if it has been replaced since.
+        :param float ended_at: When it ended.
+        """
+        with self._lock:
+            if player is not self._player:
+                return
+            if self._engine == Engine.GAPLESS and self._start_preroll(ended_at):
+                return
+            self.next()
+            self._player.play()
+
+    def _new_player(self):
+        """
+        A player for the next track. With the crossfade engine it decodes into the mixer, replacing the current input.
+        :rtype: vlc.MediaPlayer
+        """
+        if self._engine != Engine.CROSSFADE:
+            return vlc.MediaPlayer(self.instance)
+        old, self._input = self._input, MixerInput(self._mixer, self.instance)
+        #Out of the mix straight away, the player is released off the VLC event thread
+        self._mixer.remove(old.source)
+        self._server.scheduler.call_later(0, old.release)
+        return self._input.player
+
+    def _schedule_transition(self):
+        """
+        Schedules the switch to the next track from the length of the current one. The gapless engine prerolls it
+        preroll seconds before the end, the crossfade engine starts it crossfade seconds before. The length comes from
+        parsing the media, which is started in the background if it hasn't been parsed yet.
+        """
+        with self._lock:
+            if self._engine not in (Engine.GAPLESS, Engine.CROSSFADE):
+                return
+            if self._transition_timer:
+                self._transition_timer.cancel()
+                self._transition_timer = None
+            m = self._player.get_media()
+            if m is None:
+                return
+            length = m.get_duration()
+            if length <= 0 and not m.is_parsed():
+                m.event_manager().event_attach(vlc.EventType.MediaParsedChanged, self._media_parsed)
+                m.parse_async()
+                return
+            remaining = (length - max(self._player.get_time(), 0)) / 1000.0 if length > 0 else 0
+            if self._engine == Engine.GAPLESS:
+                #A stream of unknown length is prerolled straight away
+                self._transition_timer = self._server.scheduler.call_later(max(remaining - self.preroll, 0),
+                                                                           self._prepare_next)
+            elif length > 0 and self.crossfade > 0:
+                #A track shorter than two crossfades is faded over half its length
+                duration = min(self.crossfade, length / 2000.0)
+                self._transition_timer = self._server.scheduler.call_later(max(remaining - duration, 0),
+                                                                           self._start_crossfade, self._player,
+                                                                           duration)
+            #Otherwise the next track starts when this one ends
+
+    def _media_parsed(self, event):
+        #Off the VLC event thread
+        self._server.scheduler.call_later(0, self._schedule_transition)
+
+    def _prepare_next(self):
+        """
+        Opens the next queued track on a second player, paused on its first frame.
+        """
+        with self._lock:
+            self._transition_timer = None
+            if not self._queue:
+                return
+            item = self._queue[0]
+            if self._preroll and self._preroll.item is item:
+                return
+            self._discard_transition()
+            self._log.info('Prerolling {}'.format(item))
+            self._preroll = Preroll(self.instance, item, self._get_vlc_media(item.get_uri()), self._server.scheduler,
+                                    self._player.audio_get_volume(), self._gapless_started)
+
+    def _start_preroll(self, ended_at):
+        """
+        Switches to the prerolled track, called with the lock held as the current track ends.
+        :param float ended_at: When the current track ended.
+        :return: False if there was no preroll for the next track.
+        :rtype: bool
+        """
+        preroll, self._preroll = self._preroll, None
+        if preroll is None:
+            return False
+        if not self._queue or self._queue[0] is not preroll.item:
+            #The queue changed since
+            self._server.scheduler.call_later(0, preroll.release)
+            return False
+        preroll.player.audio_set_volume(self._player.audio_get_volume())
+        preroll.start(ended_at)
+
+        old = self._player
+        if self.now_playing:
+            self.history.append(self.now_playing)
+        self._queue.pop(0)
+        self._now_playing = preroll.item
+        self._player = preroll.player
+        self._setup_events()
+        self._server.scheduler.call_later(0, self._release_player, old)
+        self._media_changed(None)
+        return True
+
+    def _gapless_started(self, gap):
+        self.last_gap = gap
+        if gap > self.max_gap:
+            self._log.warning('Gap between tracks {:.1f}ms'.format(gap * 1000))
+        else:
+            self._log.info('Gap between tracks {:.1f}ms'.format(gap * 1000))
+
+    def _start_crossfade(self, player, duration):
+        """
+        Starts the next queued track on a second player in the mixer and fades it in while the current track fades
+        out, the current track becomes the next in history straight away. Runs on the scheduler duration seconds
+        before the current track ends.
+        :param vlc.MediaPlayer player: The player the crossfade was scheduled for, nothing is done if it has been
+        replaced since.
+        :param float duration: Length of the crossfade in seconds.
+        """
+        with self._lock:
+            self._transition_timer = None
+            if player is not self._player or not self._queue or self._player.get_state() != vlc.State.Playing:
+                #Without a crossfade the next track is started as this one ends
+                return
+            item = self._queue.pop(0)
+            self._log.info('Crossfading to {0} over {1:.1f}s'.format(item, duration))
+            now = time.time()
+            old = self._input
+            for event_type in (vlc.EventType.MediaPlayerEndReached, vlc.EventType.MediaPlayerEncounteredError,
+                               vlc.EventType.MediaPlayerMediaChanged):
+                self.events.event_detach(event_type)
+            old.fade(Ramp(100, 0, duration, Curve.S_CURVE, now))
+            self._fading.append(old)
+
+            def faded(event=None):
+                self._server.scheduler.call_later(0, self._release_fading, old)
+
+            #Released when it ends, or once the fade is over if the length was out
+            self.events.event_attach(vlc.EventType.MediaPlayerEndReached, faded)
+            self._server.scheduler.call_later(duration + 1, self._release_fading, old)
+
+            self._input = MixerInput(self._mixer, self.instance, Ramp(0, 100, duration, Curve.S_CURVE, now))
+            self._input.player.audio_set_volume(old.player.audio_get_volume())
+            if self.now_playing:
+                self.history.append(self.now_playing)
+            self._now_playing = item
+            self._player = self._input.player
+            self._setup_events()
+            self._player.set_media(self._get_vlc_media(item.get_uri()))
+            self._player.play()
+
+    def _release_fading(self, fading):
+        with self._lock:
+            if fading not in self._fading:
+                return
+            self._fading.remove(fading)
+        fading.release()
+
+    def _discard_transition(self):
+        """
+        Cancels a scheduled transition and releases a prerolled track and any track still fading out.
+        """
+        if self._transition_timer:
+            self._transition_timer.cancel()
+            self._transition_timer = None
+        preroll, self._preroll = self._preroll, None
+        if preroll:
+            self._server.scheduler.call_later(0, preroll.release)
+        for fading in list(self._fading):
+            self._server.scheduler.call_later(0, self._release_fading, fading)
+
+    @staticmethod
+    def _release_player(player):
+        player.stop()
+        player.release()
 
     def _media_changed(self, event):
         """
@@ -378,68 +1516,129 @@ class MediaServer(object):
         Called when self._player has a new media set, does not always mean self.now_playing has changed.
         """
         self._log.info("Track changed: {}".format(self._player.get_media().get_mrl()))
-        self._server.message_all(self._player.get_media().get_mrl() + "\n")
-        self._sout_updated()
+        self._server.message_all(MessageType.MEDIA_CHANGED, self._player.get_media().get_mrl())
+        self._server.announce_now_playing(self.now_playing)
+        self._sync_state(position=0)
+        if self._output is None:
+            #The crossfade engine's output stream carries on across tracks
+            self._sout_updated()
+        #Off the VLC event thread
+        self._server.scheduler.call_later(0, self._schedule_transition)
+
+    def _sync_state(self, **changes):
+        """
+        Reads the playback state from the player and sends clients whatever changed. Runs every state_interval
+        seconds as well as straight after anything that changes playback.
+        :param changes: Values known better than the player can report them yet, such as the volume a ramp ends on.
+        """
+        state = {
+            'now_playing': describe(self.now_playing),
+            'queue': [describe(item) for item in self._queue[:self.queue_head]],
+            'paused': self.paused,
+            'position': max(self.time, 0) if self._player.get_media() else None,
+        }
+        ramp = self._ramps.active
+        #Clients were sent the ramp and interpolate it themselves, the state holds the volume it ends on
+        state['volume'] = ramp.end if ramp else self._player.audio_get_volume()
+        state.update(changes)
+        self._server.update_state(**state)
 
     def _sout_updated(self):
         """
         Callback - Called when the server SOUT is updated to connected clients.
         """
-        self._server.message_all("SOUT UPDATED\n")
+        self._server.message_all(MessageType.SOUT_UPDATED)
 
     def _setup_events(self):
         """
-        Attaches events to the MediaPlayer object, called when self._player is replaced.
+        Attaches events to the MediaPlayer object, called when self._player is replaced. The callbacks are given the
+        player so an event from one since replaced is ignored.
         """
         self.events = self._player.event_manager()
-        self.events.event_attach(vlc.EventType.MediaPlayerEndReached, self._end_reached)
-        self.events.event_attach(vlc.EventType.MediaPlayerEncounteredError, self._encountered_error)
+        self.events.event_attach(vlc.EventType.MediaPlayerEndReached, self._end_reached, self._player)
+        self.events.event_attach(vlc.EventType.MediaPlayerEncounteredError, self._encountered_error, self._player)
         self.events.event_attach(vlc.EventType.MediaPlayerMediaChanged, self._media_changed)
 
 
+    def _get_sout(self, transcode=True):
+        """
+        The sout for the current clients, or for the relay.
+        :param bool transcode: Transcode into the streaming profile, False for media already in it.
+        :rtype: str
+        """
+        if self._relay:
+            return VLCTools.generate_relay_sout(self._relay.address, transcode)
+        return VLCTools.generate_sout(self._server.clients, self._port, self._group, self._server.multicast_ttl,
+                                      transcode)
+
     def _get_vlc_media(self, uri):
         """
-        Creates a vlc_media object with the correct sout.
+        Creates a vlc_media object with the correct sout. The VLM engine keeps its output on the broadcast so is
+        given the URI itself. A copy from the transcode cache is streamed as it is in place of the URI.
 
         :param str uri: URI to create media object with.
         :return: vlc.Media
         """
-        cmd = VLCTools.generate_sout(self._server.clients, self._port)
+        if self._engine == Engine.VLM:
+            return uri
+        if self._engine == Engine.CROSSFADE:
+            #Decoded into the mixer, the output player has the sout
+            return vlc.Media(uri)
+        cached = self._transcoder.lookup(uri) if self._transcoder else None
+        if cached:
+            #Already in the streaming profile
+            self._log.info('Streaming transcoded copy {}'.format(cached))
+            return vlc.Media(cached, self._get_sout(transcode=False))
+        cmd = self._get_sout()
         print cmd
         return vlc.Media(uri, cmd)
 
+    def _get_mix_media(self):
+        """
+        Media for the crossfade engine's output player, the mix read from the pipe as raw audio.
+        :rtype: vlc.Media
+        """
+        return vlc.Media('fd://{}'.format(self._mix_fd), *(self._mixer.options() + [self._get_sout()]))
 
     def stop(self):
         """
         Stops current playback.
         """
-        if 0 <= self._player.stop():
-            self._now_playing = None
-            #TODO: Now playing will be out of sync here.
+        with self._lock:
+            self._discard_transition()
+            if 0 <= self._player.stop():
+                self._now_playing = None
+                self._sync_state(paused=False, position=None)
 
 
     def play(self):
         """
         Plays or resumes the current loaded media.
         """
-        #Check for loaded media
-        if not self._player.get_media():
-            self.next()
-            self._player.play()
-            return
-
-        state = self._player.get_state()
-        if state == vlc.State.Ended:
-            #Start next track
-            self.next()
-
-        elif state == vlc.State.Stopped:
-            #Repeat the current loaded track?
-            self._player.stop()
-            self._player.play()
-
-        elif state == vlc.State.Paused or state == vlc.State.NothingSpecial:
-            self._player.play()
+        with self._lock:
+            if self._output and self._output.get_state() != vlc.State.Playing:
+                self._output.play()
+            #Check for loaded media
+            if not self._player.get_media():
+                self.next()
+                self._player.play()
+                return
+
+            state = self._player.get_state()
+            if state == vlc.State.Ended:
+                #Start next track
+                self.next()
+
+            elif state == vlc.State.Stopped:
+                #Repeat the current loaded track?
+                self._player.stop()
+                self._player.play()
+
+            elif state == vlc.State.Paused or state == vlc.State.NothingSpecial:
+                self._player.play()
+            self._sync_state(paused=False)
+            #Rescheduled from where playback resumed
+            self._schedule_transition()
 
     @property
     def position(self):
@@ -457,6 +1656,11 @@ class MediaServer(object):
     @position.setter
     def position(self, value):
         self._player.set_position(float(value)/100)
+        self._server.message_all(MessageType.POSITION, value)
+        #VLC seeks in the background, the time read straight back is from before the seek
+        length = self._player.get_length()
+        self._sync_state(position=value / 100.0 * length / 1000.0 if length > 0 else self.time)
+        self._schedule_transition()
 
     def pause(self):
         """
@@ -464,6 +1668,7 @@ class MediaServer(object):
         it will have no effect.
         """
         self._player.set_pause(True)
+        self._sync_state(paused=True)
 
     @property
     def paused(self):
@@ -480,6 +1685,7 @@ class MediaServer(object):
     @paused.setter
     def paused(self, value):
         self._player.set_pause(value)
+        self._sync_state(paused=bool(value))
 
     @property
     def volume(self):
@@ -491,9 +1697,30 @@ class MediaServer(object):
 
     @volume.setter
     def volume(self, value):
-        self._server.message_all("VOLUME {}".format(value))
+        #Setting the volume overrides any ramp in progress
+        self._ramps.cancel()
+        self._server.message_all(MessageType.VOLUME, value)
         #TODO: Need to be able to control volume on each client
         self._player.audio_set_volume(value)
+        self._sync_state(volume=value)
+
+    def _set_player_volume(self, value):
+        self._player.audio_set_volume(value)
+
+    def ramp_volume(self, end, duration, curve=Curve.S_CURVE, on_complete=None):
+        """
+        Ramps the volume to end over duration seconds without blocking. Clients are sent a single RAMP message and
+        interpolate it themselves. A later ramp or volume change cancels this one.
+        :param int end: Final volume.
+        :param float duration: Length of the ramp in seconds.
+        :param int curve: One of ramp.Curve.
+        :param callable on_complete: Called once the ramp finishes, not called if it is cancelled.
+        """
+        #The player reports -1 without an audio output
+        ramp = Ramp(max(self.volume, 0), end, duration, curve)
+        self._server.message_all(MessageType.RAMP, ramp.encode())
+        self._ramps.start(ramp, on_complete)
+        self._sync_state(volume=end)
 
 
     @property
@@ -506,40 +1733,65 @@ class MediaServer(object):
     @time.setter
     def time(self, value):
         self._player.set_time(value*1000)
+        self._sync_state(position=value)
+        self._schedule_transition()
 
-    def fade_out(self):
+    def fade_out(self, duration=5.0, curve=Curve.LOG):
         """
-        Fades out volume and pauses media.
+        Fades out volume and pauses media, returns straight away while the fade runs.
+        :param float duration: Length of the fade in seconds.
+        :param int curve: One of ramp.Curve.
         """
         if self._player.get_state() == vlc.State.Playing:
             v = self.volume
-            while self.volume > 0:
-                self.volume -= 1
-                time.sleep(0.05)
-            self.pause()
-            self.volume = v
+
+            def faded():
+                self.pause()
+                self.volume = v
+
+            self.ramp_volume(0, duration, curve, faded)
 
 
     def update_stream_output(self):
         """
         Updates the list of clients the server is streaming to.
-        Media will pause briefly while the media with updated output
-        is loaded.
-        """
-        if not self._player.get_media():
-            return
-        playing = self._player.get_state() == vlc.State.Playing
-        if playing:
-            self.pause()
-
-        pos = self.position
-        uri = self.now_playing.get_uri()
-        m = self._get_vlc_media(uri)
-        self._player.set_media(m)
-
-        if playing:
-            self._player.play()
-            self.position = pos
+        With the relay only its destinations change, otherwise media will pause briefly while the media with updated
+        output is loaded. A prerolled track was opened with the old output, so it is thrown away and prerolled again.
+        """
+        with self._lock:
+            if self._relay:
+                destinations = [(client, self._port) for client in self._server.clients]
+                self._relay.set_destinations(destinations + [(self._group, self._port + 1)])
+                return
+            if self._engine == Engine.VLM:
+                self._player.set_output(self._get_sout())
+                return
+            if self._output:
+                #Tracks carry on decoding into the mix, only the output player reloads
+                playing = self._output.get_state() == vlc.State.Playing
+                self._output.set_media(self._get_mix_media())
+                if playing:
+                    self._output.play()
+                return
+            if not self._player.get_media():
+                return
+            playing = self._player.get_state() == vlc.State.Playing
+            if playing:
+                #Paused without telling clients, playback carries on from the same position
+                self._player.set_pause(True)
+
+            self._discard_transition()
+            pos = self.position
+            uri = self.now_playing.get_uri()
+            m = self._get_vlc_media(uri)
+            self._player.set_media(m)
+
+            if playing:
+                self._player.play()
+                #Not a seek, clients aren't sent a POSITION
+                if pos is not None:
+                    self._player.set_position(pos / 100)
+            self._schedule_transition()
 
 
 
@@ -547,7 +1799,19 @@ class MediaServer(object):
         """
         Causes all clients to restart, usually sorts any synchronisation issues.
         """
-        self._server.message_all("RESTART")
+        self._server.message_all(MessageType.RESTART)
+
+    def shutdown(self):
+        """
+        Stops playback, kills any conversions in progress and shuts down the relay and the control server.
+        """
+        self.stop()
+        self._state_timer.cancel()
+        if self._transcoder:
+            self._transcoder.stop()
+        if self._relay:
+            self._relay.stop()
+        self._server.shutdown()
 
 
 
@@ -555,26 +1819,27 @@ class MediaServer(object):
 
 
 
-logging.basicConfig(level=logging.INFO)
-server = MediaServer()
-#Load some fucking tracks
-playlist = (
-            "http://bbcmedia.ic.llnwd.net/stream/bbcmedia_lc1_radio1_p?s=1398175066&e=1398189466&h=6f82ebdc4806c8c259ff90e63f7f482d",
-            "/Users/charlie/Music/iTunes/iTunes Media/Music/Snow Patrol/Fallen Empires/02 Called Out In The Dark.mp3",
-            "http://icy-e-01.sharp-stream.com:80/tcnation.mp3",
-            "/Users/charlie/Music/iTunes/iTunes Media/Music/Arctic Monkeys/AM (Deluxe LP Edition)/11 Knee Socks.mp3",
-            "/Users/charlie/Music/iTunes/iTunes Media/Music/Athlete/Vehicles & Animals/01 El Salvador.mp3",
-            "/Users/charlie/Music/iTunes/iTunes Media/Music/Bon Iver/For Emma, Forever Ago/09 Re_ Stacks.mp3",
-            "/Users/charlie/Music/iTunes/iTunes Media/Music/The Killers/Sam's Town/03 When You Were Young.mp3",
-            "/Users/charlie/Music/iTunes/iTunes Media/Music/Of Monsters and Men/My Head Is an Animal/13 Numb Bears.mp3",
-            "/Users/charlie/Music/iTunes/iTunes Media/Music/Rhye/Woman/02 The Fall.mp3",
-            "/Users/charlie/Music/iTunes/iTunes Media/Music/Tycho/Dive/01 A Walk.mp3",
-)
-for t in playlist:
-    server.queue.append(media.TestMedia(t))
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    server = MediaServer()
+    #Load some fucking tracks
+    playlist = (
+                "http://bbcmedia.ic.llnwd.net/stream/bbcmedia_lc1_radio1_p?s=1398175066&e=1398189466&h=6f82ebdc4806c8c259ff90e63f7f482d",
+                "/Users/charlie/Music/iTunes/iTunes Media/Music/Snow Patrol/Fallen Empires/02 Called Out In The Dark.mp3",
+                "http://icy-e-01.sharp-stream.com:80/tcnation.mp3",
+                "/Users/charlie/Music/iTunes/iTunes Media/Music/Arctic Monkeys/AM (Deluxe LP Edition)/11 Knee Socks.mp3",
+                "/Users/charlie/Music/iTunes/iTunes Media/Music/Athlete/Vehicles & Animals/01 El Salvador.mp3",
+                "/Users/charlie/Music/iTunes/iTunes Media/Music/Bon Iver/For Emma, Forever Ago/09 Re_ Stacks.mp3",
+                "/Users/charlie/Music/iTunes/iTunes Media/Music/The Killers/Sam's Town/03 When You Were Young.mp3",
+                "/Users/charlie/Music/iTunes/iTunes Media/Music/Of Monsters and Men/My Head Is an Animal/13 Numb Bears.mp3",
+                "/Users/charlie/Music/iTunes/iTunes Media/Music/Rhye/Woman/02 The Fall.mp3",
+                "/Users/charlie/Music/iTunes/iTunes Media/Music/Tycho/Dive/01 A Walk.mp3",
+    )
+    for t in playlist:
+        server.queue.append(media.TestMedia(t))
 
 
-server.play()
+    server.play()
 
 
 
@@ -0,0 +1,256 @@
+"""
+Versioned playback state shared with clients.
+
+The server keeps a PlaybackState, every change bumps its sequence number and is sent to clients as a DELTA holding
+only the fields that changed. Clients are sent a SNAPSHOT of everything when they join, and whenever they ask with
+RESYNC. A StateMirror on the client applies them in order and notices a missing delta (the outbox drops frames for
+clients that fall behind) by a gap in the sequence numbers.
+
+Payloads are JSON:
+
+    SNAPSHOT    {"id": "3f2a...", "seq": 12, "state": {"now_playing": ..., "queue": [...], "volume": 80,
+                                                       "paused": false, "position": {"seconds": 61.2, "age": 0.004}}}
+    DELTA       {"seq": 13, "changes": {"volume": 60}}
+
+The position is an anchor rather than a stream of updates, the position in seconds and how long ago it was taken.
+Clients extrapolate from it while playing so it is only sent when playback jumps.
+
+The last few hundred deltas are kept in a ReplayBuffer. A client that reconnects sends RESUME with the state id and
+the last sequence number it applied, and is sent just the deltas it missed rather than a snapshot:
+
+    RESUME      {"id": "3f2a...", "seq": 12}
+"""
+import json
+import time
+import uuid
+import threading
+
+FIELDS = ('now_playing', 'queue', 'volume', 'paused', 'position')
+
+
+def describe(item):
+    """
+    The state entry for a media item. Items are told apart by the media objects identity rather than their URI,
+    get_uri() can hand out a one time URI so is only called to play the item.
+    :param media.AbstractMedia item: The item, may be None.
+    :rtype: dict
+    """
+    if item is None:
+        return None
+    return {
+        'id': '{:x}'.format(id(item)),
+        'title': item.title,
+        'artist': item.artist,
+        'album': item.album,
+        'artwork': item.artwork,
+    }
+
+
+class PlaybackState(object):
+    """
+    The servers playback state with a sequence number. Thread safe.
+    """
+
+    #A position within this many seconds of where playback should be by now isn't a change
+    POSITION_TOLERANCE = 0.5
+
+    def __init__(self, state_id=None, now=None):
+        """
+        :param str state_id: Identifies this state, so a client resuming after a server restart isn't sent deltas of
+        a different sequence. Defaults to a random id.
+        """
+        self.id = state_id or uuid.uuid4().hex
+        self.seq = 0
+        self._values = {'now_playing': None, 'queue': [], 'volume': None, 'paused': True, 'position': None}
+        self._anchor = time.time() if now is None else now
+        self._lock = threading.Lock()
+
+    def position_at(self, now):
+        """
+        Where playback is at a point in time, extrapolated from the anchor while playing.
+        :rtype: float
+        """
+        position = self._values['position']
+        if position is None or self._values['paused']:
+            return position
+        return position + max(now - self._anchor, 0)
+
+    def update(self, now=None, **changes):
+        """
+        Changes fields of the state. Fields that already have the value are left out, as is a position that matches
+        where playback should be by now.
+        :return: The delta to send clients, None if nothing changed.
+        :rtype: dict
+        :raises ValueError: For an unknown field.
+        """
+        now = time.time() if now is None else now
+        for key in changes:
+            if key not in FIELDS:
+                raise ValueError('Unknown state field {}'.format(key))
+        with self._lock:
+            expected = self.position_at(now)
+            changed = dict((k, v) for k, v in changes.items() if k != 'position' and self._values[k] != v)
+            position = changes.get('position', expected)
+            if position is not None and (expected is None or 'paused' in changed or
+                                         abs(position - expected) > self.POSITION_TOLERANCE):
+                changed['position'] = position
+            elif 'position' in changes and position is None and expected is not None:
+                changed['position'] = None
+            if not changed:
+                return None
+            self._values.update(changed)
+            if 'position' in changed:
+                self._anchor = now
+            self.seq += 1
+            return {'seq': self.seq, 'changes': self._encode(changed, now)}
+
+    def snapshot(self, now=None):
+        """
+        The whole state, as sent to a client that joins or resyncs.
+        :rtype: dict
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            return {'id': self.id, 'seq': self.seq, 'state': self._encode(self._values, now)}
+
+    def _encode(self, values, now):
+        values = dict(values)
+        if 'position' in values and values['position'] is not None:
+            values['position'] = {'seconds': values['position'], 'age': round(now - self._anchor, 3)}
+        return values
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+
+class ReplayBuffer(object):
+    """
+    A ring of the most recent encoded deltas, oldest overwritten first. Not thread safe.
+    """
+
+    def __init__(self, size=256):
+        """
+        :param int size: Number of deltas kept.
+        """
+        self._frames = [None] * size
+        self._seqs = [None] * size
+        self.last = 0
+
+    def __len__(self):
+        return len([seq for seq in self._seqs if seq is not None])
+
+    def append(self, seq, frame):
+        """
+        Adds a delta, seq must follow the last one added.
+        :param int seq: Sequence number of the delta.
+        :param bytes frame: The encoded DELTA frame.
+        """
+        i = seq % len(self._frames)
+        self._frames[i] = frame
+        self._seqs[i] = seq
+        self.last = seq
+
+    def since(self, seq):
+        """
+        The deltas after seq, for a client resuming from it.
+        :return: Frames in order, None if some have already been overwritten and a snapshot is needed.
+        :rtype: list
+        """
+        if seq > self.last or self.last - seq > len(self._frames):
+            return None
+        frames = []
+        for s in range(seq + 1, self.last + 1):
+            i = s % len(self._frames)
+            if self._seqs[i] != s:
+                return None
+            frames.append(self._frames[i])
+        return frames
+
+
+class StateMirror(object):
+    """
+    A clients copy of the servers PlaybackState, built from SNAPSHOT and DELTA messages.
+    """
+
+    def __init__(self, callback=None):
+        """
+        :param callable callback: Called with a dict of the fields that changed after each snapshot or delta.
+        """
+        self.id = None
+        self.seq = None
+        self.state = {}
+        self.callback = callback
+        self._anchor = None
+
+    @property
+    def synced(self):
+        """
+        True once a snapshot has been applied.
+        :rtype: bool
+        """
+        return self.seq is not None
+
+    def apply_snapshot(self, payload, now=None):
+        """
+        Replaces the state with a snapshot.
+        :param payload: The SNAPSHOT payload.
+        """
+        data = _load(payload)
+        self.id = data.get('id')
+        self.seq = data['seq']
+        self.state = {}
+        self._apply(data['state'], now)
+
+    def apply_delta(self, payload, now=None):
+        """
+        Applies a delta. Deltas already covered by the last snapshot are ignored.
+        :param payload: The DELTA payload.
+        :return: False if a delta was missed and a RESYNC is needed.
+        :rtype: bool
+        """
+        data = _load(payload)
+        if self.seq is None or data['seq'] <= self.seq:
+            #The snapshot sent on joining is on its way, or already includes this delta.
+            return True
+        if data['seq'] != self.seq + 1:
+            return False
+        self.seq = data['seq']
+        self._apply(data['changes'], now)
+        return True
+
+    def resume_payload(self):
+        """
+        The RESUME payload to send after reconnecting, None before the first snapshot.
+        :rtype: bytes
+        """
+        if self.seq is None:
+            return None
+        return json.dumps({'id': self.id, 'seq': self.seq}).encode('UTF-8')
+
+    def _apply(self, changes, now):
+        now = time.time() if now is None else now
+        changes = dict(changes)
+        position = changes.get('position')
+        if position is not None:
+            changes['position'] = position['seconds']
+            self._anchor = now - position['age']
+        self.state.update(changes)
+        if self.callback:
+            self.callback(changes)
+
+    def position(self, now=None):
+        """
+        Where playback should be, extrapolated from the last anchor while playing.
+        :rtype: float
+        """
+        position = self.state.get('position')
+        if position is None or self.state.get('paused'):
+            return position
+        now = time.time() if now is None else now
+        return position + max(now - self._anchor, 0)
+
+
+def _load(payload):
+    if isinstance(payload, memoryview):
+        payload = payload.tobytes()
+    return json.loads(payload.decode('UTF-8'))
@@ -0,0 +1,353 @@
+"""
+Transcodes queued tracks into the streaming profile ahead of time, so playback streams an already encoded file rather
+than transcoding live.
+
+A Transcoder watches the first few items of the queue and converts local files, each in its own VLC process started
+from a pool of threads. libvlc can't be forked once the server has its instance and threads, so conversions never use
+it in process. Results are kept in a TranscodeCache on disk, named by a hash of the source files
+content and the profile, so a renamed or duplicated file is only converted once and a changed file is converted again.
+The cache has a size budget and evicts the least recently played files first.
+"""
+import os
+import time
+import errno
+import urllib
+import urlparse
+import hashlib
+import logging
+import functools
+import threading
+import subprocess
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+#The sout transcode options every stream is sent in
+PROFILE = 'acodec=mp3,ab=320'
+EXTENSION = '.mp3'
+#The VLC executable conversions run in
+VLC = 'vlc'
+#Seconds between checks of a running conversion
+POLL_INTERVAL = 0.25
+#A conversion is given up on once it has run for the length of the track plus TIMEOUT_MARGIN seconds, converting any
+#slower is no use as the track could be transcoded live. UNKNOWN_TIMEOUT is used when the length isn't known.
+TIMEOUT_MARGIN = 30.0
+UNKNOWN_TIMEOUT = 30 * 60.0
+
+
+def local_path(uri):
+    """
+    The file a URI refers to.
+    :return: The path, None if the URI isn't a local file.
+    :rtype: str
+    """
+    parsed = urlparse.urlparse(uri)
+    if parsed.scheme == 'file':
+        path = urllib.url2pathname(parsed.path)
+    elif not parsed.scheme or len(parsed.scheme) == 1:
+        #A plain path, or a Windows drive letter
+        path = uri
+    else:
+        return None
+    return path if os.path.isfile(path) else None
+
+
+def content_key(path, profile=PROFILE, chunk_size=1 << 20):
+    """
+    The cache key of a file, a hash of its content and the profile it is converted to.
+    :rtype: str
+    """
+    digest = hashlib.sha1(profile.encode('UTF-8'))
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def vlc_transcode(source, destination, profile=PROFILE, cancel=None, length=None):
+    """
+    Converts a file in a VLC process, blocking until it is done or times out.
+    :param threading.Event cancel: Set to kill the conversion.
+    :param float length: Length of the track in seconds, the timeout is based on it.
+    :raises IOError: If VLC fails, doesn't write the file, times out or the conversion is cancelled.
+    :raises OSError: If VLC can't be run.
+    """
+    sout = '#transcode{{{0}}}:std{{access=file,mux=raw,dst="{1}"}}'.format(profile, destination)
+    cmd = [VLC, '--intf', 'dummy', '--quiet', '--no-video', source, '--sout', sout, 'vlc://quit']
+    deadline = time.time() + (length + TIMEOUT_MARGIN if length > 0 else UNKNOWN_TIMEOUT)
+    with open(os.devnull, 'wb') as null:
+        p = subprocess.Popen(cmd, stdin=null, stdout=null, stderr=null)
+        while p.poll() is None:
+            if cancel is not None and cancel.is_set():
+                error = 'Cancelled transcoding {}'
+            elif time.time() > deadline:
+                error = 'Timed out transcoding {}'
+            else:
+                time.sleep(POLL_INTERVAL)
+                continue
+            p.kill()
+            p.wait()
+            raise IOError(error.format(source))
+    if p.returncode or not os.path.isfile(destination):
+        raise IOError('VLC could not transcode {0}, exit status {1}'.format(source, p.returncode))
+
+
+def transcode(source, directory, profile=PROFILE, converter=vlc_transcode):
+    """
+    Converts a file into the cache directory unless it is already there. Runs on a worker thread.
+    :param str source: Path of the file.
+    :param str directory: The cache directory.
+    :return: The source, its modification time and size when it was hashed, its key and an error message or None.
+    :rtype: tuple
+    """
+    try:
+        stat = os.stat(source)
+        key = content_key(source, profile)
+        destination = os.path.join(directory, key + EXTENSION)
+        if not os.path.isfile(destination):
+            #Written under a temporary name so a partial file is never picked up, unique to the thread as two sources
+            #can have the same content
+            tmp = '{0}.{1}.{2}.tmp'.format(destination, os.getpid(), threading.current_thread().ident)
+            try:
+                converter(source, tmp, profile)
+                os.rename(tmp, destination)
+            except Exception:
+                #Not counted by the cache, so it mustn't be left behind
+                _remove(tmp)
+                raise
+        return source, stat.st_mtime, stat.st_size, key, None
+    except Exception as e:
+        #Pool callbacks only receive results, so errors are returned
+        return source, None, None, None, '{0}: {1}'.format(e.__class__.__name__, e)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            logging.getLogger('Transcoder').warning('Could not delete {0}: {1}'.format(path, e))
+
+
+class TranscodeCache(object):
+    """
+    Converted files on disk, named by content_key, with a size budget. Whenever the cache is over budget the least
+    recently used files are deleted. Use is recorded in the files modification time so it survives a restart. Thread
+    safe.
+    """
+
+    def __init__(self, directory, budget=2 * 1024 ** 3):
+        """
+        :param str directory: Directory to keep the files in, created if it doesn't exist.
+        :param int budget: Most bytes the cache holds.
+        """
+        self.directory = directory
+        self.budget = budget
+        self.log = logging.getLogger('TranscodeCache')
+        self._lock = threading.Lock()
+        #Key to size, least recently used first
+        self._entries = collections.OrderedDict()
+        self.size = 0
+        self._load()
+
+    def _load(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                #Left by a worker that was stopped part way
+                self._delete(path)
+            elif name.endswith(EXTENSION):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name[:-len(EXTENSION)], stat.st_size))
+        for mtime, key, size in sorted(files):
+            self._entries[key] = size
+            self.size += size
+        self._evict()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + EXTENSION)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Looks up a converted file and marks it as the most recently used.
+        :return: Its path, None if it isn't cached.
+        :rtype: str
+        """
+        with self._lock:
+            size = self._entries.pop(key, None)
+            if size is None:
+                return None
+            self._entries[key] = size
+        path = self.path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            #Deleted behind our back
+            with self._lock:
+                if self._entries.pop(key, None) is not None:
+                    self.size -= size
+            return None
+        return path
+
+    def add(self, key):
+        """
+        Records a file a worker has written to path(key) and evicts what no longer fits.
+        """
+        try:
+            size = os.path.getsize(self.path(key))
+        except OSError as e:
+            self.log.warning('Transcoded file missing {0}: {1}'.format(key, e))
+            return
+        with self._lock:
+            self.size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            evicted = []
+            while self.size > self.budget and len(self._entries) > 1:
+                key, size = self._entries.popitem(last=False)
+                self.size -= size
+                evicted.append(key)
+        for key in evicted:
+            self.log.debug('Evicting {}'.format(key))
+            self._delete(self.path(key))
+
+    def _delete(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                self.log.warning('Could not delete {0}: {1}'.format(path, e))
+
+
+class Transcoder(object):
+    """
+    Keeps the next few items of a queue converted in a TranscodeCache. The queue is checked periodically on the
+    scheduler, conversions are run from a thread pool.
+    """
+
+    def __init__(self, cache, queue, scheduler, ahead=3, processes=None, interval=2.0):
+        """
+        :param TranscodeCache cache: The cache to convert into.
+        :param media.Queue queue: The queue to watch.
+        :param scheduler.Scheduler scheduler: Scheduler to check the queue on.
+        :param int ahead: Number of queue items to keep converted.
+        :param int processes: Conversions run at once, defaults to one less than the number of CPUs so playback keeps
+        one.
+        :param float interval: Seconds between checks of the queue.
+        """
+        self.cache = cache
+        self.queue = queue
+        self.ahead = ahead
+        self.interval = interval
+        self.log = logging.getLogger('Transcoder')
+        self._processes = processes or max(multiprocessing.cpu_count() - 1, 1)
+        self._scheduler = scheduler
+        self._pool = None
+        self._timer = None
+        self._cancel = threading.Event()
+        self._pending = set()
+        #Sources that couldn't be converted, not tried again until they change
+        self._failed = {}
+        #Source path to its modification time, size and key when last converted
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._pool is None:
+            self._cancel.clear()
+            self._pool = ThreadPool(self._processes)
+            self._timer = self._scheduler.call_every(self.interval, self.update, first=time.time())
+
+    def stop(self):
+        """
+        Stops checking the queue and terminates conversions in progress.
+        """
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._pool:
+            self._cancel.set()
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def _key(self, path):
+        """
+        The cache key of a source file converted before, None if it changed since or hasn't been seen.
+        """
+        known = self._sources.get(path)
+        if known is None:
+            return None
+        mtime, size, key = known
+        return key if self._stat(path) == (mtime, size) else None
+
+    @staticmethod
+    def _stat(path):
+        """
+        The modification time and size of a file, None if it can't be read.
+        :rtype: tuple
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def update(self):
+        """
+        Starts converting the next ahead queue items that aren't cached or being converted.
+        """
+        if self._pool is None:
+            return
+        for item in self.queue[:self.ahead]:
+            path = local_path(item.get_uri())
+            if path is None:
+                continue
+            with self._lock:
+                if path in self._pending or self._failed.get(path) == self._stat(path):
+                    continue
+                key = self._key(path)
+                if key is not None and key in self.cache:
+                    continue
+                self._pending.add(path)
+            self.log.debug('Transcoding {}'.format(path))
+            converter = functools.partial(vlc_transcode, cancel=self._cancel, length=item.length)
+            self._pool.apply_async(transcode, (path, self.cache.directory, PROFILE, converter), callback=self._done)
+
+    def _done(self, result):
+        source, mtime, size, key, error = result
+        with self._lock:
+            self._pending.discard(source)
+            if error is None:
+                self._sources[source] = (mtime, size, key)
+            elif not self._cancel.is_set():
+                self._failed[source] = self._stat(source)
+        if error is None:
+            self.cache.add(key)
+        else:
+            self.log.warning('Could not transcode {0}: {1}'.format(source, error))
+
+    def lookup(self, uri):
+        """
+        The converted file for a URI.
+        :return: Its path, None if there isn't one.
+        :rtype: str
+        """
+        path = local_path(uri)
+        if path is None:
+            return None
+        with self._lock:
+            key = self._key(path)
+        return self.cache.get(key) if key else None
@@ -0,0 +1,92 @@
+"""
+Measures the cost of a broadcast from AsyncTCPServer.message_all against the number of connected clients.
+
+For each client count the server is started on loopback, the clients connect and a number of broadcasts are sent.
+Two figures are reported per broadcast:
+
+* call - time spent in message_all (encode once and queue the shared frame on every client).
+* delivery - time until every client has received the frame.
+
+Usage: python fanout.py [client counts...]
+"""
+import os
+import sys
+import time
+import select
+import socket
+import threading
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from partybox import server
+from partybox import protocol
+from partybox.protocol import MessageType
+
+BROADCASTS = 50
+PAYLOAD = 'http://icy-e-01.sharp-stream.com:80/tcnation.mp3'
+
+
+def connect_clients(address, count):
+    clients = []
+    for i in range(count):
+        s = socket.create_connection(address)
+        clients.append(s)
+    return clients
+
+
+def drain(clients, size):
+    """
+    Reads until size bytes have arrived on every client.
+    """
+    remaining = dict((s.fileno(), [s, size]) for s in clients)
+    poll = select.poll()
+    for fd in remaining:
+        poll.register(fd, select.POLLIN)
+    while remaining:
+        ready = poll.poll(5000)
+        if not ready:
+            raise RuntimeError('Timed out waiting for broadcast')
+        for fd, event in ready:
+            entry = remaining[fd]
+            entry[1] -= len(entry[0].recv(65536))
+            if entry[1] <= 0:
+                poll.unregister(fd)
+                del remaining[fd]
+
+
+def run(count):
+    srv = server.AsyncTCPServer(('127.0.0.1', 0))
+    t = threading.Thread(target=srv.serve_forever, args=(0.1,))
+    t.daemon = True
+    t.start()
+
+    clients = connect_clients(srv.server_address, count)
+    while len(srv._clients) < count:
+        time.sleep(0.01)
+    drain(clients, len(protocol.encode(MessageType.CONNECTED, '127.0.0.1')))
+
+    size = len(protocol.encode(MessageType.MEDIA_CHANGED, PAYLOAD))
+    call = delivery = 0.0
+    for i in range(BROADCASTS):
+        start = time.time()
+        srv.message_all(MessageType.MEDIA_CHANGED, PAYLOAD)
+        call += time.time() - start
+        drain(clients, size)
+        delivery += time.time() - start
+
+    for s in clients:
+        s.close()
+    srv.shutdown()
+    t.join(2)
+    return call / BROADCASTS, delivery / BROADCASTS
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    counts = [int(x) for x in sys.argv[1:]] or [1, 10, 50, 100, 250, 500, 1000]
+    print('{0:>8} {1:>12} {2:>12} {3:>14}'.format('clients', 'call (us)', 'delivery (ms)', 'per client (us)'))
+    for count in counts:
+        call, delivery = run(count)
+        print('{0:>8} {1:>12.1f} {2:>12.2f} {3:>14.2f}'.format(count, call * 1e6, delivery * 1e3,
+                                                               delivery * 1e6 / count))
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import unittest
+import json
+import uuid
+from partybox import announce
+
+
+def message(**now_playing):
+    msg = {
+        'TYPE': 'BROADCAST',
+        'ID': uuid.uuid4().hex,
+        'NAME': u'Charlie’s Party',
+        'PORT': 8234,
+        'RTP_PORT': 8234,
+        'MULTICAST_PORT': 8235,
+        'CLIENTS': 3,
+        'LOAD': 0.42,
+        'ALIVE_SINCE': 1400000000.5,
+        'ADDRESS': u'192.168.1.20',
+    }
+    if now_playing:
+        msg['NOW_PLAYING'] = now_playing
+    return {'PARTYBOX': msg}
+
+
+class AnnounceTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        msg = message(TITLE=u'Hyperballad', ARTIST=u'Bj\xf6rk', ALBUM=u'Post')
+        packet = announce.encode(msg)
+        self.assertEqual(announce.MAGIC, packet[:2])
+        self.assertLess(len(packet), len(json.dumps(msg)))
+        self.assertEqual(msg, announce.decode(packet))
+
+    def test_unknown_values(self):
+        msg = message()
+        del msg['PARTYBOX']['LOAD']
+        decoded = announce.decode(announce.encode(msg))['PARTYBOX']
+        self.assertIsNone(decoded['LOAD'])
+        self.assertEqual(3, decoded['CLIENTS'])
+
+    def test_fits_one_datagram(self):
+        msg = message(TITLE=u'\xe9' * 400, ARTIST=u'a' * 400, ALBUM=u'b' * 400, ARTWORK=u'http://x/' + u'c' * 400)
+        msg['PARTYBOX']['NONCE'] = 'abc'
+        packet = announce.encode(msg)
+        self.assertLessEqual(len(packet), announce.MAX_SIZE)
+        decoded = announce.decode(packet)['PARTYBOX']
+        self.assertEqual('abc', decoded['NONCE'])
+        #Cut on a character boundary rather than mid way through the two byte e acute.
+        self.assertEqual(u'\xe9' * 127, decoded['NOW_PLAYING']['TITLE'])
+        self.assertEqual(u'a' * 255, decoded['NOW_PLAYING']['ARTIST'])
+        #A cut URL would be broken, it is left out instead
+        self.assertNotIn('ARTWORK', decoded['NOW_PLAYING'])
+        self.assertEqual(u'192.168.1.20', decoded['ADDRESS'])
+
+    def test_structured_fields_whole(self):
+        artwork = u'http://x/' + u'c' * 240
+        msg = message(TITLE=u't' * 255, ARTIST=u'a' * 255, ALBUM=u'b' * 255, ARTWORK=artwork)
+        decoded = announce.decode(announce.encode(msg))['PARTYBOX']
+        #Less space is left than the URL needs
+        self.assertNotIn('ARTWORK', decoded['NOW_PLAYING'])
+        msg = message(TITLE=u't', ARTWORK=artwork)
+        self.assertEqual(artwork, announce.decode(announce.encode(msg))['PARTYBOX']['NOW_PLAYING']['ARTWORK'])
+        msg = message(TITLE=u't', ARTWORK=u'http://x/artwork.jpg')
+        decoded = announce.decode(announce.encode(msg))['PARTYBOX']
+        self.assertEqual(u'http://x/artwork.jpg', decoded['NOW_PLAYING']['ARTWORK'])
+
+    def test_truncate(self):
+        self.assertEqual(u'’'.encode('UTF-8'), announce.truncate(u'’’', 5))
+        self.assertEqual(b'abc', announce.truncate(u'abc', 5))
+
+    def test_json(self):
+        msg = message()
+        packet = announce.encode(msg, compact=False)
+        self.assertEqual(msg, json.loads(packet.decode('UTF-8')))
+        self.assertEqual(msg, announce.decode(packet))
+        #IDs that can't be packed fall back to JSON
+        legacy = {'PARTYBOX': {'TYPE': 'BROADCAST', 'ID': 'a', 'ALIVE_SINCE': 1.0}}
+        self.assertEqual(legacy, announce.decode(announce.encode(legacy)))
+
+    def test_unknown_fields_skipped(self):
+        msg = message()
+        packet = announce.encode(msg) + announce.FIELD.pack(99, 3) + b'xyz'
+        self.assertEqual(msg, announce.decode(packet))
+
+    def test_not_an_announce(self):
+        self.assertRaises(announce.AnnounceError, announce.decode, b'PA')
+        self.assertRaises(announce.AnnounceError, announce.decode, b'{"TYPE": "PROBE"}')
+        self.assertRaises(announce.AnnounceError, announce.decode, b'\xff\xfe')
+        self.assertRaises(announce.AnnounceError, announce.decode, b'PA\x09' + b'\0' * 40)
@@ -0,0 +1,266 @@
+import unittest
+import time
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import uuid
+from partybox import server
+from partybox.announce import encode as encode_announce
+from partybox.client import NetworkListener
+from partybox.discovery import DiscoveryRegistry, DiscoveryCache, ConnectRace, ServerInfo, ServerFound, ServerChanged, \
+    ServerLost
+from partybox.scheduler import Scheduler
+
+
+def announce(server_id, load=0, nonce=None):
+    msg = {'TYPE': 'BROADCAST', 'ID': server_id, 'NAME': 'party', 'PORT': 8234, 'LOAD': load, 'ALIVE_SINCE': 100.0}
+    if nonce:
+        msg['NONCE'] = nonce
+    return msg
+
+
+class DiscoveryRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.registry = DiscoveryRegistry(ttl=30, scheduler=self.scheduler)
+        self.events = []
+        self.registry.register_callback((ServerFound, ServerChanged, ServerLost), self.on_event)
+
+    def tearDown(self):
+        self.registry.stop()
+
+    def on_event(self, event):
+        self.events.append(event)
+
+    def wait_events(self, count, timeout=2):
+        start = time.time()
+        while len(self.events) < count and time.time() - start < timeout:
+            time.sleep(0.005)
+        self.assertEqual(count, len(self.events))
+
+    def test_found_changed_lost(self):
+        self.registry.update(announce('a'), '10.0.0.1', now=110)
+        self.registry.update(announce('a'), '10.0.0.1', now=111)
+        self.registry.update(announce('a', load=3), '10.0.0.1', now=112)
+        self.wait_events(2)
+        self.assertEqual([ServerFound, ServerChanged], [type(e) for e in self.events])
+
+        info = self.registry.get('a')
+        self.assertEqual(('10.0.0.1', 8234), info.address)
+        self.assertEqual(3, info.load)
+        self.assertEqual(12, info.uptime)
+
+        self.registry.expire(now=130)
+        self.assertEqual(1, len(self.registry.servers))
+        self.registry.expire(now=143)
+        self.wait_events(3)
+        self.assertIsInstance(self.events[-1], ServerLost)
+        self.assertEqual([], self.registry.servers)
+
+    def test_announced_address(self):
+        self.registry.update(dict(announce('a'), ADDRESS='10.0.1.1'), '10.0.0.1')
+        self.assertEqual(('10.0.1.1', 8234), self.registry.get('a').address)
+
+    def test_ignores_probes(self):
+        self.assertIsNone(self.registry.update({'TYPE': 'PROBE', 'NONCE': 'x'}, '10.0.0.1'))
+        self.assertEqual([], self.registry.servers)
+
+    def test_ignores_announce_without_port(self):
+        msg = announce('a')
+        del msg['PORT']
+        self.assertIsNone(self.registry.update(msg, '10.0.0.1'))
+        self.assertEqual([], self.registry.servers)
+
+    def test_ignores_unhashable_fields(self):
+        msg = announce('a')
+        msg['ID'] = ['a']
+        self.assertIsNone(self.registry.update(msg, '10.0.0.1'))
+        self.assertIsNone(self.registry.update(announce('a', nonce={'n': 1}), '10.0.0.1'))
+        self.assertEqual([], self.registry.servers)
+
+    def test_rtt_and_order(self):
+        self.registry.probe_sent('n1', now=10)
+        self.registry.update(announce('a', load=5, nonce='n1'), '10.0.0.1', now=10.02)
+        self.registry.update(announce('b', load=1), '10.0.0.2', now=10.03)
+        self.assertAlmostEqual(0.02, self.registry.get('a').rtt)
+        self.assertIsNone(self.registry.get('b').rtt)
+        self.assertEqual(['b', 'a'], [s.id for s in self.registry.servers])
+
+
+class NetworkListenerTest(unittest.TestCase):
+
+    def test_discovers_announcer(self):
+        found = []
+        listener = NetworkListener(0, callback=found.append)
+        announcer = server.UDPAnnounce(('127.0.0.1', listener.port), {'PARTYBOX': announce('a')}, probe_address=False)
+        listener.start()
+        announcer.start()
+        try:
+            info = listener.wait_for_server(2)
+            self.assertEqual('a', info.id)
+            self.assertEqual(('127.0.0.1', 8234), info.address)
+        finally:
+            announcer.stop()
+            listener.stop()
+
+    def test_compact_announce(self):
+        listener = NetworkListener(0)
+        server_id = uuid.uuid4().hex
+        msg = {'PARTYBOX': dict(announce('a', load=0.5), ID=server_id, CLIENTS=2, NOW_PLAYING={'TITLE': 'Song'})}
+        announcer = server.UDPAnnounce(('127.0.0.1', listener.port), msg, probe_address=False,
+                                       encoder=encode_announce)
+        listener.start()
+        announcer.start()
+        try:
+            info = listener.wait_for_server(2)
+            self.assertEqual(server_id, info.id)
+            self.assertEqual(2, info.clients)
+            self.assertEqual(0.5, info.load)
+            self.assertEqual({'TITLE': 'Song'}, info.now_playing)
+        finally:
+            announcer.stop()
+            listener.stop()
+
+
+class DiscoveryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache', 'servers.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def server(self, server_id, last_seen):
+        server = ServerInfo(server_id, ('10.0.0.1', 8234), last_seen)
+        server.name = 'party'
+        return server
+
+    def test_persists(self):
+        now = time.time()
+        cache = DiscoveryCache(self.path)
+        cache.remember(self.server('a', now - 10))
+        cache.remember(self.server('b', now))
+        servers = DiscoveryCache(self.path).servers()
+        self.assertEqual(['b', 'a'], [s.id for s in servers])
+        self.assertEqual(('10.0.0.1', 8234), servers[0].address)
+        self.assertEqual('party', servers[0].name)
+
+    def test_limits(self):
+        now = time.time()
+        cache = DiscoveryCache(self.path, max_entries=2, max_age=60)
+        cache.remember(self.server('a', now - 100))
+        cache.remember(self.server('b', now - 5))
+        cache.remember(self.server('c', now))
+        self.assertEqual(['c', 'b'], [s.id for s in cache.servers()])
+        self.assertEqual(['c'], [s.id for s in cache.servers(now=now + 58)])
+
+    def test_track_saves_on_change(self):
+        cache = DiscoveryCache(self.path)
+        saves = []
+        cache.save = lambda: saves.append(1)
+        registry = DiscoveryRegistry(scheduler=Scheduler())
+        cache.track(registry)
+
+        def wait_for(host):
+            start = time.time()
+            while not cache.servers() or cache.servers()[0].address[0] != host:
+                self.assertLess(time.time() - start, 2)
+                time.sleep(0.005)
+
+        try:
+            registry.update(announce('a'), '10.0.0.1')
+            wait_for('10.0.0.1')
+            registry.update(announce('a', load=1), '10.0.0.1')
+            registry.update(announce('a', load=2), '10.0.0.1')
+            time.sleep(0.05)
+            registry.update(announce('a', load=2), '10.0.0.2')
+            wait_for('10.0.0.2')
+        finally:
+            registry.stop()
+        #Found and moved, the load changes aren't written
+        self.assertEqual(2, len(saves))
+
+    def test_corrupt_file(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        self.assertEqual([], DiscoveryCache(self.path).servers())
+
+
+class ConnectRaceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        #A port with nothing listening, connections are refused.
+        refused = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        refused.bind(('127.0.0.1', 0))
+        self.refused = refused.getsockname()
+        refused.close()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_first_to_connect(self):
+        race = ConnectRace()
+        race.add(self.refused)
+        race.add(self.server.getsockname())
+        race.add(self.server.getsockname())
+        connected = None
+        start = time.time()
+        while connected is None and time.time() - start < 2:
+            connected = race.poll(0.05)
+        race.close()
+        sock, address = connected
+        self.assertEqual(self.server.getsockname(), address)
+        self.assertEqual(0, len(race))
+        sock.close()
+
+    def test_listener_connects_to_cached_server(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            cache = DiscoveryCache(os.path.join(tmp, 'servers.json'))
+            cache.remember(ServerInfo('a', self.server.getsockname()))
+            listener = NetworkListener(0)
+            try:
+                sock, server = listener.connect(cache, timeout=2)
+            finally:
+                listener.stop()
+            self.assertEqual('a', server.id)
+            sock.close()
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_server_starts_late(self):
+        #Nothing is listening on the cached address for the first attempts
+        tmp = tempfile.mkdtemp()
+        late = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        late.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        def listen():
+            late.bind(self.refused)
+            late.listen(5)
+
+        timer = threading.Timer(0.5, listen)
+        try:
+            cache = DiscoveryCache(os.path.join(tmp, 'servers.json'))
+            cache.remember(ServerInfo('a', self.refused))
+            listener = NetworkListener(0)
+            timer.start()
+            try:
+                connected = listener.connect(cache, timeout=3)
+            finally:
+                listener.stop()
+            self.assertIsNotNone(connected)
+            sock, server = connected
+            self.assertEqual('a', server.id)
+            sock.close()
+        finally:
+            timer.cancel()
+            late.close()
+            shutil.rmtree(tmp)
@@ -0,0 +1,84 @@
+import unittest
+from partybox import vlc
+from partybox.engine import VLMBroadcast
+
+
+class FakeEvent(object):
+
+    def __init__(self, event_type, name):
+        self.type = event_type
+        self.u = type('EventUnion', (object,), {'filename': name})()
+
+
+class RecordingInstance(object):
+    """
+    Records the VLM calls made on it, in place of a vlc.Instance.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.callbacks = {}
+
+    def vlm_get_event_manager(self):
+        return self
+
+    def event_attach(self, event_type, callback):
+        self.callbacks[event_type] = callback
+
+    def emit(self, event_type, name=b'partybox'):
+        self.callbacks[event_type](FakeEvent(event_type, name))
+
+    def __getattr__(self, name):
+        def call(*args):
+            self.calls.append((name,) + args)
+            return 0
+        return call
+
+
+class VLMBroadcastTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instance = RecordingInstance()
+        self.broadcast = VLMBroadcast(self.instance, ':sout=#transcode{acodec=mp3}:rtp{dst=127.0.0.1,port=5004}')
+        self.events = []
+        for event_type in (vlc.EventType.MediaPlayerMediaChanged, vlc.EventType.MediaPlayerEndReached):
+            self.broadcast.event_manager().event_attach(event_type, lambda e, t=event_type: self.events.append(t))
+
+    def test_switches_input(self):
+        self.broadcast.set_media('file:///a.mp3')
+        self.broadcast.play()
+        self.instance.emit(vlc.EventType.VlmMediaInstanceStatusPlaying)
+        self.assertEqual(vlc.State.Playing, self.broadcast.get_state())
+        self.broadcast.set_media('file:///b.mp3')
+        self.assertEqual('file:///b.mp3', self.broadcast.get_media().get_mrl())
+        self.assertEqual([
+            ('vlm_add_broadcast', 'partybox', 'file:///a.mp3', '#transcode{acodec=mp3}:rtp{dst=127.0.0.1,port=5004}', 0,
+             None, True, False),
+            ('vlm_play_media', 'partybox'),
+            ('vlm_set_input', 'partybox', 'file:///b.mp3'),
+            ('vlm_play_media', 'partybox'),
+        ], self.instance.calls)
+        self.assertEqual([vlc.EventType.MediaPlayerMediaChanged] * 2, self.events)
+
+    def test_events(self):
+        self.broadcast.set_media('file:///a.mp3')
+        self.instance.emit(vlc.EventType.VlmMediaInstanceStatusEnd, b'other')
+        self.assertEqual(vlc.State.NothingSpecial, self.broadcast.get_state())
+        self.instance.emit(vlc.EventType.VlmMediaInstanceStatusEnd)
+        self.assertEqual(vlc.State.Ended, self.broadcast.get_state())
+        self.assertEqual(vlc.EventType.MediaPlayerEndReached, self.events[-1])
+
+    def test_pause_and_output(self):
+        self.broadcast.set_pause(True)
+        self.assertEqual([], self.instance.calls)
+        self.broadcast.set_media('file:///a.mp3')
+        self.instance.emit(vlc.EventType.VlmMediaInstanceStatusPlaying)
+        self.broadcast.set_pause(True)
+        self.broadcast.set_pause(True)
+        self.assertEqual(vlc.State.Paused, self.broadcast.get_state())
+        self.broadcast.play()
+        self.assertEqual(2, len([c for c in self.instance.calls if c[0] == 'vlm_pause_media']))
+        del self.instance.calls[:]
+        self.broadcast.set_output('#rtp{dst=10.0.0.2,port=5004}')
+        self.assertEqual(('vlm_set_output', 'partybox', '#rtp{dst=10.0.0.2,port=5004}'), self.instance.calls[0])
+        self.assertIn(('vlm_play_media', 'partybox'), self.instance.calls)
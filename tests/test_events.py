@@ -0,0 +1,66 @@
+import unittest
+import threading
+from partybox import events
+
+
+class Joined(events.Event):
+
+    def __init__(self, n):
+        events.Event.__init__(self)
+        self.n = n
+
+
+class Left(events.Event):
+    pass
+
+
+class EventBusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = events.EventBus(workers=4)
+
+    def tearDown(self):
+        self.bus.stop()
+
+    def test_in_order(self):
+        received = []
+        done = threading.Event()
+
+        def callback(event):
+            received.append(event.n)
+            if event.n == 99:
+                done.set()
+
+        self.bus.subscribe(Joined, callback)
+        self.bus.subscribe(Left, self.fail)
+        for i in range(100):
+            self.bus.publish(Joined(i))
+        self.assertTrue(done.wait(2))
+        self.assertEqual(list(range(100)), received)
+
+    def test_coalesce(self):
+        received = []
+        started = threading.Event()
+        release = threading.Event()
+        done = threading.Event()
+
+        def callback(event):
+            started.set()
+            release.wait(2)
+            received.append(event)
+            if isinstance(event, Left):
+                done.set()
+
+        subscription = self.bus.subscribe((Joined, Left), callback, coalesce=True)
+        self.bus.publish(Joined(0))
+        started.wait(2)
+        #A burst while the first event is being handled is delivered once, as the latest event.
+        for i in range(1, 50):
+            self.bus.publish(Joined(i))
+        last = Left()
+        self.bus.publish(last)
+        release.set()
+        self.assertTrue(done.wait(2))
+        self.assertEqual(2, len(received))
+        self.assertIs(last, received[1])
+        self.assertEqual(49, subscription.coalesced)
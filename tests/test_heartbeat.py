@@ -0,0 +1,64 @@
+import unittest
+import time
+from partybox.heartbeat import Heartbeat
+from partybox.scheduler import Scheduler
+
+
+class FakeHandler(object):
+
+    def __init__(self, heartbeat, answer=True, delay=0):
+        self.client_address = ('10.0.0.2', 5000)
+        self.heartbeat = heartbeat
+        self.answer = answer
+        self.delay = delay
+        self.pings = 0
+
+    def message(self, msg_type, payload):
+        self.pings += 1
+        if not self.answer:
+            return
+        if self.delay:
+            self.heartbeat.scheduler.call_later(self.delay, self.heartbeat.pong, self, payload)
+        else:
+            self.heartbeat.pong(self, payload)
+
+
+class HeartbeatTest(unittest.TestCase):
+
+    def setUp(self):
+        self.removed = []
+        self.scheduler = Scheduler(tick=0.005)
+        self.scheduler.start()
+        self.heartbeat = Heartbeat(self, self.scheduler, interval=0.02, misses=2)
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def remove_client(self, address):
+        self.removed.append(address)
+
+    def test_dead_client_removed(self):
+        handler = FakeHandler(self.heartbeat, answer=False)
+        self.heartbeat.add(handler)
+        time.sleep(0.2)
+        self.assertEqual([handler.client_address], self.removed)
+        self.assertEqual(2, handler.pings)
+
+    def test_rtt(self):
+        handler = FakeHandler(self.heartbeat)
+        self.heartbeat.add(handler)
+        time.sleep(0.1)
+        self.heartbeat.remove(handler)
+        self.assertEqual([], self.removed)
+        self.assertTrue(handler.pings >= 2)
+        self.assertTrue(0 <= handler.liveness.rtt < 0.1)
+        self.assertEqual(0, handler.liveness.missed)
+
+    def test_slow_client_kept(self):
+        #Every reply arrives after the next ping has been sent
+        handler = FakeHandler(self.heartbeat, delay=0.03)
+        self.heartbeat.add(handler)
+        time.sleep(0.2)
+        self.heartbeat.remove(handler)
+        self.assertEqual([], self.removed)
+        self.assertTrue(handler.pings >= 5)
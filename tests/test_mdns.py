@@ -0,0 +1,71 @@
+import unittest
+import socket
+import struct
+from partybox import mdns
+from partybox.mdns import Message, Question, Record, RecordType, DNSSDResponder
+
+
+class MessageTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        message = Message(7, mdns.RESPONSE, [Question('_partybox._tcp.local.', RecordType.PTR, True)], [
+            Record('_partybox._tcp.local.', RecordType.PTR, 'party._partybox._tcp.local.'),
+            Record('party._partybox._tcp.local.', RecordType.SRV, (0, 0, 8234, 'box.local.'), cache_flush=True),
+            Record('party._partybox._tcp.local.', RecordType.TXT, {'id': 'abc', 'version': '1'}),
+            Record('box.local.', RecordType.A, '10.0.0.5'),
+        ])
+        decoded = Message.decode(message.encode())
+        self.assertEqual(7, decoded.id)
+        self.assertTrue(decoded.is_response)
+        self.assertTrue(decoded.questions[0].unicast)
+        self.assertEqual([RecordType.PTR, RecordType.SRV, RecordType.TXT, RecordType.A],
+                         [r.type for r in decoded.answers])
+        self.assertEqual('party._partybox._tcp.local.', decoded.answers[0].data)
+        self.assertEqual((0, 0, 8234, 'box.local.'), decoded.answers[1].data)
+        self.assertTrue(decoded.answers[1].cache_flush)
+        self.assertEqual({'id': 'abc', 'version': '1'}, decoded.answers[2].data)
+        self.assertEqual('10.0.0.5', decoded.answers[3].data)
+
+    def test_compressed_names(self):
+        #A question for box.local. followed by a PTR record whose name points back at it.
+        packet = mdns.HEADER.pack(0, 0x8400, 1, 1, 0, 0) + mdns.encode_name('box.local.') + mdns.QUESTION.pack(1, 1)
+        packet += struct.pack('!H', 0xC000 | mdns.HEADER.size) + mdns.RECORD.pack(RecordType.PTR, 1, 120, 6)
+        packet += b'\x03www' + struct.pack('!H', 0xC000 | mdns.HEADER.size)
+        decoded = Message.decode(packet)
+        self.assertEqual('box.local.', decoded.answers[0].name)
+        self.assertEqual('www.box.local.', decoded.answers[0].data)
+
+    def test_malformed(self):
+        self.assertRaises(mdns.DNSError, Message.decode, b'\0\0')
+        loop = mdns.HEADER.pack(0, 0, 1, 0, 0, 0) + struct.pack('!H', 0xC000 | mdns.HEADER.size)
+        self.assertRaises(mdns.DNSError, Message.decode, loop)
+
+
+class DNSSDResponderTest(unittest.TestCase):
+
+    def test_answer(self):
+        responder = DNSSDResponder('party', 8234, {'id': 'abc'})
+        query = Message(questions=[Question(mdns.SERVICE, RecordType.PTR)])
+        response, unicast = responder.answer(query, '10.0.0.5')
+        self.assertFalse(unicast)
+        self.assertEqual([RecordType.PTR], [r.type for r in response.answers])
+        self.assertEqual(3, len(response.additionals))
+        self.assertIsNone(responder.answer(Message(questions=[Question('_http._tcp.local.', RecordType.PTR)]),
+                                           '10.0.0.5'))
+
+    def test_query_over_loopback(self):
+        #Find a free port for the group so the test doesn't need the real mDNS port.
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(('', 0))
+        group = (mdns.MDNS_GROUP, s.getsockname()[1])
+        s.close()
+        responder = DNSSDResponder('party', 8234, {'id': 'abc'}, group=group, interface='127.0.0.1')
+        responder.start()
+        try:
+            services = mdns.query(timeout=2, group=group, interface='127.0.0.1', first=True)
+        finally:
+            responder.stop()
+        self.assertEqual(1, len(services))
+        self.assertEqual('party', services[0].name)
+        self.assertEqual(('127.0.0.1', 8234), (services[0].address, services[0].port))
+        self.assertEqual('abc', services[0].txt['id'])
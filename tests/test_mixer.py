@@ -0,0 +1,80 @@
+import unittest
+import os
+import struct
+from partybox.mixer import Mixer
+from partybox.ramp import Ramp
+
+
+def samples(*values):
+    return struct.pack('={}h'.format(len(values)), *values)
+
+
+def unpack(data):
+    return list(struct.unpack('={}h'.format(len(data) // 2), data))
+
+
+class MixerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.read_fd, write_fd = os.pipe()
+        self.mixer = Mixer(write_fd, rate=4, channels=1, max_buffer=1.0)
+
+    def tearDown(self):
+        os.close(self.read_fd)
+        os.close(self.mixer.fd)
+
+    def read(self, size):
+        return unpack(os.read(self.read_fd, size * 2))
+
+    def test_single_source(self):
+        source = self.mixer.add()
+        self.mixer.write(source, samples(1, 2, 3))
+        self.assertEqual(self.read(3), [1, 2, 3])
+
+    def test_mix(self):
+        clock = self.mixer.add()
+        other = self.mixer.add()
+        #Buffered until the clock writes
+        self.mixer.write(other, samples(10, 20))
+        self.mixer.write(clock, samples(1, 2, 3))
+        self.assertEqual(self.read(3), [11, 22, 3])
+
+    def test_gain(self):
+        clock = self.mixer.add(Ramp(100, 100, 0))
+        other = self.mixer.add(Ramp(50, 50, 0))
+        self.mixer.write(other, samples(100, -100))
+        self.mixer.write(clock, samples(0, 0))
+        self.assertEqual(self.read(2), [50, -50])
+
+    def test_clipping(self):
+        clock = self.mixer.add()
+        other = self.mixer.add()
+        self.mixer.write(other, samples(30000))
+        self.mixer.write(clock, samples(30000))
+        self.assertEqual(self.read(1), [32767])
+
+    def test_handover(self):
+        clock = self.mixer.add()
+        other = self.mixer.add()
+        self.mixer.write(other, samples(1, 2))
+        self.mixer.remove(clock)
+        #The backlog is written as the new clock takes over
+        self.assertEqual(self.read(2), [1, 2])
+        self.mixer.write(other, samples(3))
+        self.assertEqual(self.read(1), [3])
+
+    def test_max_buffer(self):
+        self.mixer.add()
+        other = self.mixer.add()
+        self.mixer.write(other, samples(1, 2, 3, 4, 5, 6))
+        #One second at 4Hz, the oldest are dropped
+        self.assertEqual(other.dropped, 4)
+        self.assertEqual(unpack(other.drain()), [3, 4, 5, 6])
+
+    def test_removed_source(self):
+        clock = self.mixer.add()
+        other = self.mixer.add()
+        self.mixer.remove(other)
+        self.mixer.write(other, samples(5))
+        self.mixer.write(clock, samples(1))
+        self.assertEqual(self.read(1), [1])
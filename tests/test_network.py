@@ -0,0 +1,191 @@
+import unittest
+import socket
+import time
+import os
+import shutil
+import tempfile
+from partybox import network
+from partybox.network import NetworkUtils
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class MulticastTest(unittest.TestCase):
+
+    def test_is_multicast(self):
+        self.assertTrue(NetworkUtils.is_multicast(network.DISCOVERY_GROUP))
+        self.assertTrue(NetworkUtils.is_multicast('224.0.0.1'))
+        self.assertFalse(NetworkUtils.is_multicast('10.0.0.1'))
+        self.assertFalse(NetworkUtils.is_multicast('not an address'))
+
+    def test_zone_group(self):
+        self.assertEqual('239.255.43.1', network.zone_group())
+        self.assertEqual(network.zone_group('kitchen'), network.zone_group('kitchen'))
+        self.assertNotEqual(network.zone_group(), network.zone_group('kitchen'))
+        self.assertTrue(network.zone_group('kitchen').startswith(network.STREAM_GROUP_PREFIX))
+
+    def test_send_and_receive_over_loopback(self):
+        port = free_port()
+        receivers = [NetworkUtils.multicast_receiver(network.DISCOVERY_GROUP, port, '127.0.0.1') for i in range(2)]
+        sender = NetworkUtils.multicast_sender('127.0.0.1')
+        try:
+            sender.sendto(b'hello', (network.DISCOVERY_GROUP, port))
+            for receiver in receivers:
+                receiver.settimeout(2)
+                self.assertEqual(b'hello', receiver.recv(1024))
+            #A socket that has left the group no longer gets its packets.
+            NetworkUtils.leave_group(receivers[0], network.DISCOVERY_GROUP, '127.0.0.1')
+            sender.sendto(b'again', (network.DISCOVERY_GROUP, port))
+            self.assertEqual(b'again', receivers[1].recv(1024))
+            receivers[0].settimeout(0.1)
+            self.assertRaises(socket.timeout, receivers[0].recv, 1024)
+        finally:
+            sender.close()
+            for receiver in receivers:
+                receiver.close()
+
+    def test_local_address(self):
+        self.assertEqual('127.0.0.1', NetworkUtils.local_address('127.0.0.1'))
+
+
+ARP = """IP address       HW type     Flags       HW address            Mask     Device
+192.168.1.1      0x1         0x2         AA:BB:CC:DD:EE:01     *        eth0
+192.168.1.20     0x1         0x2         aa:bb:cc:dd:ee:14     *        wlan0
+192.168.1.30     0x1         0x0         00:00:00:00:00:00     *        eth0
+"""
+
+ROUTE = """Iface\tDestination\tGateway \tFlags\tRefCnt\tUse\tMetric\tMask\t\tMTU\tWindow\tIRTT
+eth0\t00000000\t0101A8C0\t0003\t0\t0\t100\t00000000\t0\t0\t0
+wlan0\t00000000\t0101A8C0\t0003\t0\t0\t600\t00000000\t0\t0\t0
+eth0\t0001A8C0\t00000000\t0001\t0\t0\t100\t00FFFFFF\t0\t0\t0
+wlan0\t0000FFEF\t00000000\t0001\t0\t0\t0\t0000FFFF\t0\t0\t0
+eth1\t0000000A\t00000000\t0000\t0\t0\t0\t000000FF\t0\t0\t0
+"""
+
+
+class ProcNetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+        class Utils(NetworkUtils):
+            ARP_PATH = os.path.join(self.dir, 'arp')
+            ROUTE_PATH = os.path.join(self.dir, 'route')
+            _cache = network.TTLCache()
+
+            @classmethod
+            def _nudge(cls, addresses):
+                cls.nudged = sorted(addresses)
+
+        self.utils = Utils
+        with open(Utils.ARP_PATH, 'w') as f:
+            f.write(ARP)
+        with open(Utils.ROUTE_PATH, 'w') as f:
+            f.write(ROUTE)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_arp_table(self):
+        table = network.read_arp_table(self.utils.ARP_PATH)
+        #Incomplete entries are skipped
+        self.assertEqual({'192.168.1.1': 'aa:bb:cc:dd:ee:01', '192.168.1.20': 'aa:bb:cc:dd:ee:14'}, table)
+
+    def test_route_table(self):
+        routes = network.read_route_table(self.utils.ROUTE_PATH)
+        #Down routes are skipped, the most specific first
+        self.assertEqual(['eth0', 'wlan0', 'eth0', 'wlan0'], [r[0] for r in routes])
+        self.assertEqual(network._ip_to_int('192.168.1.0'), routes[0][1])
+        self.assertEqual(network._ip_to_int('192.168.1.1'), routes[2][3])
+
+    def test_route_for(self):
+        self.assertEqual('eth0', self.utils.route_for('192.168.1.20'))
+        self.assertEqual('wlan0', self.utils.route_for('239.255.42.99'))
+        #The default route with the lowest metric
+        self.assertEqual('eth0', self.utils.route_for('8.8.8.8'))
+        self.assertEqual('wlan0', self.utils.active_device())
+
+    def test_get_mac_addrs(self):
+        self.assertEqual('aa:bb:cc:dd:ee:14', self.utils.get_mac_addr('192.168.1.20'))
+        macs = self.utils.get_mac_addrs(['192.168.1.1', '192.168.1.30'], timeout=0.05)
+        self.assertEqual({'192.168.1.1': 'aa:bb:cc:dd:ee:01', '192.168.1.30': None}, macs)
+        self.assertEqual(['192.168.1.30'], self.utils.nudged)
+        self.assertRaises(network.ARPException, self.utils.get_mac_addr, '192.168.1.30', 0.01)
+
+    def test_cached(self):
+        self.assertIn('192.168.1.1', self.utils.arp_table())
+        with open(self.utils.ARP_PATH, 'w') as f:
+            f.write(ARP.splitlines()[0])
+        self.assertIn('192.168.1.1', self.utils.arp_table())
+        self.assertEqual({}, self.utils.arp_table(refresh=True))
+
+    def test_local_subnets(self):
+        self.assertEqual(['192.168.1.0/24'], self.utils.local_subnets())
+
+
+class ProberTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_subnet_hosts(self):
+        hosts = network.subnet_hosts('192.168.1.0/24')
+        self.assertEqual(254, len(hosts))
+        self.assertEqual(('192.168.1.1', '192.168.1.254'), (hosts[0], hosts[-1]))
+        self.assertEqual(['10.0.0.5'], network.subnet_hosts('10.0.0.5/32'))
+        self.assertEqual(['10.0.0.4', '10.0.0.5'], network.subnet_hosts('10.0.0.5/31'))
+        self.assertRaises(ValueError, network.subnet_hosts, '10.0.0.0/33')
+
+    def test_tcp(self):
+        #Loopback answers on every 127/8 address, refused connections count as up.
+        hosts = ['127.0.0.1', '127.0.0.2', '127.0.0.3']
+        results = NetworkUtils.probe_hosts(hosts, self.port, concurrency=2)
+        self.assertEqual(set(hosts), set(results))
+        for host in hosts:
+            self.assertIsNotNone(results[host])
+
+    def test_udp(self):
+        results = NetworkUtils.probe_hosts(['127.0.0.1'], free_port(), network.ProbeMethod.UDP)
+        self.assertIsNotNone(results['127.0.0.1'])
+
+    def test_timeout(self):
+        #TEST-NET-1 isn't routed, the probe times out or fails straight away.
+        start = time.time()
+        results = NetworkUtils.probe_hosts(['192.0.2.123'], self.port, timeout=0.2)
+        self.assertIsNone(results['192.0.2.123'])
+        self.assertLess(time.time() - start, 1)
+
+    def test_subnet(self):
+        results = NetworkUtils.probe_subnet(self.port, '127.0.0.0/28', timeout=0.5)
+        self.assertEqual(14, len(results))
+
+    def test_large_subnet_skipped(self):
+        class Utils(NetworkUtils):
+            probed = []
+
+            @classmethod
+            def local_subnets(cls):
+                return ['127.0.0.0/28', '10.0.0.0/8', '169.254.0.0/16']
+
+            @classmethod
+            def probe_hosts(cls, hosts, *args):
+                cls.probed.extend(hosts)
+                return NetworkUtils.probe_hosts(hosts, *args)
+
+        results = Utils.probe_subnet(self.port, timeout=0.5)
+        self.assertEqual(14, len(results))
+        self.assertEqual(network.subnet_hosts('127.0.0.0/28'), Utils.probed)
+        self.assertEqual({}, Utils.probe_subnet(self.port, '127.0.0.0/16', timeout=0.5))
+        self.assertEqual(30, len(Utils.probe_subnet(self.port, '127.0.0.0/27', timeout=0.5, min_prefix=27)))
@@ -0,0 +1,94 @@
+import unittest
+import threading
+import time
+from partybox import protocol
+from partybox.protocol import MessageType
+from partybox.outbox import Outbox, OverflowPolicy, Coalescer
+from partybox.scheduler import Scheduler
+
+
+class OutboxTest(unittest.TestCase):
+
+    def test_drop_oldest(self):
+        outbox = Outbox(high_water=3, policy=OverflowPolicy.DROP_OLDEST)
+        frames = [protocol.encode(MessageType.VOLUME, i) for i in range(5)]
+        for frame in frames:
+            self.assertTrue(outbox.put(frame))
+        self.assertEqual(frames[2:], outbox.pop())
+        self.assertEqual(2, outbox.stats()['dropped'])
+        self.assertEqual(0, outbox.stats()['depth'])
+
+    def test_coalesce(self):
+        outbox = Outbox(high_water=2, policy=OverflowPolicy.COALESCE)
+        media = protocol.encode(MessageType.MEDIA_CHANGED, 'track.mp3')
+        outbox.put(media)
+        outbox.put(protocol.encode(MessageType.VOLUME, 10))
+        outbox.put(protocol.encode(MessageType.VOLUME, 20))
+        self.assertEqual([media, protocol.encode(MessageType.VOLUME, 20)], outbox.pop())
+        self.assertEqual(1, outbox.coalesced)
+        self.assertEqual(0, outbox.dropped)
+
+    def test_disconnect(self):
+        outbox = Outbox(high_water=2, policy=OverflowPolicy.DISCONNECT, disconnect_after=0)
+        frame = protocol.encode(MessageType.RESTART)
+        self.assertTrue(outbox.put(frame))
+        self.assertTrue(outbox.put(frame))
+        self.assertFalse(outbox.put(frame))
+        self.assertEqual(3, len(outbox))
+        #Catching up clears the high water mark
+        outbox.pop()
+        self.assertTrue(outbox.put(frame))
+
+    def test_keyed(self):
+        outbox = Outbox(keyed_types=(MessageType.VOLUME,))
+        media = protocol.encode(MessageType.MEDIA_CHANGED, 'track.mp3')
+        for i in range(100):
+            outbox.put(protocol.encode(MessageType.VOLUME, i))
+        outbox.put(media)
+        outbox.put(protocol.encode(MessageType.VOLUME, 100))
+        outbox.put(protocol.encode(MessageType.VOLUME, 101))
+        #Only the latest value is sent, and a value queued after another frame stays behind it.
+        self.assertEqual([protocol.encode(MessageType.VOLUME, 99), media, protocol.encode(MessageType.VOLUME, 101)],
+                         outbox.pop())
+        self.assertEqual(100, outbox.coalesced)
+        outbox.put(protocol.encode(MessageType.VOLUME, 5))
+        self.assertEqual([protocol.encode(MessageType.VOLUME, 5)], outbox.pop())
+
+    def test_blocking_pop(self):
+        outbox = Outbox()
+        frame = protocol.encode(MessageType.RESTART)
+        threading.Timer(0.05, outbox.put, args=(frame,)).start()
+        self.assertEqual([frame], outbox.pop(block=True, timeout=2))
+        threading.Timer(0.05, outbox.close).start()
+        self.assertEqual([], outbox.pop(block=True))
+
+
+class CoalescerTest(unittest.TestCase):
+
+    def test_latest_wins(self):
+        scheduler = Scheduler(tick=0.005)
+        scheduler.start()
+        sent = []
+        coalescer = Coalescer(sent.append, scheduler, window=0.05)
+        for i in range(100):
+            coalescer.put(MessageType.VOLUME, i)
+        coalescer.put(MessageType.POSITION, 50)
+        self.assertEqual([0, 50], sent)
+        time.sleep(0.15)
+        scheduler.stop()
+        self.assertEqual([0, 50, 99], sent)
+        self.assertEqual(98, coalescer.coalesced)
+
+    def test_flush(self):
+        scheduler = Scheduler(tick=0.005)
+        scheduler.start()
+        sent = []
+        coalescer = Coalescer(sent.append, scheduler, window=0.05)
+        coalescer.put(MessageType.VOLUME, 1)
+        coalescer.put(MessageType.VOLUME, 2)
+        #A RAMP must not overtake the held back volume
+        coalescer.flush()
+        sent.append('ramp')
+        time.sleep(0.1)
+        scheduler.stop()
+        self.assertEqual([1, 2, 'ramp'], sent)
@@ -0,0 +1,45 @@
+import unittest
+import socket
+from partybox import protocol
+from partybox.protocol import MessageType
+
+
+class FrameDecoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = protocol.FrameDecoder(size=16)
+
+    def decode(self):
+        return [(t, p.tobytes()) for t, p in self.decoder.frames()]
+
+    def test_split_frames(self):
+        data = protocol.encode(MessageType.CONNECTED, '10.0.0.2') + protocol.encode(MessageType.VOLUME, 40)
+        received = []
+        #Feed one byte at a time, frames must only appear once complete.
+        for i in range(len(data)):
+            self.decoder.feed(data[i:i + 1])
+            received.extend(self.decode())
+        self.assertEqual([(MessageType.CONNECTED, b'10.0.0.2'), (MessageType.VOLUME, b'40')], received)
+
+    def test_joined_frames(self):
+        frames = [protocol.encode(MessageType.MEDIA_CHANGED, 'x' * 100), protocol.encode(MessageType.RESTART)]
+        self.decoder.feed(b''.join(frames))
+        self.assertEqual([(MessageType.MEDIA_CHANGED, b'x' * 100), (MessageType.RESTART, b'')], self.decode())
+
+    def test_bad_frame(self):
+        self.decoder.feed(b'VOLUME 40')
+        self.assertRaises(protocol.ProtocolError, self.decode)
+
+        decoder = protocol.FrameDecoder()
+        decoder.feed(protocol.HEADER.pack(protocol.MAGIC, protocol.VERSION + 1, MessageType.RESTART, 0))
+        self.assertRaises(protocol.ProtocolError, list, decoder.frames())
+
+    def test_recv_into(self):
+        a, b = socket.socketpair()
+        a.sendall(protocol.encode(MessageType.VOLUME, 12) * 10)
+        a.close()
+        received = []
+        while self.decoder.recv_into(b):
+            received.extend(self.decode())
+        b.close()
+        self.assertEqual([(MessageType.VOLUME, b'12')] * 10, received)
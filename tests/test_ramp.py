@@ -0,0 +1,63 @@
+import unittest
+import threading
+from partybox import ramp
+from partybox.ramp import Ramp, RampScheduler, Curve
+from partybox.scheduler import Scheduler
+
+
+class RampTest(unittest.TestCase):
+
+    def test_curves(self):
+        for curve in ramp.CURVES.values():
+            self.assertAlmostEqual(0, curve(0))
+            self.assertAlmostEqual(1, curve(1))
+            values = [curve(x / 10.0) for x in range(11)]
+            self.assertEqual(sorted(values), values)
+
+    def test_value_at(self):
+        r = Ramp(100, 0, 2.0, Curve.LINEAR, t0=10)
+        self.assertEqual(100, r.value_at(5))
+        self.assertEqual(50, r.value_at(11))
+        self.assertEqual(0, r.value_at(20))
+        self.assertTrue(r.done(12))
+
+    def test_encode(self):
+        r = Ramp(80, 20, 1.5, Curve.S_CURVE, t0=100.25)
+        decoded = Ramp.decode(r.encode(now=100.0), now=500.0)
+        self.assertEqual((80, 20, 1.5, Curve.S_CURVE), (decoded.start, decoded.end, decoded.duration, decoded.curve))
+        self.assertAlmostEqual(500.25, decoded.t0)
+
+    def test_encode_clamped(self):
+        decoded = Ramp.decode(Ramp(-1, 300, 1).encode())
+        self.assertEqual((0, 255), (decoded.start, decoded.end))
+
+
+class RampSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler(tick=0.005)
+        self.scheduler.start()
+        self.values = []
+        self.ramps = RampScheduler(self.scheduler, self.values.append, step=0.01)
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def test_run(self):
+        done = threading.Event()
+        self.ramps.start(Ramp(0, 100, 0.1), done.set)
+        self.assertTrue(done.wait(2))
+        self.assertEqual(100, self.values[-1])
+        self.assertEqual(sorted(self.values), self.values)
+        self.assertEqual(None, self.ramps.active)
+
+    def test_override(self):
+        done = threading.Event()
+        self.ramps.start(Ramp(0, 100, 5), self.fail)
+        self.ramps.start(Ramp(50, 10, 0.05), done.set)
+        self.assertTrue(done.wait(2))
+        self.assertEqual(10, self.values[-1])
+
+        self.ramps.start(Ramp(10, 90, 5), self.fail)
+        self.ramps.cancel()
+        self.assertEqual(None, self.ramps.active)
@@ -0,0 +1,73 @@
+import unittest
+import socket
+import time
+from partybox import relay
+from partybox.relay import RTPRelay
+
+
+class RTPRelayTest(unittest.TestCase):
+
+    use_mmsg = True
+
+    def setUp(self):
+        if self.use_mmsg and relay._mmsg is None:
+            self.skipTest('recvmmsg and sendmmsg not available')
+        self.relay = RTPRelay(use_mmsg=self.use_mmsg)
+        self.relay.start()
+        self.source = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receivers = []
+
+    def tearDown(self):
+        self.relay.stop()
+        self.source.close()
+        for r in self.receivers:
+            r.close()
+
+    def receiver(self):
+        r = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        r.bind(('127.0.0.1', 0))
+        r.settimeout(2)
+        self.receivers.append(r)
+        return r
+
+    def wait_for(self, condition, timeout=2):
+        start = time.time()
+        while not condition() and time.time() - start < timeout:
+            time.sleep(0.01)
+        return condition()
+
+    def send(self, *packets):
+        for packet in packets:
+            self.source.sendto(packet, self.relay.address)
+
+    def test_fan_out(self):
+        a, b = self.receiver(), self.receiver()
+        self.relay.add(a.getsockname())
+        self.relay.add(b.getsockname())
+        packets = [b'packet %d ' % i * (i + 1) for i in range(100)]
+        self.send(*packets)
+        for r in (a, b):
+            self.assertEqual(packets, [r.recv(2048) for p in packets])
+        self.assertTrue(self.wait_for(lambda: self.relay.packets == 100))
+        self.assertEqual(sum(len(p) for p in packets), self.relay.bytes)
+
+    def test_change_destinations(self):
+        a, b = self.receiver(), self.receiver()
+        self.relay.set_destinations([a.getsockname()])
+        self.send(b'one')
+        self.assertEqual(b'one', a.recv(2048))
+        self.relay.set_destinations([b.getsockname()])
+        self.assertEqual([b.getsockname()], self.relay.destinations)
+        self.send(b'two')
+        self.assertEqual(b'two', b.recv(2048))
+        a.settimeout(0.1)
+        self.assertRaises(socket.timeout, a.recv, 2048)
+
+    def test_no_destinations(self):
+        self.send(b'dropped')
+        self.assertTrue(self.wait_for(lambda: self.relay.packets == 1))
+
+
+class FallbackRelayTest(RTPRelayTest):
+
+    use_mmsg = False
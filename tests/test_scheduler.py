@@ -0,0 +1,71 @@
+import unittest
+import threading
+import time
+from partybox.scheduler import TimingWheel, Scheduler
+
+
+class TimingWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = TimingWheel(tick=0.01, slots=8, now=100.0)
+
+    def fired(self, timers):
+        return [timer.callback for timer in timers]
+
+    def test_advance(self):
+        self.wheel.schedule(100.05, 'b')
+        self.wheel.schedule(100.02, 'a')
+        #Several laps of the wheel away
+        self.wheel.schedule(100.5, 'c')
+        self.assertEqual(3, len(self.wheel))
+
+        self.assertEqual([], self.fired(self.wheel.advance(100.01)))
+        self.assertEqual(['a', 'b'], self.fired(self.wheel.advance(100.1)))
+        self.assertEqual([], self.fired(self.wheel.advance(100.4)))
+        self.assertEqual(['c'], self.fired(self.wheel.advance(100.5)))
+        self.assertEqual(0, len(self.wheel))
+
+    def test_cancel(self):
+        timer = self.wheel.schedule(100.03, 'a')
+        timer.cancel()
+        self.assertEqual([], self.wheel.advance(101))
+        self.assertEqual(0, len(self.wheel))
+
+    def test_past_deadline(self):
+        self.wheel.schedule(50, 'a')
+        self.assertEqual(['a'], self.fired(self.wheel.advance(100.01)))
+
+    def test_next_timeout(self):
+        self.assertEqual(None, self.wheel.next_timeout(100))
+        self.wheel.schedule(100.03, 'a')
+        self.assertAlmostEqual(0.03, self.wheel.next_timeout(100))
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_call_later(self):
+        scheduler = Scheduler()
+        scheduler.start()
+        fired = threading.Event()
+        cancelled = scheduler.call_later(0.02, self.fail)
+        scheduler.call_later(0.05, fired.set)
+        cancelled.cancel()
+        self.assertTrue(fired.wait(2))
+        scheduler.stop()
+
+    def test_call_every(self):
+        scheduler = Scheduler(tick=0.005)
+        scheduler.start()
+        runs = []
+        start = time.time()
+        periodic = scheduler.call_every(0.02, lambda: runs.append(time.time()), first=start)
+        time.sleep(0.21)
+        periodic.cancel()
+        count = len(runs)
+        time.sleep(0.05)
+        scheduler.stop()
+
+        self.assertEqual(count, len(runs))
+        self.assertTrue(10 <= count <= 12)
+        #Runs stay on the original grid instead of drifting by the callback time
+        self.assertTrue(abs(runs[-1] - (start + (count - 1) * 0.02)) < 0.015)
@@ -0,0 +1,302 @@
+import unittest
+import socket
+import threading
+import time
+import json
+import asyncore
+from partybox import server
+from partybox import protocol
+from partybox import network
+from partybox.network import NetworkUtils
+from partybox.protocol import MessageType
+from partybox.scheduler import Scheduler
+
+
+class LoopbackServer(server.AsyncTCPServer):
+    #Kept off the real network, no mDNS on 5353 and announces only on loopback
+    dns_sd = False
+    multicast_interface = '127.0.0.1'
+
+
+class AsyncTCPServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LoopbackServer(('127.0.0.1', 0))
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.sockets = []
+        self.decoders = {}
+
+    def tearDown(self):
+        for s in self.sockets:
+            s.close()
+        self.server.shutdown()
+        self.thread.join(2)
+
+    def connect(self):
+        s = socket.create_connection(self.server.server_address)
+        s.settimeout(2)
+        self.sockets.append(s)
+        return s
+
+    def receive(self, s, count):
+        #Frames that arrive together with those asked for are kept for the next call
+        decoder = self.decoders.setdefault(s, protocol.FrameDecoder())
+        frames = self.decoders.setdefault((s, 'pending'), [])
+        while len(frames) < count and decoder.recv_into(s):
+            frames.extend((t, p.tobytes()) for t, p in decoder.frames())
+        received = frames[:count]
+        del frames[:count]
+        return received
+
+    def wait_for(self, condition, timeout=2):
+        start = time.time()
+        while not condition() and time.time() - start < timeout:
+            time.sleep(0.01)
+        return condition()
+
+    def test_message_all(self):
+        clients = [self.connect() for i in range(50)]
+        self.assertTrue(self.wait_for(lambda: len(self.server._clients) == 50))
+        for s in clients:
+            self.assertEqual([MessageType.CONNECTED, MessageType.SNAPSHOT], [t for t, p in self.receive(s, 2)])
+
+        self.server.message_all(MessageType.VOLUME, 40)
+        for s in clients:
+            self.assertEqual([(MessageType.VOLUME, b'40')], self.receive(s, 1))
+        self.assertEqual(['127.0.0.1'], self.server.clients)
+
+    def test_state(self):
+        self.server.update_state(volume=80)
+        s = self.connect()
+        self.assertEqual(MessageType.CONNECTED, self.receive(s, 1)[0][0])
+        msg_type, payload = self.receive(s, 1)[0]
+        self.assertEqual(MessageType.SNAPSHOT, msg_type)
+        snapshot = json.loads(payload.decode('UTF-8'))
+        self.assertEqual(1, snapshot['seq'])
+        self.assertEqual(80, snapshot['state']['volume'])
+        self.server.update_state(volume=60)
+        self.server.update_state(volume=60)
+        self.server.update_state(paused=False)
+        deltas = [json.loads(p.decode('UTF-8')) for t, p in self.receive(s, 2)]
+        self.assertEqual([{'seq': 2, 'changes': {'volume': 60}}, {'seq': 3, 'changes': {'paused': False}}], deltas)
+
+        s.sendall(protocol.encode(MessageType.RESYNC))
+        msg_type, payload = self.receive(s, 1)[0]
+        self.assertEqual(MessageType.SNAPSHOT, msg_type)
+        self.assertEqual(3, json.loads(payload.decode('UTF-8'))['seq'])
+
+    def test_resume(self):
+        self.server.update_state(volume=80)
+        s = self.connect()
+        snapshot = json.loads(self.receive(s, 2)[1][1].decode('UTF-8'))
+        s.close()
+        self.assertTrue(self.wait_for(lambda: not self.server._clients))
+        self.server.update_state(volume=60)
+        self.server.update_state(paused=False)
+
+        #Resuming from the snapshot is sent only the missed deltas
+        s = self.connect()
+        s.sendall(protocol.encode(MessageType.RESUME, json.dumps({'id': snapshot['id'], 'seq': snapshot['seq']})))
+        frames = self.receive(s, 3)
+        self.assertEqual([MessageType.CONNECTED, MessageType.DELTA, MessageType.DELTA], [t for t, p in frames])
+        self.assertEqual([2, 3], [json.loads(p.decode('UTF-8'))['seq'] for t, p in frames[1:]])
+        self.server.update_state(volume=50)
+        self.assertEqual(4, json.loads(self.receive(s, 1)[0][1].decode('UTF-8'))['seq'])
+
+        #Too far behind, or a different server, gets a snapshot
+        self.server._replay = server.ReplayBuffer(2)
+        for volume in range(5):
+            self.server.update_state(volume=volume)
+        for state_id, seq in ((snapshot['id'], 1), ('other', 8)):
+            s = self.connect()
+            s.sendall(protocol.encode(MessageType.RESUME, json.dumps({'id': state_id, 'seq': seq})))
+            self.assertEqual([MessageType.CONNECTED, MessageType.SNAPSHOT], [t for t, p in self.receive(s, 2)])
+
+    def test_disconnect_event(self):
+        disconnected = threading.Event()
+        self.server.register_callback(server.TCPServerEvent.ClientDisconnected, lambda e: disconnected.set())
+
+        s = self.connect()
+        s.recv(1024)
+        s.close()
+        self.assertTrue(disconnected.wait(2))
+        self.assertEqual(0, len(self.server._clients))
+
+    def test_heartbeat(self):
+        self.server.heartbeat.interval = 0.05
+        s = self.connect()
+        self.assertEqual(MessageType.CONNECTED, self.receive(s, 1)[0][0])
+        msg_type, payload = self.receive(s, 1)[0]
+        if msg_type == MessageType.SNAPSHOT:
+            msg_type, payload = self.receive(s, 1)[0]
+        self.assertEqual(MessageType.PING, msg_type)
+        s.sendall(protocol.encode(MessageType.PONG, payload))
+        self.assertTrue(self.wait_for(lambda: list(self.server.client_stats().values())[0]['rtt'] is not None))
+
+        #Stop answering pings
+        removed = self.wait_for(lambda: not self.server._clients)
+        self.assertTrue(removed)
+
+
+class UDPAnnounceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def test_announce(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(2)
+        announcer = server.UDPAnnounce(listener.getsockname(), {'PARTYBOX': {'TYPE': 'BROADCAST'}}, interval=0.02,
+                                       probe_address=False, scheduler=self.scheduler)
+        announcer.start()
+        try:
+            self.assertEqual({'PARTYBOX': {'TYPE': 'BROADCAST'}}, json.loads(listener.recv(1024)))
+            announcer.message = {'PARTYBOX': {'TYPE': 'BROADCAST', 'NAME': 'Party'}}
+            while json.loads(listener.recv(1024))['PARTYBOX'].get('NAME') != 'Party':
+                pass
+        finally:
+            announcer.stop()
+            listener.close()
+
+    def test_fast_start(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(2)
+        announcer = server.UDPAnnounce(listener.getsockname(), {'PARTYBOX': {'TYPE': 'BROADCAST'}}, interval=10,
+                                       min_interval=0.02, probe_address=False, scheduler=self.scheduler)
+        start = time.time()
+        announcer.start()
+        try:
+            #Sent straight away then at 20, 60 and 140ms before backing off towards the steady interval.
+            for i in range(4):
+                listener.recv(1024)
+            self.assertLess(time.time() - start, 0.5)
+            announcer.message = {'PARTYBOX': {'TYPE': 'BROADCAST', 'NAME': 'Party'}}
+            self.assertEqual('Party', json.loads(listener.recv(1024))['PARTYBOX']['NAME'])
+            self.assertLess(time.time() - start, 1)
+        finally:
+            announcer.stop()
+            listener.close()
+
+    def test_probe(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(2)
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        probe_address = probe.getsockname()
+        probe.close()
+        announcer = server.UDPAnnounce(listener.getsockname(), {'PARTYBOX': {'TYPE': 'BROADCAST'}}, interval=10,
+                                       min_interval=0.01, probe_address=probe_address, scheduler=self.scheduler)
+        announcer.start()
+        try:
+            #Wait out the fast start burst.
+            time.sleep(0.3)
+            listener.settimeout(0)
+            try:
+                while listener.recv(1024):
+                    pass
+            except socket.error:
+                pass
+            listener.settimeout(2)
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sender.sendto(json.dumps({'PARTYBOX': {'TYPE': 'PROBE', 'NONCE': 'abc'}}).encode('UTF-8'), probe_address)
+            sender.close()
+            self.assertEqual('abc', json.loads(listener.recv(1024))['PARTYBOX']['NONCE'])
+        finally:
+            announcer.stop()
+            listener.close()
+
+    def test_probe_on_event_loop(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(0.01)
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        probe_address = probe.getsockname()
+        probe.close()
+        socket_map = {}
+        announcer = server.UDPAnnounce(listener.getsockname(), {'PARTYBOX': {'TYPE': 'BROADCAST'}}, interval=10,
+                                       min_interval=0.01, probe_address=probe_address, socket_map=socket_map,
+                                       scheduler=self.scheduler)
+        announcer.start()
+        try:
+            self.assertEqual(1, len(socket_map))
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sender.sendto(json.dumps({'PARTYBOX': {'TYPE': 'PROBE', 'NONCE': 'abc'}}).encode('UTF-8'), probe_address)
+            sender.close()
+            nonce = None
+            end = time.time() + 2
+            while nonce is None and time.time() < end:
+                asyncore.loop(timeout=0.01, use_poll=True, map=socket_map, count=1)
+                try:
+                    nonce = json.loads(listener.recv(1024))['PARTYBOX'].get('NONCE')
+                except socket.error:
+                    pass
+            self.assertEqual('abc', nonce)
+        finally:
+            announcer.stop()
+            listener.close()
+        self.assertEqual({}, socket_map)
+
+    def test_interfaces(self):
+        #Each interface announces from its own socket with its own address, new interfaces are found by rescanning.
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(2)
+        interfaces = ['127.0.0.1']
+        announcer = server.UDPAnnounce(listener.getsockname(), {'PARTYBOX': {'TYPE': 'BROADCAST'}}, interval=0.05,
+                                       min_interval=0.01, probe_address=False, interface=lambda: interfaces,
+                                       rescan_interval=0.05, scheduler=self.scheduler)
+        announcer.start()
+        try:
+            data, source = listener.recvfrom(1024)
+            self.assertEqual('127.0.0.1', json.loads(data)['PARTYBOX']['ADDRESS'])
+            self.assertEqual('127.0.0.1', source[0])
+            interfaces = ['127.0.0.1', '127.0.0.2']
+            seen = {}
+            while len(seen) < 2:
+                data, source = listener.recvfrom(1024)
+                seen[json.loads(data)['PARTYBOX']['ADDRESS']] = source[0]
+            self.assertEqual({'127.0.0.1': '127.0.0.1', '127.0.0.2': '127.0.0.2'}, seen)
+            self.assertEqual(['127.0.0.1', '127.0.0.2'], sorted(announcer.interfaces))
+        finally:
+            announcer.stop()
+            listener.close()
+
+    def test_multicast_probe(self):
+        #Announces and probes both go over a multicast group on the loopback interface.
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(('', 0))
+        group = (network.DISCOVERY_GROUP, s.getsockname()[1])
+        s.close()
+        listener = NetworkUtils.multicast_receiver(group[0], group[1], '127.0.0.1')
+        listener.settimeout(2)
+        announcer = server.UDPAnnounce(group, {'PARTYBOX': {'TYPE': 'BROADCAST'}}, interval=10, min_interval=0.01,
+                                       interface='127.0.0.1', scheduler=self.scheduler)
+        announcer.start()
+        try:
+            time.sleep(0.3)
+            listener.settimeout(0)
+            try:
+                while listener.recv(1024):
+                    pass
+            except socket.error:
+                pass
+            listener.settimeout(2)
+            listener.sendto(json.dumps({'PARTYBOX': {'TYPE': 'PROBE', 'NONCE': 'xyz'}}).encode('UTF-8'), group)
+            while True:
+                msg = json.loads(listener.recv(1024))['PARTYBOX']
+                if msg['TYPE'] == 'BROADCAST':
+                    break
+            self.assertEqual('xyz', msg['NONCE'])
+        finally:
+            announcer.stop()
+            listener.close()
@@ -0,0 +1,110 @@
+import unittest
+import json
+from partybox.state import PlaybackState, StateMirror, ReplayBuffer, describe
+from partybox.media import TestMedia
+
+
+class OneTimeMedia(TestMedia):
+
+    def get_uri(self):
+        raise AssertionError('URI spent')
+
+
+class PlaybackStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state = PlaybackState(now=100)
+
+    def test_deltas(self):
+        self.assertEqual({'seq': 1, 'changes': {'volume': 80}}, self.state.update(volume=80, now=100))
+        self.assertIsNone(self.state.update(volume=80, now=101))
+        delta = self.state.update(volume=60, paused=False, now=102)
+        self.assertEqual(2, delta['seq'])
+        self.assertEqual({'volume': 60, 'paused': False}, delta['changes'])
+        self.assertRaises(ValueError, self.state.update, colour='red')
+
+    def test_describe(self):
+        item = OneTimeMedia('a.mp3')
+        self.assertEqual(describe(item), describe(item))
+        self.assertNotEqual(describe(item)['id'], describe(OneTimeMedia('a.mp3'))['id'])
+        self.assertIsNone(describe(None))
+
+    def test_position_anchor(self):
+        self.state.update(paused=False, position=10, now=100)
+        #Where playback should be by now, nothing to send
+        self.assertIsNone(self.state.update(position=15.2, now=105))
+        self.assertEqual(15, self.state.position_at(105))
+        #A seek
+        delta = self.state.update(position=60, now=106)
+        self.assertEqual({'position': {'seconds': 60, 'age': 0}}, delta['changes'])
+        #Pausing anchors the position, which then stays put
+        delta = self.state.update(paused=True, now=110)
+        self.assertEqual({'paused': True, 'position': {'seconds': 64, 'age': 0}}, delta['changes'])
+        self.assertEqual(64, self.state.position_at(200))
+
+    def test_snapshot(self):
+        self.state.update(volume=80, paused=False, position=0, now=100)
+        snapshot = self.state.snapshot(now=102)
+        self.assertEqual(1, snapshot['seq'])
+        self.assertEqual({'seconds': 0, 'age': 2}, snapshot['state']['position'])
+        self.assertEqual(80, snapshot['state']['volume'])
+        self.assertEqual([], snapshot['state']['queue'])
+
+
+class StateMirrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state = PlaybackState(now=100)
+        self.changes = []
+        self.mirror = StateMirror(self.changes.append)
+
+    def send(self, data):
+        return json.dumps(data).encode('UTF-8')
+
+    def test_snapshot_and_deltas(self):
+        self.state.update(volume=80, paused=False, position=30, now=100)
+        #Sent before the snapshot, already part of it
+        early = self.state.update(volume=70, now=100)
+        self.assertTrue(self.mirror.apply_delta(self.send(early)))
+        self.assertFalse(self.mirror.synced)
+        self.mirror.apply_snapshot(memoryview(self.send(self.state.snapshot(now=101))), now=500)
+        self.assertTrue(self.mirror.apply_delta(self.send(early)))
+        self.assertEqual(70, self.mirror.state['volume'])
+        self.assertEqual(33, self.mirror.position(now=502))
+
+        self.assertTrue(self.mirror.apply_delta(self.send(self.state.update(paused=True, now=104))))
+        self.assertEqual(34, self.mirror.position(now=600))
+        self.assertEqual({'paused': True, 'position': 34}, self.changes[-1])
+
+    def test_gap(self):
+        self.mirror.apply_snapshot(self.send(self.state.snapshot()))
+        self.state.update(volume=10)
+        missed = self.state.update(volume=20)
+        self.assertFalse(self.mirror.apply_delta(self.send(missed)))
+        self.assertIsNone(self.mirror.state['volume'])
+        self.mirror.apply_snapshot(self.send(self.state.snapshot()))
+        self.assertEqual(20, self.mirror.state['volume'])
+
+
+class ReplayBufferTest(unittest.TestCase):
+
+    def test_since(self):
+        replay = ReplayBuffer(4)
+        self.assertEqual([], replay.since(0))
+        for seq in range(1, 7):
+            replay.append(seq, 'delta {}'.format(seq))
+        self.assertEqual(4, len(replay))
+        self.assertEqual(['delta 5', 'delta 6'], replay.since(4))
+        self.assertEqual(['delta 3', 'delta 4', 'delta 5', 'delta 6'], replay.since(2))
+        self.assertEqual([], replay.since(6))
+        #Fell out of the window, or ahead of it
+        self.assertIsNone(replay.since(1))
+        self.assertIsNone(replay.since(7))
+
+    def test_resume_payload(self):
+        state = PlaybackState('abc')
+        state.update(volume=50)
+        mirror = StateMirror()
+        self.assertIsNone(mirror.resume_payload())
+        mirror.apply_snapshot(json.dumps(state.snapshot()).encode('UTF-8'))
+        self.assertEqual({'id': 'abc', 'seq': 1}, json.loads(mirror.resume_payload().decode('UTF-8')))
@@ -0,0 +1,175 @@
+import unittest
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+from partybox import transcode
+from partybox.transcode import TranscodeCache, Transcoder, content_key, local_path
+from partybox.scheduler import Scheduler
+from partybox.media import TestMedia
+
+
+def copy(source, destination, profile):
+    shutil.copyfile(source, destination)
+
+
+class Log(object):
+
+    def __init__(self):
+        self.started = []
+        self.failed = threading.Event()
+
+    def debug(self, message):
+        self.started.append(message)
+
+    def warning(self, message):
+        self.failed.set()
+
+
+class TranscodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def source(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def fake_vlc(self, script):
+        path = os.path.join(self.dir, 'vlc')
+        with open(path, 'w') as f:
+            f.write('#!{}\nimport re, sys, time\n'.format(sys.executable) + script)
+        os.chmod(path, 0o755)
+        self.addCleanup(setattr, transcode, 'VLC', transcode.VLC)
+        transcode.VLC = path
+
+    def cached(self, cache, key, size):
+        with open(cache.path(key), 'wb') as f:
+            f.write(b'x' * size)
+        cache.add(key)
+
+    def test_local_path(self):
+        path = self.source('a.flac', b'a')
+        self.assertEqual(local_path(path), path)
+        self.assertEqual(local_path('file://' + path), path)
+        self.assertIsNone(local_path('http://example.com/a.mp3'))
+        self.assertIsNone(local_path(os.path.join(self.dir, 'missing.flac')))
+
+    def test_content_key(self):
+        a = self.source('a.flac', b'same')
+        b = self.source('b.flac', b'same')
+        c = self.source('c.flac', b'different')
+        self.assertEqual(content_key(a), content_key(b))
+        self.assertNotEqual(content_key(a), content_key(c))
+        self.assertNotEqual(content_key(a), content_key(a, 'acodec=vorb'))
+
+    def test_transcode(self):
+        os.mkdir(self.cache_dir)
+        path = self.source('a.flac', b'audio')
+        source, mtime, size, key, error = transcode.transcode(path, self.cache_dir, converter=copy)
+        self.assertIsNone(error)
+        self.assertEqual((source, size, key), (path, 5, content_key(path)))
+        self.assertEqual(os.listdir(self.cache_dir), [key + transcode.EXTENSION])
+
+    def test_transcode_error(self):
+        error = transcode.transcode(os.path.join(self.dir, 'missing.flac'), self.dir, converter=copy)[-1]
+        self.assertTrue(error.startswith('OSError'))
+
+    def test_transcode_failed_cleaned_up(self):
+        os.mkdir(self.cache_dir)
+        self.fake_vlc("sout = sys.argv[sys.argv.index('--sout') + 1]\n"
+                      "open(re.search('dst=\"(.*)\"', sout).group(1), 'w').write('partial')\n"
+                      "sys.exit(1)\n")
+        error = transcode.transcode(self.source('a.flac', b'audio'), self.cache_dir)[-1]
+        self.assertTrue(error.startswith('IOError'))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_transcode_timeout_cleaned_up(self):
+        os.mkdir(self.cache_dir)
+        self.fake_vlc("sout = sys.argv[sys.argv.index('--sout') + 1]\n"
+                      "open(re.search('dst=\"(.*)\"', sout).group(1), 'w').write('partial')\n"
+                      "time.sleep(10)\n")
+        self.addCleanup(setattr, transcode, 'UNKNOWN_TIMEOUT', transcode.UNKNOWN_TIMEOUT)
+        transcode.UNKNOWN_TIMEOUT = 0.5
+        error = transcode.transcode(self.source('a.flac', b'audio'), self.cache_dir)[-1]
+        self.assertTrue(error.startswith('IOError'))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_vlc_transcode(self):
+        self.fake_vlc("sout = sys.argv[sys.argv.index('--sout') + 1]\n"
+                      "open(re.search('dst=\"(.*)\"', sout).group(1), 'w').write('mp3')\n")
+        destination = os.path.join(self.dir, 'a.mp3')
+        transcode.vlc_transcode(self.source('a.flac', b'audio'), destination)
+        with open(destination) as f:
+            self.assertEqual(f.read(), 'mp3')
+
+    def test_vlc_transcode_fails(self):
+        self.fake_vlc('sys.exit(1)\n')
+        self.assertRaises(IOError, transcode.vlc_transcode, self.source('a.flac', b'audio'),
+                          os.path.join(self.dir, 'a.mp3'))
+
+    def test_vlc_transcode_cancelled(self):
+        self.fake_vlc('time.sleep(10)\n')
+        cancel = threading.Event()
+        threading.Timer(0.2, cancel.set).start()
+        started = time.time()
+        self.assertRaises(IOError, transcode.vlc_transcode, self.source('a.flac', b'audio'),
+                          os.path.join(self.dir, 'a.mp3'), cancel=cancel)
+        self.assertLess(time.time() - started, 5)
+
+    def test_vlc_transcode_timeout(self):
+        self.fake_vlc('time.sleep(10)\n')
+        self.addCleanup(setattr, transcode, 'TIMEOUT_MARGIN', transcode.TIMEOUT_MARGIN)
+        transcode.TIMEOUT_MARGIN = 0.2
+        started = time.time()
+        self.assertRaises(IOError, transcode.vlc_transcode, self.source('a.flac', b'audio'),
+                          os.path.join(self.dir, 'a.mp3'), length=0.1)
+        self.assertLess(time.time() - started, 5)
+
+    def test_failed_not_retried(self):
+        self.fake_vlc('sys.exit(1)\n')
+        queue = [TestMedia(self.source('a.flac', b'audio'))]
+        transcoder = Transcoder(TranscodeCache(self.cache_dir), queue, Scheduler(), processes=1)
+        transcoder.start()
+        self.addCleanup(transcoder.stop)
+        transcoder.log = Log()
+        transcoder.update()
+        self.assertTrue(transcoder.log.failed.wait(5))
+        transcoder.update()
+        self.assertEqual(len(transcoder.log.started), 1)
+
+    def test_eviction(self):
+        cache = TranscodeCache(self.cache_dir, budget=25)
+        self.cached(cache, 'a', 10)
+        self.cached(cache, 'b', 10)
+        #a is used, so b is the least recently used
+        self.assertEqual(cache.get('a'), cache.path('a'))
+        self.cached(cache, 'c', 10)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertFalse(os.path.exists(cache.path('b')))
+        self.assertEqual(cache.size, 20)
+
+    def test_reload(self):
+        cache = TranscodeCache(self.cache_dir)
+        self.cached(cache, 'a', 10)
+        open(cache.path('b') + '.123.tmp', 'w').close()
+        cache = TranscodeCache(self.cache_dir)
+        self.assertIn('a', cache)
+        self.assertEqual(cache.size, 10)
+        self.assertEqual(os.listdir(self.cache_dir), ['a' + transcode.EXTENSION])
+
+    def test_missing(self):
+        cache = TranscodeCache(self.cache_dir)
+        self.cached(cache, 'a', 10)
+        os.remove(cache.path('a'))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.size, 0)